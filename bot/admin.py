@@ -1,16 +1,23 @@
 from collections.abc import Callable, Sequence
 from typing import Any
+from django import forms
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django.http import HttpRequest
-from bot.models import TelegramUser, Contact, Product, Order, OrderItem, CustomUser, Category, Area, ArchiveOrder
+from bot.models import TelegramUser, Contact, Product, Order, OrderItem, CustomUser, Category, Area, ArchiveOrder, Notification, \
+    StockMovement, ArchiveOrderItem, OrderEvent, SlaRollup
+from bot import catalog, search, sla, stock
+from bot.signals import batched_notifications
 from solo.admin import SingletonModelAdmin
-from django.db.models import Sum, F, FloatField
-from django.db.models import Q
-from django.utils.html import format_html
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery
+from django.utils.html import format_html, format_html_join
 from import_export.admin import ImportExportModelAdmin
 from django.http import HttpResponseRedirect
+from django.template.response import TemplateResponse
 from django.contrib.auth.models import Group
 from django.utils import timezone
+from django.contrib import messages
 from datetime import timedelta
 
 admin.site.unregister(Group)
@@ -24,13 +31,7 @@ class CategoryAdmin(admin.ModelAdmin):
 
     def get_search_results(self, request, queryset, search_term):
         if search_term:
-            search_term = search_term.lower()  # Ensure the search term is lowercase
-            queries = [
-                Q(**{f"{field}__icontains": search_term}) |
-                Q(**{f"{field}__iregex": f"(?i){search_term}"})  # Using regex for case-insensitive match
-                for field in self.search_fields
-            ]
-            queryset = queryset.filter(*queries)
+            queryset = queryset.filter(pk__in=search.categories(search_term))
         return queryset, False
 
 
@@ -54,26 +55,65 @@ class CustomUserAdmin(admin.ModelAdmin):
 admin.site.register(Contact, SingletonModelAdmin)
 
 
+# Price field of the product forms per client category, see Product.price_uzs_a etc.
+PRICE_FIELDS = {f"price_uzs_{tier}": tier for tier in TelegramUser.UserCategory.values}
+
+
+class ProductForm(forms.ModelForm):
+    """The prices aren't columns, they are saved to ProductPrice together with the m2m data."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk:
+            for name in PRICE_FIELDS:
+                if name in self.fields:
+                    self.fields[name].initial = getattr(self.instance, name)
+
+    def _save_m2m(self):
+        super()._save_m2m()
+        prices = {tier: self.cleaned_data[name] for name, tier in PRICE_FIELDS.items() if name in self.changed_data}
+        if prices:
+            catalog.set_prices(self.instance, prices)
+
+
+# Declared in a loop so that a new client category shows up without touching the form
+ProductForm = type("ProductForm", (ProductForm,), {
+    "__module__": __name__,
+    **{name: forms.FloatField(label=getattr(Product, name).fget.short_description, initial=0)
+       for name in PRICE_FIELDS},
+})
+
+
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ("id", "title", "is_active", "price_uzs_a",
-                    "price_uzs_b", "price_uzs_c", "price_uzs_d", "price_uzs_e", "amount")
-    list_editable = ('is_active', "price_uzs_a", "price_uzs_b", "price_uzs_c", "price_uzs_d", "price_uzs_e", "amount")
+    form = ProductForm
+    list_display = ("id", "title", "is_active", *PRICE_FIELDS, "amount", "reserved")
+    # The price columns are editable as well, they come with the changelist form
+    list_editable = ('is_active', "amount")
     list_display_links = ("id", "title",)
     list_filter = ("category", "is_active")
     search_fields = ("title",)
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related("prices")
+
+    def get_changelist_form(self, request, **kwargs):
+        return super().get_changelist_form(request, form=ProductForm, **kwargs)
+
     def get_search_results(self, request, queryset, search_term):
         if search_term:
-            search_term = search_term.lower()  # Ensure the search term is lowercase
-            queries = [
-                Q(**{f"{field}__icontains": search_term}) |
-                Q(**{f"{field}__iregex": f"(?i){search_term}"})  # Using regex for case-insensitive match
-                for field in self.search_fields
-            ]
-            queryset = queryset.filter(*queries)
+            queryset = queryset.filter(pk__in=search.products(search_term))
         return queryset, False
 
+    def save_model(self, request, obj, form, change):
+        if not change or "amount" not in form.changed_data:
+            return super().save_model(request, obj, form, change)
+        # Stock counts go through the ledger so they add up with reservations and write-offs made meanwhile
+        stock.adjust(obj.pk, form.cleaned_data["amount"] - form.initial["amount"])
+        fields = [name for name in form.changed_data if name != "amount" and name not in PRICE_FIELDS]
+        if fields:
+            obj.save(update_fields=fields)
+
 
 from bot.resources import UsersTableResourse, OrderResource
 
@@ -105,6 +145,11 @@ class OrderItemTabularInline(admin.TabularInline):
     def get_fields(self, request, obj=None):
         return ['product_name', 'product_in_set', 'qty', 'set_amount', 'price_uzs', 'get_real_qty']
 
+    def get_queryset(self, request):
+        # The free stock of every line's product in the same query, read by get_real_qty
+        available = Product.objects.filter(pk=OuterRef("product_id")).values(available=F("amount") - F("reserved"))
+        return super().get_queryset(request).annotate(product_available=Subquery(available))
+
     def has_delete_permission(self, request, obj=None) -> bool:
         return False
 
@@ -115,6 +160,10 @@ class OrderItemTabularInline(admin.TabularInline):
         return False
 
 
+class ArchiveOrderItemTabularInline(OrderItemTabularInline):
+    model = ArchiveOrderItem
+
+
 import openpyxl
 from openpyxl.styles import Font, Alignment, PatternFill, Side, Border
 from django.utils.timezone import localtime
@@ -213,7 +262,7 @@ def export_orders_to_excel(modeladmin, request, queryset):
                 cell = ws.cell(row=ws.max_row, column=col_num)
                 cell.alignment = Alignment(horizontal="right")
 
-        items_count = order.items.all().count()
+        items_count = order.item_count
         row_count += items_count
 
         ws.merge_cells(f"A{row_count + 1}:E{row_count + 1}")
@@ -353,7 +402,7 @@ def export_invoice_total_amount(modeladmin, request, queryset):
 
             total_count += int(float(item.qty))
 
-        items_count = order.items.all().count()
+        items_count = order.item_count
         row_count += items_count
 
     ws[f"A{count + 4}"] = ""
@@ -386,11 +435,132 @@ def export_invoice_total_amount(modeladmin, request, queryset):
 
 export_invoice_total_amount.short_description = "Накладная общая сумма (Excel)"
 
+def save_order(request, obj, form, change):
+    """Saves the order form, status and approval changes are applied as Order.TRANSITIONS."""
+    if not change:
+        return obj.save()
+
+    names = [
+        f"{role}_{'approve' if flag == 'confirm' else 'cancel'}"
+        for role in Order.APPROVERS for flag in ("confirm", "cancel")
+        if f"is_{role}_{flag}" in form.changed_data and form.cleaned_data[f"is_{role}_{flag}"]
+    ]
+    if "status" in form.changed_data:
+        name = next((name for name, (_, target) in Order.TRANSITIONS.items() if target == obj.status), None)
+        if name is None:
+            messages.error(request, f"Заказ Nº {obj.pk}: переход в статус «{obj.get_status_display()}» недоступен.")
+        elif name not in names:
+            names.append(name)
+        obj.status = form.initial["status"]
+
+    obj.save()
+    for name in names:
+        if not obj.transition(name, actor=request.user):
+            target = Order.OrderStatus(Order.TRANSITIONS[name][1]).label
+            messages.error(request, f"Заказ Nº {obj.pk}: «{target}» не применено, статус заказа уже изменён.")
+
+
+def transition_orders(model_admin, request, queryset, action):
+    """Applies ``<role>_<action>`` of the user's role to the selected orders in one transaction, orders
+    whose flag the role may not change in the form are skipped. The agents get one notification each."""
+    role = getattr(request.user, "role", None)
+    if role not in Order.APPROVERS:
+        return messages.error(request, "Действие доступно только для подтверждающих ролей.")
+
+    name = f"{role}_{action}"
+    flag = f"is_{role}_{'confirm' if action == 'approve' else 'cancel'}"
+    orders = OrderEvent.attach(queryset.select_related("user", "agent").prefetch_related("items", "agent__territory"))
+    done, skipped = [], []
+    with transaction.atomic(), batched_notifications():
+        for order in orders:
+            if flag in model_admin.get_readonly_fields(request, order) or not order.transition(name, actor=request.user):
+                skipped.append(order.pk)
+            else:
+                done.append(order.pk)
+
+    target = Order.OrderStatus(Order.TRANSITIONS[name][1]).label
+    if done:
+        messages.success(request, f"«{target}»: {len(done)} заказ(ов).")
+    if skipped:
+        messages.warning(request, f"«{target}» не применено к заказам Nº {', '.join(map(str, skipped))}.")
+
+
+CANCELERS = {
+    "rop": "руководителем отдела продаж",
+    "accountant": "бухгалтером",
+    "director": "директором",
+    "storekeeper": "кладовщиком",
+}
+
+
+class OrderForm(forms.ModelForm):
+    """The approval checkboxes aren't columns, save_order applies the checked ones as transitions."""
+    is_rop_confirm = forms.BooleanField(label="Руководитель отдела продаж подтвердил?", required=False)
+    is_accountant_confirm = forms.BooleanField(label="Бухгалтер подтвердил?", required=False)
+    is_director_confirm = forms.BooleanField(label="Директор подтвердил?", required=False)
+    is_storekeeper_confirm = forms.BooleanField(label="Кладовщик подтвердил?", required=False)
+    is_rop_cancel = forms.BooleanField(label="Руководитель отдела продаж отменил?", required=False)
+    is_accountant_cancel = forms.BooleanField(label="Бухгалтер отменил?", required=False)
+    is_director_cancel = forms.BooleanField(label="Директор отменил?", required=False)
+    is_storekeeper_cancel = forms.BooleanField(label="Кладовщик отменил?", required=False)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for name in Order.STAGE_FLAGS:
+            if name in self.fields:
+                self.fields[name].initial = getattr(self.instance, name)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        for role, whom in CANCELERS.items():
+            if cleaned_data.get(f"is_{role}_confirm") and cleaned_data.get(f"is_{role}_cancel"):
+                self.add_error(f"is_{role}_confirm", f"Нельзя одновременно подтвердить и отменить заказ {whom}.")
+        return cleaned_data
+
+
+def order_fields(model):
+    """Names of everything the order form shows, the model's fields and the approval checkboxes."""
+    return [field.name for field in model._meta.fields] + list(Order.STAGE_FLAGS)
+
+
+APPROVED_ICON = '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="16" height="16"><circle cx="12" cy="12" r="12" fill="green"/><path fill="none" stroke="white" stroke-width="2" d="M6 12l4 4l8-8" /></svg>'
+CANCELED_ICON = '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="16" height="16"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg>'
+WAITING_ICON = '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="16" height="16"><circle cx="12" cy="12" r="11" fill="none" stroke="gray" stroke-width="2"/></svg>'
+STAGE_NAMES = {
+    "rop": "Руководитель отдел продаж",
+    "accountant": "Бухгалтер",
+    "director": "Директор",
+    "storekeeper": "Кладовщик",
+}
+
+
+def stage_badges(order):
+    rows = []
+    for role, stage_name in STAGE_NAMES.items():
+        if order.stages.get((role, "cancel")):
+            icon, text, at = CANCELED_ICON, "Отказано", order.stages[(role, "cancel")]
+        elif order.stages.get((role, "approve")):
+            icon, text, at = APPROVED_ICON, "Подтверждено", order.stages[(role, "approve")]
+        else:
+            icon, text, at = WAITING_ICON, "", None
+        rows.append((format_html(icon), stage_name, text, localtime(at).strftime("%d.%m.%Y %H:%M") if at else ""))
+    return format_html_join(format_html("<br>"), "{} {}: {} {}", rows)
+
+
+class StagesChangeList(ChangeList):
+    """Loads the events of the page's orders with one query for their stage badges."""
+
+    def get_results(self, request):
+        super().get_results(request)
+        OrderEvent.attach(self.result_list)
+
+
 @admin.register(ArchiveOrder)
 class ActiveOrderAdmin(admin.ModelAdmin):
     list_display = ("id", "user", "status", "comment", "get_total_cost", "location_path")
     list_per_page = 20
-    inlines = (OrderItemTabularInline,)
+    inlines = (ArchiveOrderItemTabularInline,)
+    form = OrderForm
     fields = (
         "user", "status", "payment_status", "payment_type", "comment", "is_rop_confirm", "is_accountant_confirm", "is_director_confirm",
         "is_storekeeper_confirm", "is_rop_cancel", "is_accountant_cancel", "is_director_cancel", "is_storekeeper_cancel")
@@ -426,13 +596,6 @@ class ActiveOrderAdmin(admin.ModelAdmin):
                 p = Product.objects.filter(title__icontains=product.product_name).last()
                 product.product_id = p.pk if p else 0
 
-    def get_readonly_fields(self, request, obj=None):
-        if request.user.username == "admin" and request.user.is_superuser:
-            return []
-               
-        return [field.name for field in self.model._meta.fields]
-
-
     def get_fields(self, request: HttpRequest, obj=None):
         if request.user.role == "storekeeper":
             return ("status", "user", "comment", "is_storekeeper_confirm")
@@ -442,39 +605,31 @@ class ActiveOrderAdmin(admin.ModelAdmin):
         if request.user.role == "rop":
             return (
                 "id", "user", "get_agent_name", "get_agent_territory", "status", "get_total_cost", "payment_status",
-                "payment_type", "comment", "get_location", "created_at",
-                "get_rop_approve_time", "get_accountant_approve_time", "get_director_approve_time",
-                "get_storekeeper_approve_time",
+                "payment_type", "comment", "get_location", "created_at", "get_stages",
             )
 
         if request.user.role == "accountant":
             return (
                 "id", "user", "get_agent_name", "get_agent_territory", "status", "get_total_cost", "payment_status",
-                "payment_type", "comment", "get_location", "created_at",
-                "get_rop_approve_time", "get_accountant_approve_time", "get_director_approve_time",
-                "get_storekeeper_approve_time",
+                "payment_type", "comment", "get_location", "created_at", "get_stages",
             )
 
         if request.user.role == "director":
             return (
                 "id", "user", "get_agent_name", "get_agent_territory", "status", "get_total_cost", "payment_status",
-                "payment_type", "comment", "get_location", "created_at",
-                "get_rop_approve_time", "get_accountant_approve_time", "get_director_approve_time",
-                "get_storekeeper_approve_time",
+                "payment_type", "comment", "get_location", "created_at", "get_stages",
             )
 
         if request.user.role == "storekeeper":
             return (
                 "id", "user", "get_agent_name", "get_agent_territory", "status", "get_total_cost", "comment",
-                "get_location", "created_at", "get_accountant_approve_time",
-                "get_rop_approve_time", "get_director_approve_time", "get_storekeeper_approve_time",
+                "get_location", "created_at", "get_stages",
             )
 
         return (
             "id", "user", "get_agent_name", "get_agent_territory", "status", "get_total_cost", "comment",
             "payment_status", "payment_type", "get_location",
-            "created_at", "get_rop_approve_time", "get_accountant_approve_time", "get_director_approve_time",
-            "get_storekeeper_approve_time",
+            "created_at", "get_stages",
         )
 
     def get_agent_territory(self, obj):
@@ -491,33 +646,13 @@ class ActiveOrderAdmin(admin.ModelAdmin):
 
     get_agent_name.short_description = "Агент"
 
-    def get_rop_approve_time(self, obj):
-        if obj.is_rop_confirm and obj.rop_approve_time:
-            return format_html(
-                f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="green"/><path fill="none" stroke="white" stroke-width="2" d="M6 12l4 4l8-8" /></svg> Подтвержденный <br>{obj.rop_approve_time.strftime("%d.%m.%Y %H:%M:%S")}' if obj.is_rop_confirm else '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg>')
-
-    get_rop_approve_time.short_description = "Руководитель отдел продаж"
-
-    def get_accountant_approve_time(self, obj):
-        if obj.is_accountant_confirm and obj.accountant_approve_time:
-            return format_html(
-                f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="green"/><path fill="none" stroke="white" stroke-width="2" d="M6 12l4 4l8-8" /></svg> Подтвержденный <br>{obj.accountant_approve_time.strftime("%d.%m.%Y %H:%M:%S")}' if obj.is_accountant_confirm else '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg>')
-
-    get_accountant_approve_time.short_description = "Бухгалтер"
-
-    def get_director_approve_time(self, obj):
-        if obj.is_director_confirm and obj.director_approve_time:
-            return format_html(
-                f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="green"/><path fill="none" stroke="white" stroke-width="2" d="M6 12l4 4l8-8" /></svg> Подтвержденный <br>{obj.director_approve_time.strftime("%d.%m.%Y %H:%M:%S")}' if obj.is_director_confirm else '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg>')
-
-    get_director_approve_time.short_description = "Директор"
+    def get_stages(self, obj):
+        return stage_badges(obj)
 
-    def get_storekeeper_approve_time(self, obj):
-        if obj.is_storekeeper_confirm and obj.storekeeper_approve_time:
-            return format_html(
-                f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="green"/><path fill="none" stroke="white" stroke-width="2" d="M6 12l4 4l8-8" /></svg> Подтвержденный <br>{obj.storekeeper_approve_time.strftime("%d.%m.%Y %H:%M:%S")}' if obj.is_storekeeper_confirm else '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg>')
+    get_stages.short_description = "Этапы"
 
-    get_storekeeper_approve_time.short_description = "Кладовщик"
+    def get_changelist(self, request, **kwargs):
+        return StagesChangeList
 
     def formfield_for_choice_field(self, db_field, request, **kwargs):
         if db_field.name == 'status':
@@ -530,36 +665,18 @@ class ActiveOrderAdmin(admin.ModelAdmin):
 
         return super().formfield_for_choice_field(db_field, request, **kwargs)
 
-    def get_queryset(self, request):
-        queryset = super().get_queryset(request)
-        queryset = queryset.annotate(
-            total_price=Sum(F('items__price_uzs') * F('items__qty'), output_field=FloatField())
-        )
-        
-        queryset = queryset.exclude(
-            Q(is_rop_cancel=True) | 
-            Q(is_accountant_cancel=True) |
-            Q(is_director_cancel=True) |
-            Q(is_storekeeper_cancel=True)
-        )
-
-        queryset = queryset.filter(
-            is_rop_confirm=True,
-            is_director_confirm=True,
-            is_storekeeper_confirm=True,
-            is_accountant_confirm=True
-        )
-
-        return queryset
-
     def has_delete_permission(self, request, obj=None):
         return False
 
     def has_add_permission(self, request):
         return False
 
+    def has_change_permission(self, request, obj=None):
+        # Archived orders are final, the admin only shows them (superusers included)
+        return False
+
     def get_total_cost(self, obj):
-        return f"{(obj.total_price):,}" if obj.total_price else 0
+        return f"{obj.total_uzs:,}" if obj.total_uzs else 0
 
     get_total_cost.short_description = "Общая сумма"
 
@@ -573,7 +690,7 @@ class ActiveOrderAdmin(admin.ModelAdmin):
 
     list_display_links = (
         "id", "user", "status", "get_total_cost", "payment_status", "payment_type", "get_location", "created_at",
-        "get_rop_approve_time", "get_accountant_approve_time", "get_director_approve_time", "get_storekeeper_approve_time")
+        "get_stages")
 
 
 @admin.register(Order)
@@ -581,6 +698,7 @@ class OrderAdmin(ImportExportModelAdmin):
     list_display = ("id", "user", "status", "comment", "get_total_cost", "location_path")
     list_per_page = 20
     inlines = (OrderItemTabularInline,)
+    form = OrderForm
     fields = (
     "user", "status", "payment_status", "payment_type", "comment", "is_rop_confirm", "is_accountant_confirm", "is_director_confirm",
     "is_storekeeper_confirm", "is_rop_cancel", "is_accountant_cancel", "is_director_cancel", "is_storekeeper_cancel")
@@ -591,7 +709,18 @@ class OrderAdmin(ImportExportModelAdmin):
     skip_export_form = True
     
 
-    actions = ['generate_multiple_pdfs', 'generate_pdf2', export_orders_to_excel, export_invoice_total_amount]
+    actions = ['confirm_orders', 'cancel_orders', 'generate_multiple_pdfs', 'generate_pdf2', export_orders_to_excel,
+               export_invoice_total_amount]
+
+    def confirm_orders(self, request, queryset):
+        transition_orders(self, request, queryset, "approve")
+
+    confirm_orders.short_description = "Подтвердить выбранные заказы"
+
+    def cancel_orders(self, request, queryset):
+        transition_orders(self, request, queryset, "cancel")
+
+    cancel_orders.short_description = "Отменить выбранные заказы"
 
     def generate_multiple_pdfs(self, request, queryset):
         selected_ids = queryset.values_list('id', flat=True)
@@ -622,76 +751,76 @@ class OrderAdmin(ImportExportModelAdmin):
             return []
 
         if obj and obj.status == "cancelled":
-            return [field.name for field in self.model._meta.fields]
+            return order_fields(self.model)
 
         if request.user.role == "rop" and obj.is_rop_confirm and obj.rop_approve_time:
             if timezone.now() <= obj.rop_approve_time + timedelta(hours=1):
                 return [
-                    field.name for field in self.model._meta.fields
-                    if field.name not in {"is_rop_confirm", "is_rop_cancel"}
+                    field for field in order_fields(self.model)
+                    if field not in {"is_rop_confirm", "is_rop_cancel"}
                 ]
         
         if request.user.role == "accountant" and obj.is_accountant_confirm and obj.accountant_approve_time:
             if timezone.now() <= obj.accountant_approve_time + timedelta(hours=1):
                 return [
-                    field.name for field in self.model._meta.fields
-                    if field.name not in {"is_accountant_confirm", "is_accountant_cancel"}
+                    field for field in order_fields(self.model)
+                    if field not in {"is_accountant_confirm", "is_accountant_cancel"}
                 ]
         
         if request.user.role == "director" and obj.is_director_confirm and obj.director_approve_time:
             if timezone.now() <= obj.director_approve_time + timedelta(hours=1):
                 return [
-                    field.name for field in self.model._meta.fields
-                    if field.name not in {"is_director_confirm", "is_director_cancel"}
+                    field for field in order_fields(self.model)
+                    if field not in {"is_director_confirm", "is_director_cancel"}
                 ]
         
         if request.user.role == "storekeeper" and obj.is_storekeeper_confirm and obj.storekeeper_approve_time:
             if timezone.now() <= obj.storekeeper_approve_time + timedelta(hours=1):
                 return [
-                    field.name for field in self.model._meta.fields
-                    if field.name not in {"is_storekeeper_confirm", "is_storekeeper_cancel"}
+                    field for field in order_fields(self.model)
+                    if field not in {"is_storekeeper_confirm", "is_storekeeper_cancel"}
                 ]
 
         if request.user.role == "rop":
             if obj.is_rop_confirm or obj.is_rop_cancel:
-                return [field.name for field in self.model._meta.fields]
+                return order_fields(self.model)
 
             return [
-                field.name for field in self.model._meta.fields
-                if field.name not in {"is_rop_confirm", "is_rop_cancel"}
+                field for field in order_fields(self.model)
+                if field not in {"is_rop_confirm", "is_rop_cancel"}
             ]
 
         if request.user.role == "accountant":
             if obj.is_rop_confirm and not obj.is_accountant_confirm:
                 return [
-                    field.name for field in self.model._meta.fields
-                    if field.name not in {"is_accountant_confirm", "is_accountant_cancel"}
+                    field for field in order_fields(self.model)
+                    if field not in {"is_accountant_confirm", "is_accountant_cancel"}
                 ]
 
             if obj.is_accountant_confirm or obj.is_accountant_cancel or obj.is_rop_cancel:
-                return [field.name for field in self.model._meta.fields]
+                return order_fields(self.model)
 
         if request.user.role == "director":
             if obj.is_accountant_confirm and not obj.is_director_confirm:
                 return [
-                    field.name for field in self.model._meta.fields
-                    if field.name not in {"is_director_confirm", "is_director_cancel"}
+                    field for field in order_fields(self.model)
+                    if field not in {"is_director_confirm", "is_director_cancel"}
                 ]
                 
             if obj.is_director_confirm or obj.is_director_cancel or obj.is_accountant_cancel:
-                return [field.name for field in self.model._meta.fields]
+                return order_fields(self.model)
     
         if request.user.role == "storekeeper":
             if obj.is_director_confirm and not obj.is_storekeeper_confirm:
                 return [
-                    field.name for field in self.model._meta.fields
-                    if field.name not in {"is_storekeeper_confirm", "is_storekeeper_cancel"}
+                    field for field in order_fields(self.model)
+                    if field not in {"is_storekeeper_confirm", "is_storekeeper_cancel"}
                 ]
             
             if obj.is_storekeeper_confirm or obj.is_storekeeper_cancel or obj.is_director_cancel:
-                return [field.name for field in self.model._meta.fields]
+                return order_fields(self.model)
             
-        return [field.name for field in self.model._meta.fields]
+        return order_fields(self.model)
 
 
     def get_fields(self, request: HttpRequest, obj=None):
@@ -703,35 +832,29 @@ class OrderAdmin(ImportExportModelAdmin):
         if request.user.role == "rop":
             return (
                 "id", "user", "get_agent_name", "get_agent_territory", "status", "get_total_cost", "payment_status", "payment_type", "comment", "get_location", "created_at",
-                "get_rop_approve_time", "get_accountant_approve_time", "get_director_approve_time", "get_storekeeper_approve_time",
-                "get_rop_cancel_time", "get_accountant_cancel_time", "get_director_cancel_time", "get_storekeeper_cancel_time"
+                "get_stages",
             )
 
         if request.user.role == "accountant":
             return (
                 "id", "user", "get_agent_name", "get_agent_territory", "status", "get_total_cost", "payment_status", "payment_type", "comment", "get_location", "created_at",
-                "get_rop_approve_time", "get_accountant_approve_time", "get_director_approve_time", "get_storekeeper_approve_time",
-                "get_rop_cancel_time", "get_accountant_cancel_time", "get_director_cancel_time", "get_storekeeper_cancel_time"
+                "get_stages",
             )
 
         if request.user.role == "director":
             return (
                 "id", "user", "get_agent_name", "get_agent_territory", "status", "get_total_cost", "payment_status", "payment_type", "comment", "get_location", "created_at",
-                "get_rop_approve_time", "get_accountant_approve_time", "get_director_approve_time", "get_storekeeper_approve_time",
-                "get_rop_cancel_time", "get_accountant_cancel_time", "get_director_cancel_time", "get_storekeeper_cancel_time",
+                "get_stages",
             )
 
         if request.user.role == "storekeeper":
             return (
-                "id", "user", "get_agent_name", "get_agent_territory", "status", "get_total_cost", "comment", "get_location", "created_at", "get_accountant_approve_time",
-                "get_rop_approve_time", "get_director_approve_time", "get_storekeeper_approve_time",
-                "get_rop_cancel_time", "get_accountant_cancel_time", "get_director_cancel_time", "get_storekeeper_cancel_time",
+                "id", "user", "get_agent_name", "get_agent_territory", "status", "get_total_cost", "comment", "get_location", "created_at", "get_stages",
             )
 
         return (
             "id", "user", "get_agent_name", "get_agent_territory", "status", "get_total_cost", "comment", "payment_status", "payment_type", "get_location",
-            "created_at", "get_rop_approve_time", "get_accountant_approve_time", "get_director_approve_time",
-            "get_storekeeper_approve_time", "get_rop_cancel_time", "get_accountant_cancel_time", "get_director_cancel_time", "get_storekeeper_cancel_time"
+            "created_at", "get_stages",
         )
 
     def get_agent_territory(self, obj):
@@ -748,62 +871,13 @@ class OrderAdmin(ImportExportModelAdmin):
 
     get_agent_name.short_description = "Агент"
 
-    def get_rop_cancel_time(self, obj):
-        return format_html(
-            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="green"/><path fill="none" stroke="white" stroke-width="2" d="M6 12l4 4l8-8" /></svg> Отказанный <br>{obj.rop_cancel_time.strftime("%d.%m.%Y %H:%M:%S")}' if obj.rop_cancel_time else '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg>')
-
-    get_rop_cancel_time.short_description = "Отказ руководителем отдела продаж"
+    def get_stages(self, obj):
+        return stage_badges(obj)
 
-    def get_accountant_cancel_time(self, obj):
-        return format_html(
-            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="green"/><path fill="none" stroke="white" stroke-width="2" d="M6 12l4 4l8-8" /></svg> Отказанный <br>{obj.accountant_cancel_time.strftime("%d.%m.%Y %H:%M:%S")}' if obj.accountant_cancel_time else '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg>')
+    get_stages.short_description = "Этапы"
 
-    get_accountant_cancel_time.short_description = "Отказ бухгалтером"
-
-    def get_director_cancel_time(self, obj):
-        return format_html(
-            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="green"/><path fill="none" stroke="white" stroke-width="2" d="M6 12l4 4l8-8" /></svg> Отказанно <br>{obj.director_cancel_time.strftime("%d.%m.%Y %H:%M:%S")}' if obj.director_cancel_time else '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg>')
-
-    get_director_cancel_time.short_description = "Отказ директором"
-
-    def get_storekeeper_cancel_time(self, obj):
-        return format_html(
-            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="green"/><path fill="none" stroke="white" stroke-width="2" d="M6 12l4 4l8-8" /></svg> Отказанно <br>{obj.storekeeper_cancel_time.strftime("%d.%m.%Y %H:%M:%S")}' if obj.storekeeper_cancel_time else '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg>')
-
-    get_storekeeper_cancel_time.short_description = "Отказ кладовщиком"
-
-    def get_rop_approve_time(self, obj):
-        if obj and obj.status == "cancelled" and obj.rop_approve_time:
-            return format_html(
-                '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg> Отменено')
-        return format_html(
-            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="green"/><path fill="none" stroke="white" stroke-width="2" d="M6 12l4 4l8-8" /></svg> Подтвержденный <br>{obj.rop_approve_time.strftime("%d.%m.%Y %H:%M:%S")}' if obj.rop_approve_time else '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg>')
-
-    get_rop_approve_time.short_description = "Руководитель отдел продаж"
-
-    def get_accountant_approve_time(self, obj):
-        if obj and obj.status == "cancelled" and obj.accountant_approve_time:
-            return format_html(
-                '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg> Отменено')
-        return format_html(
-            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="green"/><path fill="none" stroke="white" stroke-width="2" d="M6 12l4 4l8-8" /></svg> Подтвержденный <br>{obj.accountant_approve_time.strftime("%d.%m.%Y %H:%M:%S")}' if obj.accountant_approve_time else '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg>')
-
-    get_accountant_approve_time.short_description = "Бухгалтер"
-
-    def get_director_approve_time(self, obj):
-        if obj and obj.status == "cancelled" and obj.director_approve_time:
-            return format_html(
-                '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg> Отменено')
-        return format_html(
-            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="green"/><path fill="none" stroke="white" stroke-width="2" d="M6 12l4 4l8-8" /></svg> Подтвержденный <br>{obj.director_approve_time.strftime("%d.%m.%Y %H:%M:%S")}' if obj.director_approve_time else '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg>')
-
-    get_director_approve_time.short_description = "Директор"
-
-    def get_storekeeper_approve_time(self, obj):
-        return format_html(
-            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="green"/><path fill="none" stroke="white" stroke-width="2" d="M6 12l4 4l8-8" /></svg> Подтвержденный <br>{obj.storekeeper_approve_time.strftime("%d.%m.%Y %H:%M:%S")}' if obj.storekeeper_approve_time else '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24" width="24" height="24"><circle cx="12" cy="12" r="12" fill="red"/><path fill="none" stroke="white" stroke-width="2" d="M6 6l12 12M6 18L18 6" /></svg>')
-
-    get_storekeeper_approve_time.short_description = "Кладовщик"
+    def get_changelist(self, request, **kwargs):
+        return StagesChangeList
 
     def formfield_for_choice_field(self, db_field, request, **kwargs):
         if db_field.name == 'status':
@@ -818,9 +892,6 @@ class OrderAdmin(ImportExportModelAdmin):
 
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
-        queryset = queryset.annotate(
-            total_price=Sum(F('items__price_uzs') * F('items__qty'), output_field=FloatField())
-        )
 
         if request.user.role == "director":
             queryset = queryset.exclude(status="pending")
@@ -835,8 +906,11 @@ class OrderAdmin(ImportExportModelAdmin):
     def has_add_permission(self, request):
         return False
 
+    def save_model(self, request, obj, form, change):
+        save_order(request, obj, form, change)
+
     def get_total_cost(self, obj):
-        return f"{(obj.total_price):,}" if obj.total_price else 0
+        return f"{obj.total_uzs:,}" if obj.total_uzs else 0
 
     get_total_cost.short_description = "Общая сумма"
 
@@ -850,8 +924,7 @@ class OrderAdmin(ImportExportModelAdmin):
 
     list_display_links = (
     "id", "user", "status", "get_total_cost", "payment_status", "payment_type", "get_location", "created_at",
-    "get_rop_approve_time", "get_accountant_approve_time", "get_director_approve_time", "get_storekeeper_approve_time",
-    "get_rop_cancel_time", "get_accountant_cancel_time", "get_director_cancel_time", "get_storekeeper_cancel_time",)
+    "get_stages",)
 
 
 @admin.register(Area)
@@ -870,3 +943,115 @@ class AreaAdmin(admin.ModelAdmin):
             ]
             queryset = queryset.filter(*queries)
         return queryset, False
+
+
+@admin.register(Notification)
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ("id", "chat_id", "status", "attempts", "created_at", "sent_at", "last_error")
+    list_filter = ("status",)
+    search_fields = ("chat_id",)
+    readonly_fields = ("bot_id", "chat_id", "text", "parse_mode", "attempts", "created_at", "sent_at", "last_error")
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ("id", "product", "order", "kind", "amount_change", "reserved_change", "created_at")
+    list_filter = ("kind",)
+    search_fields = ("product__title", "order__id")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(OrderEvent)
+class OrderEventAdmin(admin.ModelAdmin):
+    list_display = ("id", "order_id", "role", "action", "at", "actor")
+    list_filter = ("role", "action", "actor")
+    date_hierarchy = "at"
+    # The order may be archived already, the id is shown instead of following the relation
+    fields = ("order_id", "role", "action", "at", "actor")
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+def format_wait(seconds):
+    minutes = int(seconds // 60)
+    if minutes < 1:
+        return "< 1 мин"
+    if minutes < 60:
+        return f"{minutes} мин"
+    if minutes < 24 * 60:
+        return f"{minutes // 60} ч {minutes % 60} мин"
+    return f"{minutes // (24 * 60)} дн. {minutes // 60 % 24} ч"
+
+
+@admin.register(SlaRollup)
+class SlaRollupAdmin(admin.ModelAdmin):
+    """Dashboard of how long orders wait for each approver, read from the rollups only."""
+    # key -> (title, period of the rollups, length)
+    WINDOWS = {
+        "24h": ("Сутки", SlaRollup.Periods.HOUR, timedelta(hours=24)),
+        "7d": ("7 дней", SlaRollup.Periods.DAY, timedelta(days=7)),
+        "30d": ("30 дней", SlaRollup.Periods.DAY, timedelta(days=30)),
+        "90d": ("90 дней", SlaRollup.Periods.DAY, timedelta(days=90)),
+    }
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def changelist_view(self, request, extra_context=None):
+        window = request.GET.get("window") if request.GET.get("window") in self.WINDOWS else "7d"
+        title, period, length = self.WINDOWS[window]
+        since = sla.period_starts(timezone.now() - length)[period]
+        roles = dict(CustomUser.ROLE_CHOICES)
+
+        rows = []
+        for (role, territory), stats in sla.summary(period, since).items():
+            rows.append({
+                "role": roles.get(role, role),
+                "territory": territory,
+                "count": stats["count"],
+                "average": format_wait(stats["average"]),
+                **{
+                    f"p{percent}": f"≤ {format_wait(stats[f'p{percent}'])}" if stats[f"p{percent}"] is not None
+                    else f"> {format_wait(sla.LATENCY_BUCKETS[-1])}"
+                    for percent in sla.PERCENTILES
+                },
+                "order": (territory or "", Order.APPROVERS.index(role) if role in Order.APPROVERS else 0),
+            })
+        rows.sort(key=lambda row: row["order"])
+
+        context = {
+            **self.admin_site.each_context(request),
+            "title": f"SLA подтверждений: {title}",
+            "opts": self.model._meta,
+            "windows": [(key, value[0]) for key, value in self.WINDOWS.items()],
+            "window": window,
+            "totals": [row for row in rows if row["territory"] is None],
+            "territories": [row for row in rows if row["territory"] is not None],
+            **(extra_context or {}),
+        }
+        return TemplateResponse(request, "admin/bot/sla_dashboard.html", context)
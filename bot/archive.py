@@ -0,0 +1,53 @@
+import logging
+
+from django.db import transaction
+
+from bot.models import ArchiveOrder, ArchiveOrderItem, Order, OrderItem
+
+logger = logging.getLogger(__name__)
+
+Statuses = Order.OrderStatus
+
+# Orders in these statuses don't change anymore
+FINAL_STATUSES = [
+    Statuses.APPROVED_BY_STOREKEEPER,
+    Statuses.CANCELED_BY_ROP,
+    Statuses.CANCELED_BY_ACCOUNTANT,
+    Statuses.CANCELED_BY_DIRECTOR,
+    Statuses.CANCELED_BY_STOREKEEPER,
+    Statuses.CANCELLED,
+]
+
+
+def copy(instance, model):
+    return model(**{field.attname: getattr(instance, field.attname) for field in instance._meta.concrete_fields})
+
+
+def archivable(before):
+    """Finished orders placed before ``before``, oldest first, found through the order_status_created_at
+    index. created_at is the placement time, editing an order doesn't move it."""
+    return Order.objects.filter(status__in=FINAL_STATUSES, created_at__lt=before).order_by("created_at")
+
+
+def archive_batch(before, batch_size):
+    """Moves up to ``batch_size`` finished orders placed before ``before`` with their items into the
+    archive tables, in one transaction. Returns how many were moved."""
+    with transaction.atomic():
+        orders = list(archivable(before)[:batch_size])
+        if not orders:
+            return 0
+        ids = [order.pk for order in orders]
+        ArchiveOrder.objects.bulk_create([copy(order, ArchiveOrder) for order in orders])
+        ArchiveOrderItem.objects.bulk_create(
+            [copy(item, ArchiveOrderItem) for item in OrderItem.objects.filter(order_id__in=ids)]
+        )
+        Order.objects.filter(pk__in=ids).delete()
+    return len(orders)
+
+
+def archive_orders(before, batch_size=500):
+    total = 0
+    while moved := archive_batch(before, batch_size):
+        total += moved
+        logger.info("Archived %s orders", total)
+    return total
@@ -0,0 +1,157 @@
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from bot.models import CatalogVersion, Category, Product, ProductPrice, TelegramUser
+
+TIERS = TelegramUser.UserCategory.values
+DEFAULT_TIER = TelegramUser.UserCategory.A
+# Entries of old versions are never read again, they only have to expire eventually
+CACHE_TIMEOUT = 24 * 60 * 60
+PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+# How long a process trusts the versions it read, other processes' bumps show up after at most this long
+VERSION_TTL = 2
+
+# Default of cache.get() telling a cached None (no such product) from a miss
+MISSING = object()
+
+# Timestamp bumped with each version
+CHANGED_AT = {"version": "changed_at", "stock_version": "stock_changed_at"}
+
+_current = None
+_current_read_at = 0.0
+
+
+def current():
+    """The CatalogVersion row, read from the database at most every VERSION_TTL seconds."""
+    global _current, _current_read_at
+    if _current is None or time.monotonic() - _current_read_at > VERSION_TTL:
+        _current = CatalogVersion.get_solo()
+        _current_read_at = time.monotonic()
+    return _current
+
+
+def versions():
+    """(catalog version, stock version)"""
+    row = current()
+    return row.version, row.stock_version
+
+
+def users_version():
+    """Bumped with every TelegramUser change, the bot's resolved users read before it are stale."""
+    return current().users_version
+
+
+def _bump(field):
+    global _current
+    CatalogVersion.get_solo()
+    changes = {field: F(field) + 1}
+    if field in CHANGED_AT:
+        changes[CHANGED_AT[field]] = timezone.now()
+    CatalogVersion.objects.update(**changes)
+    _current = None
+
+
+def bump(field="version"):
+    """Invalidates the cached catalog (or only the stock with ``field="stock_version"``, the users with
+    ``field="users_version"``). Done after the commit, a process that sees the new version must also
+    see the new data."""
+    transaction.on_commit(lambda: _bump(field))
+
+
+def tier_of(user_id=None, cate=None):
+    """Price tier of a webapp page: the client's category, ``?cate=`` for pages opened without a client."""
+    if user_id and user_id != "None":
+        tier = TelegramUser.objects.filter(pk=user_id).values_list("category", flat=True).first()
+    else:
+        tier = cate
+    return tier if tier in TIERS else DEFAULT_TIER
+
+
+def set_prices(product, prices, currency=ProductPrice.Currencies.UZS):
+    """Saves {tier: amount} as the product's prices, one upsert for all of them."""
+    ProductPrice.objects.bulk_create(
+        [ProductPrice(product=product, tier=tier, currency=currency, amount=amount) for tier, amount in prices.items()],
+        update_conflicts=True,
+        unique_fields=["product", "tier", "currency"],
+        update_fields=["amount"],
+    )
+    product.__dict__.pop("_tier_prices", None)
+    bump()
+
+
+def stock():
+    """{product_id: (amount, reserved)}"""
+    key = f"catalog:stock:{versions()[1]}"
+    quantities = cache.get(key)
+    if quantities is None:
+        quantities = {pk: (amount, reserved) for pk, amount, reserved in
+                      Product.objects.values_list("pk", "amount", "reserved")}
+        cache.set(key, quantities, CACHE_TIMEOUT)
+    return quantities
+
+
+def products(tier, category_id=None):
+    """Products of the category (all of them without one) priced for the tier. The lists are cached
+    per catalog version, the stock is laid over them from its own cache since every order moves it."""
+    if tier not in TIERS:
+        tier = DEFAULT_TIER
+    key = f"catalog:products:{versions()[0]}:{tier}:{'all' if category_id is None else category_id}"
+    items = cache.get(key)
+    if items is None:
+        queryset = Product.objects.priced(tier).order_by("pk")
+        if category_id is not None:
+            queryset = queryset.filter(category_id=category_id)
+        items = list(queryset)
+        cache.set(key, items, CACHE_TIMEOUT)
+
+    quantities = stock()
+    for product in items:
+        product.amount, product.reserved = quantities.get(product.pk, (product.amount, product.reserved))
+    return items
+
+
+def product(tier, pk):
+    """Product priced for the tier, None when there is no such product. Cached on its own for the
+    detail page, with the stock it had at the current stock version."""
+    if tier not in TIERS:
+        tier = DEFAULT_TIER
+    version, stock_version = versions()
+    key = f"catalog:product:{version}:{stock_version}:{tier}:{pk}"
+    item = cache.get(key, MISSING)
+    if item is MISSING:
+        item = Product.objects.priced(tier).filter(pk=pk).first()
+        cache.set(key, item, CACHE_TIMEOUT)
+    return item
+
+
+def categories():
+    key = f"catalog:categories:{versions()[0]}"
+    items = cache.get(key)
+    if items is None:
+        items = list(Category.objects.all())
+        cache.set(key, items, CACHE_TIMEOUT)
+    return items
+
+
+def page(items, after=None, size=PAGE_SIZE, by_pk=True):
+    """Keyset page of a product list: the ``size`` products following the cursor ``after``, the
+    (pk, position) of the last product of the previous page. When that product is gone meanwhile,
+    lists in pk order go on with the greater pks and the others (search results, in rank order) at
+    its position. Returns the page and the cursor of the next one, None on the last page."""
+    start = 0
+    if after is not None:
+        pk, position = after
+        start = next((i + 1 for i, item in enumerate(items) if item.pk == pk), None)
+        if start is None and (by_pk or position is None):
+            start = next((i for i, item in enumerate(items) if item.pk > pk), len(items))
+        elif start is None:
+            # The products after it moved up by one
+            start = min(position, len(items))
+    chunk = items[start:start + size]
+    end = start + len(chunk)
+    return chunk, ((chunk[-1].pk, end - 1) if end < len(items) else None)
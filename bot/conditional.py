@@ -0,0 +1,84 @@
+import os
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+
+from django.template.loader import get_template
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from bot import catalog, metrics
+
+OUTCOMES = ("hit", "stale", "miss")
+
+_template_times = {}
+
+
+def request_tier(request):
+    """The price tier of a webapp request, looked up once per request."""
+    if not hasattr(request, "catalog_tier"):
+        request.catalog_tier = catalog.tier_of(request.GET.get("user_id"), request.GET.get("cate"))
+    return request.catalog_tier
+
+
+def template_time(template_name):
+    """Modification time of the template, a deploy that changes it must not be answered with 304."""
+    if template_name not in _template_times:
+        _template_times[template_name] = os.path.getmtime(get_template(template_name).origin.name)
+    return _template_times[template_name]
+
+
+def catalog_conditional(name, template_name=None, stock=False, tier=request_tier):
+    """Conditional GET for a page made from the catalog. The ETag changes with the catalog version
+    (and the stock version with ``stock``), the price tier (``tier(request)``) and the template,
+    Last-Modified is the time of the latest of those changes. Counts hits (304), stale revalidations
+    and misses per page for catalog_hit_rates()."""
+    def etag(request, *args, **kwargs):
+        version, stock_version = catalog.versions()
+        parts = [name, version, stock_version if stock else "", tier(request)]
+        if template_name:
+            parts.append(template_time(template_name))
+        return hashlib.md5(":".join(map(str, parts)).encode()).hexdigest()
+
+    def last_modified(request, *args, **kwargs):
+        row = catalog.current()
+        times = [row.changed_at]
+        if stock:
+            times.append(row.stock_changed_at)
+        if template_name:
+            times.append(datetime.fromtimestamp(template_time(template_name), tz=timezone.utc))
+        return max(times)
+
+    def decorator(view):
+        conditional_view = condition(etag_func=etag, last_modified_func=last_modified)(view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            if request.method in ("GET", "HEAD"):
+                # Prices differ per client, and the browser has to ask every time instead of guessing
+                patch_cache_control(response, private=True, no_cache=True)
+                if response.status_code == 304:
+                    outcome = "hit"
+                elif "HTTP_IF_NONE_MATCH" in request.META or "HTTP_IF_MODIFIED_SINCE" in request.META:
+                    outcome = "stale"
+                else:
+                    outcome = "miss"
+                metrics.incr(f"webapp.conditional.{name}.{outcome}")
+            return response
+        return wrapper
+    return decorator
+
+
+def catalog_hit_rates():
+    """{page: {"hit": n, "stale": n, "miss": n, "hit_rate": share of 304s}} of this process."""
+    pages = {}
+    for counter, value in metrics.snapshot()["counters"].items():
+        prefix, _, outcome = counter.rpartition(".")
+        if prefix.startswith("webapp.conditional.") and outcome in OUTCOMES:
+            page = pages.setdefault(prefix[len("webapp.conditional."):], dict.fromkeys(OUTCOMES, 0))
+            page[outcome] = value
+    for page in pages.values():
+        total = sum(page[outcome] for outcome in OUTCOMES)
+        page["hit_rate"] = round(page["hit"] / total, 3) if total else 0
+    return pages
@@ -0,0 +1,128 @@
+import time
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from telegram.request import HTTPXRequest
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+
+from bot import metrics
+
+# (connect, read) seconds for calls that don't pass their own timeout
+DEFAULT_TIMEOUT = (5, 60)
+DEFAULT_POOL_SIZE = 10
+# Connections kept alive per host, sized by how many threads talk to it at once
+HOST_POOL_SIZES = {
+    "https://api.telegram.org": 20,
+    "https://apisupply.smartpos.uz": 10,
+}
+# Bot API connections per bot, a bit more than the update lanes serving it
+TELEGRAM_POOL_SIZE = 16
+
+
+class TimedConnectionMixin:
+    """Reports how long opening a connection takes, TCP and TLS separately."""
+
+    def _new_conn(self):
+        started_at = time.monotonic()
+        sock = super()._new_conn()
+        self._connected_at = time.monotonic()
+        metrics.incr(f"http.connections.{self.host}")
+        metrics.observe(f"http.connect.{self.host}", self._connected_at - started_at)
+        return sock
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    def connect(self):
+        super().connect()
+        metrics.observe(f"http.tls.{self.host}", time.monotonic() - self._connected_at)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+
+class PooledSession(requests.Session):
+    """requests.Session that keeps connections alive per host and never waits forever."""
+
+    def __init__(self):
+        super().__init__()
+        self.mount("http://", PooledAdapter(pool_maxsize=DEFAULT_POOL_SIZE))
+        self.mount("https://", PooledAdapter(pool_maxsize=DEFAULT_POOL_SIZE))
+        for prefix, size in HOST_POOL_SIZES.items():
+            self.mount(prefix, PooledAdapter(pool_connections=1, pool_maxsize=size))
+        self.hooks["response"].append(self._count)
+
+    @staticmethod
+    def _count(response, *args, **kwargs):
+        metrics.incr(f"http.requests.{urlsplit(response.url).hostname}")
+        metrics.observe("http.request", response.elapsed.total_seconds())
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = DEFAULT_TIMEOUT
+        return super().request(method, url, **kwargs)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """The process wide session, shared by all threads so they reuse each other's connections."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = PooledSession()
+        return _session
+
+
+class TimedHTTPXRequest(HTTPXRequest):
+    """Bot API request of python-telegram-bot with a bigger pool and the same connect/TLS metrics."""
+
+    def __init__(self, connection_pool_size=TELEGRAM_POOL_SIZE, **kwargs):
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+
+    def _build_client(self):
+        client = super()._build_client()
+        client.event_hooks["request"].append(self._trace)
+        return client
+
+    @staticmethod
+    async def _trace(request):
+        host = request.url.host
+        started = {}
+
+        async def trace(event, info):
+            step, _, stage = event.rpartition(".")
+            if stage == "started":
+                started[step] = time.monotonic()
+            elif stage == "complete" and step in started:
+                seconds = time.monotonic() - started.pop(step)
+                if step == "connection.connect_tcp":
+                    metrics.incr(f"http.connections.{host}")
+                    metrics.observe(f"http.connect.{host}", seconds)
+                elif step == "connection.start_tls":
+                    metrics.observe(f"http.tls.{host}", seconds)
+
+        metrics.incr(f"http.requests.{host}")
+        request.extensions["trace"] = trace
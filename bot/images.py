@@ -0,0 +1,89 @@
+import os
+import logging
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Widths of the derivatives. The webapp is at most 600px wide, its cards take a bit less than 1/2
+# (products) and 1/4 (categories) of it, times the screen's pixel density
+WIDTHS = (120, 240, 360, 540)
+FORMATS = {
+    "webp": {"format": "WEBP", "quality": 75, "method": 6},
+    "jpg": {"format": "JPEG", "quality": 82, "optimize": True, "progressive": True},
+}
+CONTENT_TYPES = {"webp": "image/webp", "jpg": "image/jpeg"}
+
+
+def derivative_name(name, width, extension):
+    """products/milk.jpg -> products/derivatives/milk.jpg-320.webp, the original's extension stays so that
+    milk.jpg and milk.png don't share their copies."""
+    directory, filename = os.path.split(name)
+    return os.path.join(directory, "derivatives", f"{filename}-{width}.{extension}")
+
+
+def generate(name, storage=default_storage):
+    """Writes the derivatives of the image ``name``: every width of WIDTHS that isn't wider than the
+    original, in every format of FORMATS, turned upright and without EXIF. Returns the widths written."""
+    with storage.open(name, "rb") as file:
+        original = Image.open(file)
+        original.load()
+    image = ImageOps.exif_transpose(original)
+    widths = [width for width in WIDTHS if width < image.width] or [image.width]
+    for width in widths:
+        height = max(round(image.height * width / image.width), 1)
+        resized = image.resize((width, height), Image.LANCZOS) if width != image.width else image
+        for extension, options in FORMATS.items():
+            # An alpha channel only where there is transparency, and JPEG has none
+            transparent = "A" in resized.getbands() or "transparency" in resized.info
+            converted = resized.convert("RGBA" if transparent and options["format"] != "JPEG" else "RGB")
+            buffer = BytesIO()
+            converted.save(buffer, **options)
+            path = derivative_name(name, width, extension)
+            if storage.exists(path):
+                storage.delete(path)
+            storage.save(path, ContentFile(buffer.getvalue()))
+    return widths
+
+
+def pick(widths, pixels):
+    """The width a browser takes from the srcset for an image ``pixels`` wide."""
+    return min((width for width in widths if width >= pixels), default=max(widths))
+
+
+def sources(name, widths, storage=default_storage):
+    """{"webp": srcset, "jpg": srcset, "src": smallest JPEG} of the image's derivatives, None
+    without them."""
+    if not name or not widths:
+        return None
+    result = {
+        extension: ", ".join(f"{storage.url(derivative_name(name, width, extension))} {width}w" for width in widths)
+        for extension in FORMATS
+    }
+    result["src"] = storage.url(derivative_name(name, widths[0], "jpg"))
+    return result
+
+
+def refresh(instance, force=False, bump=True):
+    """Generates the derivatives of ``instance.cover`` when they are missing or belong to a replaced
+    file and stores their widths in ``cover_derivatives``. Returns whether anything was generated.
+    The cached catalog is invalidated unless ``bump`` is off, for callers that do it once at the end."""
+    name = instance.cover.name if instance.cover else ""
+    if not force and instance.cover_derivatives.get("name", "") == name:
+        return False
+    derivatives = {}
+    if name:
+        try:
+            derivatives = {"name": name, "widths": generate(name)}
+        except (OSError, Image.DecompressionBombError) as e:
+            logger.warning("No derivatives for %s %s: %s", type(instance).__name__, instance.pk, e)
+            derivatives = {"name": name, "widths": []}
+    instance.cover_derivatives = derivatives
+    type(instance).objects.filter(pk=instance.pk).update(cover_derivatives=derivatives)
+    if bump:
+        from bot import catalog
+        catalog.bump()
+    return True
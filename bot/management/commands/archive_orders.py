@@ -0,0 +1,21 @@
+import os
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from bot.archive import archive_orders
+
+
+class Command(BaseCommand):
+    help = 'Moves finished orders placed more than --days ago with their items into the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=int(os.environ.get('ARCHIVE_AFTER_DAYS', 30)),
+                            help='Archive orders placed this many days ago or earlier')
+        parser.add_argument('--batch', type=int, default=500, help='Orders moved per transaction')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        moved = archive_orders(before, options['batch'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {moved} orders'))
@@ -0,0 +1,40 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from bot import catalog, images
+from bot.models import Category, Product
+
+# A product card (45vw) on a phone 390px wide with a pixel density of 2
+CARD_PIXELS = 351
+
+
+class Command(BaseCommand):
+    help = 'Makes the smaller webapp copies of the product and category covers that are missing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Make them again, e.g. after images.WIDTHS changed')
+
+    def handle(self, *args, **options):
+        originals = derivatives = 0
+        made_total = 0
+        for model in (Category, Product):
+            made = 0
+            for instance in model.objects.exclude(cover="").iterator():
+                if images.refresh(instance, force=options['force'], bump=False):
+                    made += 1
+                widths = instance.cover_derivatives.get("widths")
+                if widths and default_storage.exists(instance.cover.name):
+                    # What a card downloads: the original before, the WebP copy its srcset picks now
+                    width = images.pick(widths, CARD_PIXELS)
+                    originals += default_storage.size(instance.cover.name)
+                    derivatives += default_storage.size(images.derivative_name(instance.cover.name, width, "webp"))
+            self.stdout.write(f'{model._meta.verbose_name_plural}: made copies for {made}')
+            made_total += made
+        if made_total:
+            # The cached pages and their ETags still point at the originals
+            catalog.bump()
+        if derivatives:
+            self.stdout.write(self.style.SUCCESS(
+                f'Cards download {derivatives / 1024:.0f} KB instead of {originals / 1024:.0f} KB '
+                f'({originals / derivatives:.1f}x less)'
+            ))
@@ -0,0 +1,33 @@
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bot.notifications import dispatch, get_bots
+
+
+class Command(BaseCommand):
+    help = 'Delivers queued order notifications to Telegram with retries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--batch', type=int, default=100, help='Notifications fetched per round')
+        parser.add_argument('--once', action='store_true', help='Deliver what is due and exit')
+
+    def handle(self, *args, **options):
+        bots = get_bots()
+        if not bots:
+            raise CommandError('TOKENS is not set')
+
+        asyncio.run(self.run(bots, options['interval'], options['batch'], options['once']))
+
+    async def run(self, bots, interval, batch, once):
+        await asyncio.gather(*[bot.initialize() for bot in bots.values()])
+        try:
+            while True:
+                delivered = await dispatch(bots, limit=batch)
+                if once:
+                    break
+                if delivered < batch:
+                    await asyncio.sleep(interval)
+        finally:
+            await asyncio.gather(*[bot.shutdown() for bot in bots.values()])
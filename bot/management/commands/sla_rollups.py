@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from bot import sla
+
+
+class Command(BaseCommand):
+    help = 'Drops hourly SLA rollups older than --keep-days, with --rebuild recomputes all rollups from the order events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-days', type=int, default=14, help='Days of hourly rollups to keep')
+        parser.add_argument('--rebuild', action='store_true', help='Recompute the rollups from scratch')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            rows = sla.rebuild()
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt {rows} rollups'))
+        deleted = sla.prune(timezone.now() - timedelta(days=options['keep_days']))
+        self.stdout.write(self.style.SUCCESS(f'Dropped {deleted} hourly rollups'))
@@ -0,0 +1,30 @@
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from bot.staticfiles import ENCODINGS
+
+
+class Command(BaseCommand):
+    help = 'Shows how many bytes the .br/.gz copies written by collectstatic save on every static file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='assets/', help='Only the files under this path, "" for all of them')
+
+    def handle(self, *args, **options):
+        if not hasattr(staticfiles_storage, 'savings'):
+            raise CommandError('STORAGES["staticfiles"] is not bot.staticfiles.CompressedManifestStaticFilesStorage')
+        total = 0
+        best_total = 0
+        for name, size, sizes in staticfiles_storage.savings():
+            if not name.startswith(options['prefix']):
+                continue
+            best = min(sizes.values(), default=size)
+            total += size
+            best_total += best
+            copies = ', '.join(f'{encoding} {sizes[encoding]}' for encoding in ENCODINGS if encoding in sizes) or 'none'
+            self.stdout.write(f'{name}: {size} bytes, {copies} ({1 - best / size:.0%} saved)' if size else f'{name}: empty')
+        if not total:
+            raise CommandError('No collected files, run collectstatic first')
+        self.stdout.write(self.style.SUCCESS(
+            f'{total / 1024:.1f} KB served as {best_total / 1024:.1f} KB ({1 - best_total / total:.0%} saved)'
+        ))
@@ -0,0 +1,52 @@
+import threading
+from collections import defaultdict, deque
+
+# Number of recent samples kept per timing for percentiles
+SAMPLE_SIZE = 1000
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+_timings = {}
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, seconds):
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = {"count": 0, "total": 0.0, "max": 0.0, "samples": deque(maxlen=SAMPLE_SIZE)}
+        timing["count"] += 1
+        timing["total"] += seconds
+        timing["max"] = max(timing["max"], seconds)
+        timing["samples"].append(seconds)
+
+
+def _percentile(samples, percent):
+    if not samples:
+        return 0
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+def snapshot():
+    with _lock:
+        timings = {}
+        for name, timing in _timings.items():
+            samples = sorted(timing["samples"])
+            timings[name] = {
+                "count": timing["count"],
+                "avg": timing["total"] / timing["count"],
+                "p50": _percentile(samples, 50),
+                "p95": _percentile(samples, 95),
+                "max": timing["max"],
+            }
+        return {"counters": dict(_counters), "gauges": dict(_gauges), "timings": timings}
@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2026-10-18 04:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0049_order_is_rop_cancel_order_is_rop_confirm_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BotState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bot_id', models.CharField(max_length=32, verbose_name='ID бота')),
+                ('kind', models.CharField(choices=[('user', 'Данные пользователя'), ('chat', 'Данные чата'), ('bot', 'Данные бота'), ('conversation', 'Состояние диалога')], max_length=16, verbose_name='Тип')),
+                ('name', models.CharField(blank=True, default='', max_length=64, verbose_name='Название диалога')),
+                ('key', models.CharField(max_length=255, verbose_name='Ключ')),
+                ('data', models.JSONField(blank=True, null=True, verbose_name='Данные')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+            ],
+            options={
+                'verbose_name': 'Состояние бота',
+                'verbose_name_plural': 'Состояния бота',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='botstate',
+            constraint=models.UniqueConstraint(fields=('bot_id', 'kind', 'name', 'key'), name='unique_bot_state'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2 on 2026-10-18 04:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0051_notification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='reserved',
+            field=models.FloatField(default=0, editable=False, verbose_name='Зарезервировано'),
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('reserve', 'Резерв'), ('release', 'Снятие резерва'), ('commit', 'Списание'), ('adjust', 'Корректировка')], max_length=16, verbose_name='Тип')),
+                ('amount_change', models.FloatField(default=0, verbose_name='Изменение количества')),
+                ('reserved_change', models.FloatField(default=0, verbose_name='Изменение резерва')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Время')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_movements', to='bot.order', verbose_name='Заказ')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='bot.product', verbose_name='Продукт')),
+            ],
+            options={
+                'verbose_name': 'Движение товара',
+                'verbose_name_plural': 'Движения товаров',
+            },
+        ),
+    ]
@@ -0,0 +1,94 @@
+# Generated by Django 4.2 on 2026-10-18 04:14
+
+from decimal import Decimal, InvalidOperation
+
+from django.db import migrations, models
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum, Count
+from django.db.models.functions import Coalesce
+
+
+# How many of the bad values the error lists
+SHOWN_ERRORS = 50
+
+
+def to_decimal(value):
+    """The value as a number with two decimals, 0 for an empty one, None when it isn't a number."""
+    text = "" if value is None else str(value).replace(" ", "").replace(",", ".")
+    if not text:
+        return Decimal("0.00")
+    try:
+        number = Decimal(text).quantize(Decimal("0.01"))
+    except InvalidOperation:
+        return None
+    return number if number.is_finite() else None
+
+
+def clean_item_numbers(apps, schema_editor):
+    # The columns were free text, make every value parse as a number before the type changes. A value
+    # that doesn't is not guessed at: the migration stops and lists them to be fixed by hand
+    OrderItem = apps.get_model("bot", "OrderItem")
+    fields = ["qty", "set_amount", "price_uzs"]
+    items = []
+    bad = []
+    for item in OrderItem.objects.only(*fields).iterator():
+        for field in fields:
+            number = to_decimal(getattr(item, field))
+            if number is None:
+                bad.append(f"item {item.pk} {field}={getattr(item, field)!r}")
+            else:
+                setattr(item, field, str(number))
+        items.append(item)
+    if bad:
+        raise ValueError(
+            f"{len(bad)} order item values are not numbers, fix them and migrate again: "
+            + ", ".join(bad[:SHOWN_ERRORS]) + (", ..." if len(bad) > SHOWN_ERRORS else "")
+        )
+    OrderItem.objects.bulk_update(items, fields, batch_size=500)
+
+
+def fill_order_totals(apps, schema_editor):
+    Order = apps.get_model("bot", "Order")
+    OrderItem = apps.get_model("bot", "OrderItem")
+    items = OrderItem.objects.filter(order=OuterRef("pk")).order_by().values("order")
+    line_total = ExpressionWrapper(F("qty") * F("price_uzs"), output_field=DecimalField(max_digits=16, decimal_places=2))
+    Order.objects.update(
+        total_uzs=Coalesce(Subquery(items.annotate(total=Sum(line_total)).values("total")), Decimal("0")),
+        item_count=Coalesce(Subquery(items.annotate(count=Count("pk")).values("count")), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0052_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(clean_item_numbers, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Количество позиций'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_uzs',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=16, verbose_name='Общая сумма (UZS)'),
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='price_uzs',
+            field=models.DecimalField(decimal_places=2, max_digits=14, verbose_name='Цена sum'),
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='qty',
+            field=models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Количество'),
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='set_amount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Блок'),
+        ),
+        migrations.RunPython(fill_order_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,99 @@
+# Generated by Django 4.2 on 2026-10-18 04:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0053_numeric_order_items'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveOrderItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_name', models.CharField(max_length=255, verbose_name='Название продукта')),
+                ('product_in_set', models.FloatField(default=0, verbose_name='Количество в Блок')),
+                ('product_id', models.IntegerField(default=0)),
+                ('qty', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Количество')),
+                ('set_amount', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Блок')),
+                ('price_uzs', models.DecimalField(decimal_places=2, max_digits=14, verbose_name='Цена sum')),
+                ('price_usd', models.CharField(blank=True, editable=False, max_length=255, null=True, verbose_name='Цена USD')),
+            ],
+            options={
+                'verbose_name': 'Заказанные продукты (архив)',
+                'verbose_name_plural': 'Заказанные продукты (архив)',
+            },
+        ),
+        migrations.DeleteModel(
+            name='ArchiveOrder',
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='agent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='%(class)ss', to='bot.telegramuser', verbose_name='Agent'),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='%(class)s_set', to='bot.telegramuser', verbose_name='Клиент'),
+        ),
+        migrations.AlterField(
+            model_name='stockmovement',
+            name='order',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='stock_movements', to='bot.order', verbose_name='Заказ'),
+        ),
+        migrations.CreateModel(
+            name='ArchiveOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payment_status', models.CharField(choices=[('paid', 'Оплаченный'), ('unpaid', 'Неоплачиваемый')], default='unpaid', max_length=16, verbose_name='Статус платежа')),
+                ('payment_type', models.CharField(blank=True, choices=[('cash', 'Наличные'), ('payme', 'Payme'), ('click', 'Click'), ('terminal', 'Терминал'), ('transfer', 'Перечисления'), ('other', 'Другой')], max_length=16, null=True, verbose_name='Тип платежа')),
+                ('status', models.CharField(choices=[('pending', 'Новый'), ('approved_by_rop', 'Согласовано руководителем отдела продаж'), ('approved_by_account', 'Аттестовано бухгалтером'), ('approved_by_director', 'Утверждено директором'), ('approved_by_storekeeper', 'Подтверждено кладовщиком'), ('canceled_by_rop', 'Отказано руководителем отдела продаж'), ('canceled_by_account', 'Отказано бухгалтером'), ('canceled_by_director', 'Отказано директором'), ('canceled_by_storekeeper', 'Отказано кладовщиком'), ('cancelled', 'Отменено')], default='pending', max_length=24, verbose_name='Статус заказа')),
+                ('location_path', models.URLField(blank=True, null=True, verbose_name='Место доставки')),
+                ('comment', models.TextField(blank=True, null=True, verbose_name='Комментарий')),
+                ('rop_approve_time', models.DateTimeField(blank=True, null=True, verbose_name='Время утверждения руководителем отдела продаж')),
+                ('accountant_approve_time', models.DateTimeField(blank=True, null=True, verbose_name='Время утверждения бухгалтером')),
+                ('director_approve_time', models.DateTimeField(blank=True, null=True, verbose_name='Время утверждения директором')),
+                ('storekeeper_approve_time', models.DateTimeField(blank=True, null=True, verbose_name='Время одобрения кладовщика')),
+                ('is_rop_confirm', models.BooleanField(default=False, verbose_name='Руководитель отдела продаж подтвердил?')),
+                ('is_accountant_confirm', models.BooleanField(default=False, verbose_name='Бухгалтер подтвердил?')),
+                ('is_director_confirm', models.BooleanField(default=False, verbose_name='Директор подтвердил?')),
+                ('is_storekeeper_confirm', models.BooleanField(default=False, verbose_name='Кладовщик подтвердил?')),
+                ('rop_cancel_time', models.DateTimeField(blank=True, null=True, verbose_name='Время отказа руководителя отдела продаж')),
+                ('accountant_cancel_time', models.DateTimeField(blank=True, null=True, verbose_name='Время отказа бухгалтером')),
+                ('director_cancel_time', models.DateTimeField(blank=True, null=True, verbose_name='Время отказа директором')),
+                ('storekeeper_cancel_time', models.DateTimeField(blank=True, null=True, verbose_name='Время отказа кладовщиком')),
+                ('is_rop_cancel', models.BooleanField(default=False, verbose_name='Руководитель отдела продаж отменил?')),
+                ('is_accountant_cancel', models.BooleanField(default=False, verbose_name='Бухгалтер отменил?')),
+                ('is_director_cancel', models.BooleanField(default=False, verbose_name='Директор отменил?')),
+                ('is_storekeeper_cancel', models.BooleanField(default=False, verbose_name='Кладовщик отменил?')),
+                ('total_uzs', models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=16, verbose_name='Общая сумма (UZS)')),
+                ('item_count', models.PositiveIntegerField(default=0, editable=False, verbose_name='Количество позиций')),
+                ('created_at', models.DateTimeField(verbose_name='Время размещения заказа')),
+                ('archived_at', models.DateTimeField(auto_now_add=True, verbose_name='Время архивации')),
+                ('agent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='%(class)ss', to='bot.telegramuser', verbose_name='Agent')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='%(class)s_set', to='bot.telegramuser', verbose_name='Клиент')),
+            ],
+            options={
+                'verbose_name': 'Архив',
+                'verbose_name_plural': 'Архивы',
+            },
+        ),
+        migrations.AddField(
+            model_name='archiveorderitem',
+            name='order',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='bot.archiveorder', verbose_name='Заказ'),
+        ),
+        migrations.AddIndex(
+            model_name='archiveorder',
+            index=models.Index(fields=['created_at'], name='archive_order_created_at'),
+        ),
+        migrations.AddIndex(
+            model_name='archiveorder',
+            index=models.Index(fields=['status', 'created_at'], name='archive_order_status'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2 on 2026-10-18 04:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0054_archive_tables'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'created_at'], name='order_status_created_at'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created_at'], name='order_created_at'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['agent', 'created_at'], name='order_agent_created_at'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(fields=['product_id'], name='orderitem_product_id'),
+        ),
+        migrations.AddIndex(
+            model_name='telegramuser',
+            index=models.Index(condition=models.Q(('is_agent', True)), fields=['first_name'], name='telegramuser_agents'),
+        ),
+        migrations.AddIndex(
+            model_name='telegramuser',
+            index=models.Index(fields=['tin'], name='telegramuser_tin'),
+        ),
+    ]
@@ -0,0 +1,182 @@
+# Generated by Django 4.2 on 2026-10-18 04:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+ROLES = ("rop", "accountant", "director", "storekeeper")
+
+
+def events_from_columns(apps, schema_editor):
+    # Every flag that is set becomes an event, at its time or, for rows that never got one, the order's
+    OrderEvent = apps.get_model("bot", "OrderEvent")
+    events = []
+    for model_name in ("Order", "ArchiveOrder"):
+        model = apps.get_model("bot", model_name)
+        for order in model.objects.iterator():
+            for role in ROLES:
+                for action, flag, time in (("approve", "confirm", "approve"), ("cancel", "cancel", "cancel")):
+                    at = getattr(order, f"{role}_{time}_time")
+                    if getattr(order, f"is_{role}_{flag}") or at:
+                        events.append(OrderEvent(order_id=order.pk, role=role, action=action,
+                                                 at=at or order.created_at))
+    OrderEvent.objects.bulk_create(events, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0055_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(blank=True, choices=[('rop', 'Руководитель отдел продаж'), ('director', 'Директор'), ('accountant', 'Бухгалтер'), ('storekeeper', 'Заведующий складом')], max_length=20, verbose_name='Роль')),
+                ('action', models.CharField(choices=[('approve', 'Подтверждено'), ('cancel', 'Отменено')], max_length=16, verbose_name='Действие')),
+                ('at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Время')),
+                ('actor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+                ('order', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='bot.order', verbose_name='Заказ')),
+            ],
+            options={
+                'verbose_name': 'Событие заказа',
+                'verbose_name_plural': 'События заказов',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='orderevent',
+            index=models.Index(fields=['order', 'at'], name='orderevent_order_at'),
+        ),
+        migrations.RunPython(events_from_columns, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='accountant_approve_time',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='accountant_cancel_time',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='director_approve_time',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='director_cancel_time',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='is_accountant_cancel',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='is_accountant_confirm',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='is_director_cancel',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='is_director_confirm',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='is_rop_cancel',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='is_rop_confirm',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='is_storekeeper_cancel',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='is_storekeeper_confirm',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='rop_approve_time',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='rop_cancel_time',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='storekeeper_approve_time',
+        ),
+        migrations.RemoveField(
+            model_name='archiveorder',
+            name='storekeeper_cancel_time',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='accountant_approve_time',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='accountant_cancel_time',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='director_approve_time',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='director_cancel_time',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='is_accountant_cancel',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='is_accountant_confirm',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='is_director_cancel',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='is_director_confirm',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='is_rop_cancel',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='is_rop_confirm',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='is_storekeeper_cancel',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='is_storekeeper_confirm',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='rop_approve_time',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='rop_cancel_time',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='storekeeper_approve_time',
+        ),
+        migrations.RemoveField(
+            model_name='order',
+            name='storekeeper_cancel_time',
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2 on 2026-10-18 04:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0056_order_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlaRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Час'), ('day', 'День')], max_length=8, verbose_name='Период')),
+                ('start', models.DateTimeField(verbose_name='Начало периода')),
+                ('role', models.CharField(choices=[('rop', 'Руководитель отдел продаж'), ('director', 'Директор'), ('accountant', 'Бухгалтер'), ('storekeeper', 'Заведующий складом')], max_length=20, verbose_name='Роль')),
+                ('bucket', models.PositiveSmallIntegerField(verbose_name='Интервал')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Заказов')),
+                ('total_seconds', models.FloatField(default=0, verbose_name='Сумма ожидания (сек)')),
+                ('territory', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='bot.area', verbose_name='Территория')),
+            ],
+            options={
+                'verbose_name': 'SLA подтверждений',
+                'verbose_name_plural': 'SLA подтверждений',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='slarollup',
+            index=models.Index(fields=['period', 'start', 'role'], name='slarollup_period_start'),
+        ),
+    ]
@@ -0,0 +1,113 @@
+# Generated by Django 4.2 on 2026-10-18 04:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+TIERS = ("a", "b", "c", "d", "e")
+CURRENCIES = ("uzs", "usd")
+
+
+def prices_from_columns(apps, schema_editor):
+    Product = apps.get_model("bot", "Product")
+    ProductPrice = apps.get_model("bot", "ProductPrice")
+    prices = []
+    for product in Product.objects.iterator():
+        for tier in TIERS:
+            for currency in CURRENCIES:
+                amount = getattr(product, f"price_{currency}_{tier}")
+                # The dollar prices were never editable, only the ones somebody set are worth a row
+                if currency == "uzs" or amount:
+                    prices.append(ProductPrice(product_id=product.pk, tier=tier, currency=currency, amount=amount))
+    ProductPrice.objects.bulk_create(prices, batch_size=500)
+
+
+def prices_to_columns(apps, schema_editor):
+    Product = apps.get_model("bot", "Product")
+    ProductPrice = apps.get_model("bot", "ProductPrice")
+    products = {}
+    for price in ProductPrice.objects.filter(tier__in=TIERS, currency__in=CURRENCIES).iterator():
+        products.setdefault(price.product_id, {})[f"price_{price.currency}_{price.tier}"] = price.amount
+    for product_id, prices in products.items():
+        Product.objects.filter(pk=product_id).update(**prices)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0058_catalog_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tier', models.CharField(max_length=16, verbose_name='Категория клиента')),
+                ('currency', models.CharField(choices=[('uzs', 'Сум'), ('usd', 'Долл. США')], default='uzs', max_length=3, verbose_name='Валюта')),
+                ('amount', models.FloatField(default=0, verbose_name='Цена')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='prices', to='bot.product', verbose_name='Продукт')),
+            ],
+            options={
+                'verbose_name': 'Цена продукта',
+                'verbose_name_plural': 'Цены продуктов',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='productprice',
+            index=models.Index(fields=['product', 'tier', 'currency', 'amount'], name='productprice_covering'),
+        ),
+        migrations.AddConstraint(
+            model_name='productprice',
+            constraint=models.UniqueConstraint(fields=('product', 'tier', 'currency'), name='productprice_unique'),
+        ),
+        migrations.RunPython(prices_from_columns, prices_to_columns),
+        migrations.RemoveField(
+            model_name='product',
+            name='price_usd',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='price_usd_a',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='price_usd_b',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='price_usd_c',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='price_usd_d',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='price_usd_e',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='price_uzs',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='price_uzs_a',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='price_uzs_b',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='price_uzs_c',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='price_uzs_d',
+        ),
+        migrations.RemoveField(
+            model_name='product',
+            name='price_uzs_e',
+        ),
+    ]
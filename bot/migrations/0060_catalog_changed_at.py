@@ -0,0 +1,24 @@
+# Generated by Django 4.2 on 2026-10-18 04:38
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0059_product_prices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='catalogversion',
+            name='changed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Каталог изменён'),
+        ),
+        migrations.AddField(
+            model_name='catalogversion',
+            name='stock_changed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Остатки изменены'),
+        ),
+    ]
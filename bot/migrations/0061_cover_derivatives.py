@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 04:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0060_catalog_changed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='cover_derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Уменьшенные копии'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='cover_derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Уменьшенные копии'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2 on 2026-10-18 05:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0061_cover_derivatives'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='notification',
+            name='bot_id',
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='claimed_by',
+            field=models.CharField(blank=True, default='', editable=False, max_length=32, verbose_name='Отправитель'),
+        ),
+        migrations.AlterField(
+            model_name='notification',
+            name='status',
+            field=models.CharField(choices=[('pending', 'В очереди'), ('sending', 'Отправляется'), ('sent', 'Отправлено'), ('failed', 'Ошибка')], default='pending', max_length=16, verbose_name='Статус'),
+        ),
+    ]
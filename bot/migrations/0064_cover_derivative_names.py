@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+def forget_derivatives(apps, schema_editor):
+    # The copies are named after the original's full file name now, the cover_derivatives command
+    # makes them again. Until then the pages show the originals
+    for model_name in ("Category", "Product"):
+        apps.get_model("bot", model_name).objects.exclude(cover_derivatives={}).update(cover_derivatives={})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0063_order_created_at_placed'),
+    ]
+
+    operations = [
+        migrations.RunPython(forget_derivatives, migrations.RunPython.noop),
+    ]
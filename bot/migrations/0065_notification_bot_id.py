@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 05:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0064_cover_derivative_names'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='bot_id',
+            field=models.CharField(blank=True, default='', max_length=32, verbose_name='ID бота'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 05:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0065_notification_bot_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='catalogversion',
+            name='users_version',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='Версия клиентов'),
+        ),
+    ]
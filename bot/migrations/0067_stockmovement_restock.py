@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 05:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0066_catalogversion_users_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stockmovement',
+            name='kind',
+            field=models.CharField(choices=[('reserve', 'Резерв'), ('release', 'Снятие резерва'), ('commit', 'Списание'), ('restock', 'Возврат на склад'), ('adjust', 'Корректировка')], max_length=16, verbose_name='Тип'),
+        ),
+    ]
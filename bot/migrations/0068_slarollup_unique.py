@@ -0,0 +1,36 @@
+# Generated by Django 4.2 on 2026-10-18 05:30
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicates(apps, schema_editor):
+    # Rows created twice by concurrent transitions are added up into the first of them
+    SlaRollup = apps.get_model("bot", "SlaRollup")
+    key = ("period", "start", "role", "territory", "bucket")
+    duplicates = SlaRollup.objects.values(*key).annotate(
+        rows=Count("pk"), first=Min("pk"), total_count=Sum("count"), total=Sum("total_seconds"),
+    ).filter(rows__gt=1)
+    for row in duplicates:
+        rows = SlaRollup.objects.filter(**{field: row[field] for field in key})
+        rows.exclude(pk=row["first"]).delete()
+        rows.update(count=row["total_count"], total_seconds=row["total"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0067_stockmovement_restock'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='slarollup',
+            constraint=models.UniqueConstraint(condition=models.Q(('territory__isnull', False)), fields=('period', 'start', 'role', 'territory', 'bucket'), name='unique_slarollup_territory'),
+        ),
+        migrations.AddConstraint(
+            model_name='slarollup',
+            constraint=models.UniqueConstraint(condition=models.Q(('territory__isnull', True)), fields=('period', 'start', 'role', 'bucket'), name='unique_slarollup_all'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2 on 2026-10-18 05:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0068_slarollup_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedUpdate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bot_id', models.CharField(max_length=32, verbose_name='ID бота')),
+                ('update_id', models.BigIntegerField(verbose_name='ID обновления')),
+                ('received_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Получено')),
+            ],
+            options={
+                'verbose_name': 'Полученное обновление',
+                'verbose_name_plural': 'Полученные обновления',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='processedupdate',
+            constraint=models.UniqueConstraint(fields=('bot_id', 'update_id'), name='unique_processed_update'),
+        ),
+    ]
@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, FilteredRelation, Q, Value
+from django.db.models.functions import Coalesce
 from solo.models import SingletonModel
 from django.contrib.auth.models import AbstractUser, Group
 from django.core.management import call_command
@@ -6,7 +8,10 @@ from django.core.exceptions import ValidationError
 from django.contrib.auth.hashers import make_password
 from uuid import uuid4
 from datetime import datetime
+from decimal import Decimal
+from django.utils import timezone
 
+from bot import images
 from bot.utils import send_telegram_message
 
 
@@ -119,6 +124,11 @@ class TelegramUser(models.Model):
     class Meta:
         verbose_name = "Клиент"
         verbose_name_plural = "Клиенты"
+        indexes = [
+            # Agents are a handful among thousands of clients
+            models.Index(fields=["first_name"], condition=models.Q(is_agent=True), name="telegramuser_agents"),
+            models.Index(fields=["tin"], name="telegramuser_tin"),
+        ]
 
 
 class Contact(SingletonModel):
@@ -129,7 +139,23 @@ class Contact(SingletonModel):
         verbose_name_plural = "Связаться с нами"
 
 
-class Category(models.Model):
+class CoverMixin(models.Model):
+    """Smaller copies of the cover for the webapp, made by bot.images when the cover is saved."""
+    # {"name": the cover they were made from, "widths": [...]}
+    cover_derivatives = models.JSONField("Уменьшенные копии", default=dict, blank=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+    @property
+    def cover_sources(self):
+        """{"webp": srcset, "jpg": srcset, "src": url} for <picture>, None until the copies are made."""
+        if not self.cover or self.cover_derivatives.get("name") != self.cover.name:
+            return None
+        return images.sources(self.cover.name, self.cover_derivatives.get("widths"))
+
+
+class Category(CoverMixin):
     cover = models.ImageField("Изображение категории", upload_to="categories")
     title = models.CharField("Название категории", max_length=255)
 
@@ -141,7 +167,17 @@ class Category(models.Model):
         return self.title
 
 
-class Product(models.Model):
+class ProductQuerySet(models.QuerySet):
+    def priced(self, tier, currency="uzs"):
+        """Annotates price_<currency> with the product's price for the client tier (0 without one),
+        a single LEFT JOIN on ProductPrice's covering index."""
+        price = FilteredRelation("prices", condition=Q(prices__tier=tier, prices__currency=currency))
+        return self.alias(**{f"{currency}_price": price}).annotate(
+            **{f"price_{currency}": Coalesce(F(f"{currency}_price__amount"), Value(0.0))}
+        )
+
+
+class Product(CoverMixin):
     cover = models.ImageField("Изображение продукта", upload_to="products")
     title = models.CharField("Название продукта", max_length=255)
     category = models.ForeignKey(
@@ -154,28 +190,14 @@ class Product(models.Model):
     )
     description = models.TextField("Комментарий")
     is_active = models.BooleanField("Активен", default=True)
-    price_uzs = models.FloatField("Цена (сум)", default=0, editable=False)
-    price_usd = models.FloatField("Цена (долл. США)", default=0, editable=False)
-
-    price_uzs_a = models.FloatField("Стандарт Цена (сум)", default=0)
-    price_usd_a = models.FloatField("Стандарт Цена (долл. США)", default=0, editable=False)
-
-    price_uzs_b = models.FloatField("-4% Цена (сум)", default=0)
-    price_usd_b = models.FloatField("-4% Цена (долл. США)", default=0, editable=False)
-
-    price_uzs_c = models.FloatField("Хорека Цена (сум)", default=0)
-    price_usd_c = models.FloatField("Хорека Цена (долл. США)", default=0, editable=False)
-
-    price_uzs_d = models.FloatField("Оптовик Цена (сум)", default=0)
-    price_usd_d = models.FloatField("Оптовик Цена (долл. США)", default=0, editable=False)
-
-    price_uzs_e = models.FloatField("-2% Цена (сум)", default=0)
-    price_usd_e = models.FloatField("-2% Цена (долл. США)", default=0, editable=False)
-
     amount = models.FloatField("Количество", default=0)
+    # Part of amount promised to orders that the storekeeper has not approved yet, kept by bot.stock
+    reserved = models.FloatField("Зарезервировано", default=0, editable=False)
     set_amount = models.FloatField("Количество в блоке", default=0)
     is_top = models.BooleanField("Популярный продукт", default=False)
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Продукт"
         verbose_name_plural = "Продукты"
@@ -183,8 +205,89 @@ class Product(models.Model):
     def __str__(self) -> str:
         return self.title
 
+    @property
+    def available(self):
+        return self.amount - self.reserved
+
+    @property
+    def tier_prices(self):
+        """{(tier, currency): amount}, from prefetched prices when there are some."""
+        if not hasattr(self, "_tier_prices"):
+            self._tier_prices = {(price.tier, price.currency): price.amount for price in self.prices.all()}
+        return self._tier_prices
+
+
+def tier_price(tier, currency, description):
+    def get(product):
+        return product.tier_prices.get((tier, currency), 0)
+    get.short_description = description
+    return property(get)
+
+
+# product.price_uzs_a etc. for the admin's columns and forms
+for _tier, _label in TelegramUser.UserCategory.choices:
+    setattr(Product, f"price_uzs_{_tier}", tier_price(_tier, "uzs", f"{_label} Цена (сум)"))
+
+
+class ProductPrice(models.Model):
+    """Price of a product for one client tier (TelegramUser.UserCategory) in one currency. The tier
+    has no choices here, so a new client category needs no migration."""
+
+    class Currencies(models.TextChoices):
+        UZS = "uzs", "Сум"
+        USD = "usd", "Долл. США"
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="prices", verbose_name="Продукт")
+    tier = models.CharField("Категория клиента", max_length=16)
+    currency = models.CharField("Валюта", max_length=3, choices=Currencies.choices, default=Currencies.UZS)
+    amount = models.FloatField("Цена", default=0)
+
+    class Meta:
+        verbose_name = "Цена продукта"
+        verbose_name_plural = "Цены продуктов"
+        constraints = [
+            models.UniqueConstraint(fields=["product", "tier", "currency"], name="productprice_unique"),
+        ]
+        indexes = [
+            # Covers Product.objects.priced(), the join never reads the table itself
+            models.Index(fields=["product", "tier", "currency", "amount"], name="productprice_covering"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.product_id} {self.tier} {self.amount} {self.currency}"
+
+
+class CatalogVersion(SingletonModel):
+    """Counters the webapp's catalog cache and the bot's user cache are keyed by, see bot.catalog."""
+    version = models.PositiveBigIntegerField("Версия каталога", default=0)
+    stock_version = models.PositiveBigIntegerField("Версия остатков", default=0)
+    users_version = models.PositiveBigIntegerField("Версия клиентов", default=0)
+    changed_at = models.DateTimeField("Каталог изменён", default=timezone.now)
+    stock_changed_at = models.DateTimeField("Остатки изменены", default=timezone.now)
+
+    class Meta:
+        verbose_name = "Версия каталога"
+        verbose_name_plural = "Версия каталога"
+
+
+def stage_flag(role, action, description):
+    def get(order):
+        return (role, action) in order.stages
+    get.short_description = description
+    get.boolean = True
+    return property(get)
+
+
+def stage_time(role, action, description):
+    def get(order):
+        return order.stages.get((role, action))
+    get.short_description = description
+    return property(get)
+
+
+class BaseOrder(models.Model):
+    """Fields shared by live orders and the archive."""
 
-class Order(models.Model):
     class PaymentTypes(models.TextChoices):
         CASH = "cash", "Наличные"
         PAYME = "payme", "Payme"
@@ -223,34 +326,63 @@ class Order(models.Model):
         APPROVED_BY_DIRECTOR = "approved_by_director", "Утверждено директором"
         APPROVED_BY_STOREKEEPER = "approved_by_storekeeper", "Подтверждено кладовщиком"
 
-    user = models.ForeignKey(verbose_name="Клиент", to=TelegramUser, on_delete=models.SET_NULL, null=True, blank=True)
+    # name -> (statuses it starts from, status it ends in). Every transition is recorded as an
+    # OrderEvent, "<role>_approve" and "<role>_cancel" with the role.
+    TRANSITIONS = {
+        "rop_approve": ((OrderStatus.PENDING,), OrderStatus.APPROVED_BY_ROP),
+        "accountant_approve": ((OrderStatus.APPROVED_BY_ROP,), OrderStatus.APPROVED_BY_ACCOUNTANT),
+        "director_approve": ((OrderStatus.APPROVED_BY_ACCOUNTANT,), OrderStatus.APPROVED_BY_DIRECTOR),
+        "storekeeper_approve": ((OrderStatus.APPROVED_BY_DIRECTOR,), OrderStatus.APPROVED_BY_STOREKEEPER),
+        "rop_cancel": ((OrderStatus.PENDING, OrderStatus.APPROVED_BY_ROP), OrderStatus.CANCELED_BY_ROP),
+        "accountant_cancel": (
+            (OrderStatus.APPROVED_BY_ROP, OrderStatus.APPROVED_BY_ACCOUNTANT), OrderStatus.CANCELED_BY_ACCOUNTANT),
+        "director_cancel": (
+            (OrderStatus.APPROVED_BY_ACCOUNTANT, OrderStatus.APPROVED_BY_DIRECTOR), OrderStatus.CANCELED_BY_DIRECTOR),
+        "storekeeper_cancel": (
+            (OrderStatus.APPROVED_BY_DIRECTOR, OrderStatus.APPROVED_BY_STOREKEEPER), OrderStatus.CANCELED_BY_STOREKEEPER),
+        "cancel": (
+            (OrderStatus.PENDING, OrderStatus.APPROVED_BY_ROP, OrderStatus.APPROVED_BY_ACCOUNTANT,
+             OrderStatus.APPROVED_BY_DIRECTOR, OrderStatus.APPROVED_BY_STOREKEEPER),
+            OrderStatus.CANCELLED,
+        ),
+    }
+    APPROVERS = ("rop", "accountant", "director", "storekeeper")
+    TOTAL_FIELDS = {"total_uzs", "item_count"}
+    TRANSITION_FIELDS = {"status"}
+    # The approval checkboxes of the admin form
+    STAGE_FLAGS = tuple(f"is_{role}_{flag}" for role in APPROVERS for flag in ("confirm", "cancel"))
+
+    user = models.ForeignKey(verbose_name="Клиент", to=TelegramUser, on_delete=models.SET_NULL, null=True, blank=True,
+                             related_name="%(class)s_set")
     agent = models.ForeignKey(verbose_name="Agent", to=TelegramUser, on_delete=models.SET_NULL, null=True, blank=True,
-                              related_name="orders")
+                              related_name="%(class)ss")
     payment_status = models.CharField("Статус платежа", choices=PaymentStatus.choices, default=PaymentStatus.UNPAID,
                                       max_length=16)
     payment_type = models.CharField("Тип платежа", choices=PaymentTypes.choices, null=True, blank=True, max_length=16)
     status = models.CharField("Статус заказа", max_length=24, choices=OrderStatus.choices, default=OrderStatus.PENDING)
-    created_at = models.DateTimeField("Время размещения заказа", auto_now=True)
+    created_at = models.DateTimeField("Время размещения заказа", auto_now_add=True)
     location_path = models.URLField("Место доставки", null=True, blank=True)
     comment = models.TextField("Комментарий", null=True, blank=True)
-    # fields for approve
-    rop_approve_time = models.DateTimeField("Время утверждения руководителем отдела продаж", null=True, blank=True)
-    accountant_approve_time = models.DateTimeField("Время утверждения бухгалтером", null=True, blank=True)
-    director_approve_time = models.DateTimeField("Время утверждения директором", null=True, blank=True)
-    storekeeper_approve_time = models.DateTimeField("Время одобрения кладовщика", null=True, blank=True)
-    is_rop_confirm = models.BooleanField("Руководитель отдела продаж подтвердил?", default=False)
-    is_accountant_confirm = models.BooleanField("Бухгалтер подтвердил?", default=False)
-    is_director_confirm = models.BooleanField("Директор подтвердил?", default=False)
-    is_storekeeper_confirm = models.BooleanField("Кладовщик подтвердил?", default=False)
-    # fields for cancel
-    rop_cancel_time = models.DateTimeField("Время отказа руководителя отдела продаж", null=True, blank=True)
-    accountant_cancel_time = models.DateTimeField("Время отказа бухгалтером", null=True, blank=True)
-    director_cancel_time = models.DateTimeField("Время отказа директором", null=True, blank=True)
-    storekeeper_cancel_time = models.DateTimeField("Время отказа кладовщиком", null=True, blank=True)
-    is_rop_cancel = models.BooleanField("Руководитель отдела продаж отменил?", default=False)
-    is_accountant_cancel = models.BooleanField("Бухгалтер отменил?", default=False)
-    is_director_cancel = models.BooleanField("Директор отменил?", default=False)
-    is_storekeeper_cancel = models.BooleanField("Кладовщик отменил?", default=False)
+    # Approvals and cancellations of the roles, read from the order's OrderEvent rows
+    is_rop_confirm = stage_flag("rop", "approve", "Руководитель отдела продаж подтвердил?")
+    is_accountant_confirm = stage_flag("accountant", "approve", "Бухгалтер подтвердил?")
+    is_director_confirm = stage_flag("director", "approve", "Директор подтвердил?")
+    is_storekeeper_confirm = stage_flag("storekeeper", "approve", "Кладовщик подтвердил?")
+    is_rop_cancel = stage_flag("rop", "cancel", "Руководитель отдела продаж отменил?")
+    is_accountant_cancel = stage_flag("accountant", "cancel", "Бухгалтер отменил?")
+    is_director_cancel = stage_flag("director", "cancel", "Директор отменил?")
+    is_storekeeper_cancel = stage_flag("storekeeper", "cancel", "Кладовщик отменил?")
+    rop_approve_time = stage_time("rop", "approve", "Время утверждения руководителем отдела продаж")
+    accountant_approve_time = stage_time("accountant", "approve", "Время утверждения бухгалтером")
+    director_approve_time = stage_time("director", "approve", "Время утверждения директором")
+    storekeeper_approve_time = stage_time("storekeeper", "approve", "Время одобрения кладовщика")
+    rop_cancel_time = stage_time("rop", "cancel", "Время отказа руководителя отдела продаж")
+    accountant_cancel_time = stage_time("accountant", "cancel", "Время отказа бухгалтером")
+    director_cancel_time = stage_time("director", "cancel", "Время отказа директором")
+    storekeeper_cancel_time = stage_time("storekeeper", "cancel", "Время отказа кладовщиком")
+    # Kept up to date by OrderItem writes, see Order.add_to_totals
+    total_uzs = models.DecimalField("Общая сумма (UZS)", max_digits=16, decimal_places=2, default=0, editable=False)
+    item_count = models.PositiveIntegerField("Количество позиций", default=0, editable=False)
 
     def clean(self) -> None:
         from django.core.exceptions import ValidationError
@@ -258,103 +390,210 @@ class Order(models.Model):
             raise ValidationError(
                 {"payment_type": "При изменении статуса платежа на «Оплачен» необходимо указать тип платежа."})
 
-        if self.is_rop_confirm and self.is_rop_cancel:
-            raise ValidationError(
-                {"is_rop_confirm": "Нельзя одновременно подтвердить и отменить заказ руководителем отдела продаж."})
-        
-        if self.is_accountant_confirm and self.is_accountant_cancel:
-            raise ValidationError(
-                {"is_accountant_confirm": "Нельзя одновременно подтвердить и отменить заказ бухгалтером."})
-        
-        if self.is_director_confirm and self.is_director_cancel:
-            raise ValidationError(
-                {"is_director_confirm": "Нельзя одновременно подтвердить и отменить заказ директором."})
+        return super().clean()
 
-        if self.is_storekeeper_confirm and self.is_storekeeper_cancel:
-            raise ValidationError(
-                {"is_storekeeper_confirm": "Нельзя одновременно подтвердить и отменить заказ кладовщиком."})
+    @property
+    def events(self):
+        """The order's OrderEvent rows oldest first, loaded once per instance unless
+        OrderEvent.attach() already did it for a whole page of orders."""
+        if getattr(self, "_events", None) is None:
+            self._events = list(OrderEvent.objects.filter(order_id=self.pk).order_by("at", "pk"))
+        return self._events
+
+    @property
+    def stages(self):
+        """{(role, action): time} of the order's events, the current state of every approval stage."""
+        if getattr(self, "_stages", None) is None:
+            self._stages = {(event.role, event.action): event.at for event in self.events}
+        return self._stages
+
+    class Meta:
+        abstract = True
 
-        return super().clean()
 
+class Order(BaseOrder):
     def save(self, *args, **kwargs):
-        from bot.signals import make_order_message, cancel_order_message, send_notification
         self.clean()
-        if self.pk:
-            message = None
-            # approve
-            if self.is_rop_confirm and not self.rop_approve_time:
-                self.rop_approve_time = datetime.now()
-                self.status = Order.OrderStatus.APPROVED_BY_ROP
-                message = make_order_message(self, "rop")
-            if self.is_accountant_confirm and not self.accountant_approve_time:
-                self.accountant_approve_time = datetime.now()
-                self.status = Order.OrderStatus.APPROVED_BY_ACCOUNTANT
-                message = make_order_message(self, "accountant")
-            if self.is_director_confirm and not self.director_approve_time:
-                self.director_approve_time = datetime.now()
-                self.status = Order.OrderStatus.APPROVED_BY_DIRECTOR
-                message = make_order_message(self, "director")
-            if self.is_storekeeper_confirm and not self.storekeeper_approve_time:
-                self.storekeeper_approve_time = datetime.now()
-                self.status = Order.OrderStatus.APPROVED_BY_STOREKEEPER
-                message = make_order_message(self, "storekeeper")
-            # cancel
-            if self.is_rop_cancel and not self.rop_cancel_time:
-                self.rop_cancel_time = datetime.now()
-                self.status = Order.OrderStatus.CANCELED_BY_ROP
-                message = cancel_order_message(self, "rop")
-            if self.is_storekeeper_cancel and not self.storekeeper_cancel_time:
-                self.storekeeper_cancel_time = datetime.now()
-                self.status = Order.OrderStatus.CANCELED_BY_STOREKEEPER
-                message = cancel_order_message(self, "storekeeper")
-            if self.is_director_cancel and not self.director_cancel_time:
-                self.director_cancel_time = datetime.now()
-                self.status = Order.OrderStatus.CANCELED_BY_DIRECTOR
-                message = cancel_order_message(self, "director")
-            if self.is_accountant_cancel and not self.accountant_cancel_time:
-                self.accountant_cancel_time = datetime.now()
-                self.status = Order.OrderStatus.CANCELED_BY_ACCOUNTANT
-                message = cancel_order_message(self, "accountant")
-            if self.agent and self.agent.telegram_id and message:
-                send_notification(self.agent.telegram_id, message)
-
+        if not self._state.adding and not kwargs.get("update_fields"):
+            # Status and approvals only change through transition() and totals through OrderItem writes,
+            # a full save must not undo one that happened since this instance was loaded
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.TRANSITION_FIELDS | self.TOTAL_FIELDS
+            ]
         return super().save(*args, **kwargs)
 
+    @staticmethod
+    def add_to_totals(order_id, total_uzs, item_count):
+        Order.objects.filter(pk=order_id).update(
+            total_uzs=F("total_uzs") + total_uzs, item_count=F("item_count") + item_count)
+
+    @staticmethod
+    def recompute_totals(order_ids):
+        """Sets the totals of the orders from their items, for writes that don't know the differences."""
+        totals = {order_id: (Decimal(0), 0) for order_id in order_ids}
+        for item in OrderItem.objects.filter(order_id__in=totals).only("order_id", "qty", "price_uzs"):
+            total, count = totals[item.order_id]
+            totals[item.order_id] = (total + item.total_uzs, count + 1)
+        for order_id, (total, count) in totals.items():
+            Order.objects.filter(pk=order_id).update(total_uzs=total, item_count=count)
+
+    def transition(self, name, actor=None):
+        """Applies ``TRANSITIONS[name]`` with one UPDATE that only matches while the order is still in
+        the status this instance has and records it as an OrderEvent of ``actor``. Returns False when
+        the status has changed, e.g. another admin was first."""
+        from bot.signals import order_transitioned
+        sources, target = self.TRANSITIONS[name]
+        source = self.status
+        if source not in sources:
+            return False
+
+        role, _, action = name.rpartition("_")
+        # No savepoint when called inside a bigger transaction (bulk actions), an error there rolls it all back
+        with transaction.atomic(savepoint=False):
+            if not Order.objects.filter(pk=self.pk, status=source).update(status=target):
+                return False
+            # Loaded before the new event is written so it isn't in there twice
+            events = self.events
+            event = OrderEvent.objects.create(order_id=self.pk, role=role, action=action, actor=actor)
+            self.status = target
+            events.append(event)
+            self._stages = None
+            order_transitioned.send(sender=Order, order=self, name=name, source=source)
+        return True
+
     class Meta:
         verbose_name = "Заказ"
         verbose_name_plural = "Заказы"
+        indexes = [
+            # Role queues and status filters of the admin, newest first
+            models.Index(fields=["status", "created_at"], name="order_status_created_at"),
+            models.Index(fields=["created_at"], name="order_created_at"),
+            models.Index(fields=["agent", "created_at"], name="order_agent_created_at"),
+        ]
+
 
+class ArchiveOrder(BaseOrder):
+    """Finished orders moved out of the live table by the archive_orders command, same ids as before."""
+    # Copied from the order, it must not be touched by saves in the archive
+    created_at = models.DateTimeField("Время размещения заказа")
+    archived_at = models.DateTimeField("Время архивации", auto_now_add=True)
 
-class ArchiveOrder(Order):
     class Meta:
-        proxy = True
         verbose_name = "Архив"
         verbose_name_plural = "Архивы"
-
-
-class OrderItem(models.Model):
-    order = models.ForeignKey(verbose_name="Заказ", related_name="items", to=Order, on_delete=models.CASCADE)
+        indexes = [
+            models.Index(fields=["created_at"], name="archive_order_created_at"),
+            models.Index(fields=["status", "created_at"], name="archive_order_status"),
+        ]
+
+
+class OrderItemQuerySet(models.QuerySet):
+    # Fields an update() of which changes the totals of the orders
+    TOTAL_FIELDS = {"order", "order_id", "qty", "price_uzs"}
+
+    def delete(self):
+        with transaction.atomic():
+            order_ids = set(self.values_list("order_id", flat=True))
+            result = super().delete()
+            Order.recompute_totals(order_ids)
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def update(self, **kwargs):
+        if not self.TOTAL_FIELDS & kwargs.keys():
+            return super().update(**kwargs)
+        with transaction.atomic():
+            order_ids = set(self.values_list("order_id", flat=True))
+            new_order = kwargs.get("order", kwargs.get("order_id"))
+            if new_order is not None:
+                order_ids.add(getattr(new_order, "pk", new_order))
+            result = super().update(**kwargs)
+            Order.recompute_totals(order_ids)
+        return result
+
+    update.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        totals = {}
+        for item in objs:
+            total, count = totals.get(item.order_id, (0, 0))
+            totals[item.order_id] = (total + item.total_uzs, count + 1)
+        with transaction.atomic():
+            objs = super().bulk_create(objs, *args, **kwargs)
+            for order_id, (total, count) in totals.items():
+                Order.add_to_totals(order_id, total, count)
+        return objs
+
+
+class BaseOrderItem(models.Model):
     product_name = models.CharField("Название продукта", max_length=255)
     product_in_set = models.FloatField("Количество в Блок", default=0)
     product_id = models.IntegerField(default=0)
-    qty = models.CharField("Количество", max_length=255)
-    set_amount = models.CharField("Блок", max_length=255, default="0")
-    price_uzs = models.CharField("Цена sum", max_length=255)
+    qty = models.DecimalField("Количество", max_digits=12, decimal_places=2)
+    set_amount = models.DecimalField("Блок", max_digits=12, decimal_places=2, default=0)
+    price_uzs = models.DecimalField("Цена sum", max_digits=14, decimal_places=2)
     price_usd = models.CharField("Цена USD", max_length=255, null=True, blank=True, editable=False)
 
+    @property
+    def total_uzs(self):
+        return Decimal(str(self.qty)) * Decimal(str(self.price_uzs))
+
     def get_real_qty(self):
-        try:
-            product = Product.objects.get(id=self.product_id)
-            set_amount = int(product.amount) // int(product.set_amount)
-            return f"{product.amount} dona"
-        except:
-            return f"0x0"
+        # Annotated by the admin's item inline, None for a product that is gone
+        available = getattr(self, "product_available", None)
+        if available is None:
+            return None
+        return f"{available} dona"
 
     get_real_qty.short_description = "Oстатка"
 
+    class Meta:
+        abstract = True
+
+
+class OrderItem(BaseOrderItem):
+    order = models.ForeignKey(verbose_name="Заказ", related_name="items", to=Order, on_delete=models.CASCADE)
+
+    objects = OrderItemQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if "qty" in field_names and "price_uzs" in field_names:
+            instance._saved_total = instance.total_uzs
+        return instance
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding or hasattr(self, "_saved_total"):
+                Order.add_to_totals(self.order_id, self.total_uzs - getattr(self, "_saved_total", 0), int(adding))
+        self._saved_total = self.total_uzs
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            Order.add_to_totals(self.order_id, -self.total_uzs, -1)
+            return super().delete(*args, **kwargs)
+
     class Meta:
         verbose_name = "Заказанные продукты"
         verbose_name_plural = "Заказанные продукты"
+        indexes = [
+            models.Index(fields=["product_id"], name="orderitem_product_id"),
+        ]
+
+
+class ArchiveOrderItem(BaseOrderItem):
+    order = models.ForeignKey(verbose_name="Заказ", related_name="items", to=ArchiveOrder, on_delete=models.CASCADE)
+
+    class Meta:
+        verbose_name = "Заказанные продукты (архив)"
+        verbose_name_plural = "Заказанные продукты (архив)"
 
 
 class Area(models.Model):
@@ -366,3 +605,172 @@ class Area(models.Model):
 
     def __str__(self) -> str:
         return f"{self.pk}. {self.name}"
+
+
+class BotState(models.Model):
+    class Kinds(models.TextChoices):
+        USER = "user", "Данные пользователя"
+        CHAT = "chat", "Данные чата"
+        BOT = "bot", "Данные бота"
+        CONVERSATION = "conversation", "Состояние диалога"
+
+    bot_id = models.CharField("ID бота", max_length=32)
+    kind = models.CharField("Тип", max_length=16, choices=Kinds.choices)
+    name = models.CharField("Название диалога", max_length=64, blank=True, default="")
+    key = models.CharField("Ключ", max_length=255)
+    data = models.JSONField("Данные", null=True, blank=True)
+    updated_at = models.DateTimeField("Обновлено", auto_now=True)
+
+    class Meta:
+        verbose_name = "Состояние бота"
+        verbose_name_plural = "Состояния бота"
+        constraints = [
+            models.UniqueConstraint(fields=["bot_id", "kind", "name", "key"], name="unique_bot_state"),
+        ]
+
+
+class ProcessedUpdate(models.Model):
+    """Webhook updates already queued by one of the bot workers, see serve.handle_update."""
+    bot_id = models.CharField("ID бота", max_length=32)
+    update_id = models.BigIntegerField("ID обновления")
+    received_at = models.DateTimeField("Получено", auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = "Полученное обновление"
+        verbose_name_plural = "Полученные обновления"
+        constraints = [
+            models.UniqueConstraint(fields=["bot_id", "update_id"], name="unique_processed_update"),
+        ]
+
+
+class Notification(models.Model):
+    class Statuses(models.TextChoices):
+        PENDING = "pending", "В очереди"
+        SENDING = "sending", "Отправляется"
+        SENT = "sent", "Отправлено"
+        FAILED = "failed", "Ошибка"
+
+    # Bot the chat talks to, see bot.notifications.bot_ids. Empty for the first bot in TOKENS
+    bot_id = models.CharField("ID бота", max_length=32, blank=True, default="")
+    chat_id = models.CharField("ID чата", max_length=255)
+    text = models.TextField("Текст")
+    parse_mode = models.CharField("Формат", max_length=16, default="HTML")
+    status = models.CharField("Статус", max_length=16, choices=Statuses.choices, default=Statuses.PENDING)
+    attempts = models.PositiveIntegerField("Попытки", default=0)
+    next_attempt_at = models.DateTimeField("Следующая попытка", default=timezone.now)
+    last_error = models.TextField("Последняя ошибка", blank=True, default="")
+    # Dispatcher run that is sending it, see bot.notifications.claim_due
+    claimed_by = models.CharField("Отправитель", max_length=32, blank=True, default="", editable=False)
+    created_at = models.DateTimeField("Создано", auto_now_add=True)
+    sent_at = models.DateTimeField("Отправлено", null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Уведомление"
+        verbose_name_plural = "Уведомления"
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"]),
+        ]
+
+
+class StockMovement(models.Model):
+    """Append-only ledger of Product.amount and Product.reserved changes, written by bot.stock."""
+
+    class Kinds(models.TextChoices):
+        RESERVE = "reserve", "Резерв"
+        RELEASE = "release", "Снятие резерва"
+        COMMIT = "commit", "Списание"
+        RESTOCK = "restock", "Возврат на склад"
+        ADJUST = "adjust", "Корректировка"
+
+    product = models.ForeignKey(verbose_name="Продукт", to=Product, on_delete=models.CASCADE, related_name="movements")
+    # No constraint so the id still points at the order once it is moved to ArchiveOrder
+    order = models.ForeignKey(verbose_name="Заказ", to=Order, on_delete=models.DO_NOTHING, null=True, blank=True,
+                              related_name="stock_movements", db_constraint=False)
+    kind = models.CharField("Тип", max_length=16, choices=Kinds.choices)
+    amount_change = models.FloatField("Изменение количества", default=0)
+    reserved_change = models.FloatField("Изменение резерва", default=0)
+    created_at = models.DateTimeField("Время", auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Движение товара"
+        verbose_name_plural = "Движения товаров"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValidationError("Движения товаров нельзя изменять.")
+        return super().save(*args, **kwargs)
+
+
+class OrderEvent(models.Model):
+    """Append-only history of order approvals and cancellations, written by Order.transition."""
+
+    class Actions(models.TextChoices):
+        APPROVE = "approve", "Подтверждено"
+        CANCEL = "cancel", "Отменено"
+
+    # No constraint so the id still points at the order once it is moved to ArchiveOrder
+    order = models.ForeignKey(verbose_name="Заказ", to=Order, on_delete=models.DO_NOTHING, related_name="+",
+                              db_constraint=False)
+    # Empty for the generic cancel of the status field
+    role = models.CharField("Роль", max_length=20, choices=CustomUser.ROLE_CHOICES, blank=True)
+    action = models.CharField("Действие", max_length=16, choices=Actions.choices)
+    at = models.DateTimeField("Время", default=timezone.now)
+    actor = models.ForeignKey(verbose_name="Пользователь", to=CustomUser, on_delete=models.SET_NULL, null=True,
+                              blank=True, related_name="+")
+
+    class Meta:
+        verbose_name = "Событие заказа"
+        verbose_name_plural = "События заказов"
+        indexes = [
+            models.Index(fields=["order", "at"], name="orderevent_order_at"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValidationError("События заказов нельзя изменять.")
+        return super().save(*args, **kwargs)
+
+    @classmethod
+    def attach(cls, orders):
+        """Loads the events of all ``orders`` (live or archived) with one query."""
+        orders = list(orders)
+        by_order = {order.pk: [] for order in orders}
+        for event in cls.objects.filter(order_id__in=by_order).order_by("at", "pk"):
+            by_order[event.order_id].append(event)
+        for order in orders:
+            order._events = by_order[order.pk]
+            order._stages = None
+        return orders
+
+
+class SlaRollup(models.Model):
+    """How long orders waited for each approver: latency histograms per hour and per day, role and
+    territory of the agent (empty for all territories together). Kept up to date by bot.sla."""
+
+    class Periods(models.TextChoices):
+        HOUR = "hour", "Час"
+        DAY = "day", "День"
+
+    period = models.CharField("Период", max_length=8, choices=Periods.choices)
+    start = models.DateTimeField("Начало периода")
+    role = models.CharField("Роль", max_length=20, choices=CustomUser.ROLE_CHOICES)
+    territory = models.ForeignKey(verbose_name="Территория", to=Area, on_delete=models.CASCADE, null=True,
+                                  blank=True, related_name="+")
+    # Index into bot.sla.LATENCY_BUCKETS
+    bucket = models.PositiveSmallIntegerField("Интервал")
+    count = models.PositiveIntegerField("Заказов", default=0)
+    total_seconds = models.FloatField("Сумма ожидания (сек)", default=0)
+
+    class Meta:
+        verbose_name = "SLA подтверждений"
+        verbose_name_plural = "SLA подтверждений"
+        indexes = [
+            models.Index(fields=["period", "start", "role"], name="slarollup_period_start"),
+        ]
+        # One row per bucket. NULLs are distinct in a unique index, the rows of all territories get their own
+        constraints = [
+            models.UniqueConstraint(fields=["period", "start", "role", "territory", "bucket"],
+                                    condition=models.Q(territory__isnull=False), name="unique_slarollup_territory"),
+            models.UniqueConstraint(fields=["period", "start", "role", "bucket"],
+                                    condition=models.Q(territory__isnull=True), name="unique_slarollup_all"),
+        ]
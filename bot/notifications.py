@@ -0,0 +1,123 @@
+import os
+import uuid
+import asyncio
+import logging
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.ext import ExtBot
+
+from bot.http_client import TimedHTTPXRequest
+from bot.models import BotState, Notification
+from bot.sender import NOTIFICATION, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 5  # seconds, doubled after every failed attempt
+BACKOFF_MAX = 60 * 60
+# How long a claimed batch belongs to its dispatcher. One that died meanwhile leaves it "sending",
+# the other dispatchers take it over once this has passed
+CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+def get_bots():
+    """Bot per bot id for every token in TOKENS, in their order."""
+    bots = {}
+    for token in os.environ.get("TOKENS", "").split(","):
+        if token:
+            bots[token.split(":")[0]] = ExtBot(token, request=TimedHTTPXRequest(),
+                                               rate_limiter=RateLimiter(token.split(":")[0]))
+    return bots
+
+
+def bot_ids(chat_ids):
+    """{chat id: id of the bot the user last wrote to} for the private chats the bots know. A bot can
+    only message the users who started it, so an agent's notifications go through their bot."""
+    rows = BotState.objects.filter(
+        kind=BotState.Kinds.USER, name="", key__in=[str(chat_id) for chat_id in chat_ids],
+    ).order_by("updated_at", "pk").values_list("key", "bot_id")
+    # The latest row of a user wins
+    return dict(rows)
+
+
+@sync_to_async
+def claim_due(limit):
+    """Marks up to ``limit`` due notifications as being sent by this call and returns them. The rows
+    another dispatcher claimed between the SELECT and the UPDATE are left out, so none is sent twice."""
+    now = timezone.now()
+    claim = uuid.uuid4().hex
+    due = Notification.objects.filter(
+        status__in=[Notification.Statuses.PENDING, Notification.Statuses.SENDING],
+        next_attempt_at__lte=now,
+    )
+    ids = list(due.order_by("id").values_list("id", flat=True)[:limit])
+    if not ids:
+        return []
+    due.filter(id__in=ids).update(
+        status=Notification.Statuses.SENDING,
+        claimed_by=claim,
+        next_attempt_at=now + CLAIM_TIMEOUT,
+    )
+    return list(Notification.objects.filter(id__in=ids, claimed_by=claim).order_by("id"))
+
+
+async def deliver(notification, bot):
+    notification.attempts += 1
+    # Back in the queue unless sent or given up below
+    notification.status = Notification.Statuses.PENDING
+    notification.next_attempt_at = timezone.now()
+    try:
+        await bot.send_message(
+            chat_id=notification.chat_id,
+            text=notification.text,
+            parse_mode=notification.parse_mode,
+            rate_limit_args=NOTIFICATION,
+        )
+        notification.status = Notification.Statuses.SENT
+        notification.sent_at = timezone.now()
+        notification.last_error = ""
+    except RetryAfter as e:
+        # Flood control is not the notification's fault, it does not count as an attempt
+        notification.attempts -= 1
+        notification.next_attempt_at = timezone.now() + timedelta(seconds=e.retry_after)
+        notification.last_error = str(e)
+    except (BadRequest, Forbidden) as e:
+        # Chat not found, bot blocked by the user etc. won't get better with retries
+        notification.status = Notification.Statuses.FAILED
+        notification.last_error = str(e)
+    except TelegramError as e:
+        notification.last_error = str(e)
+        if notification.attempts >= MAX_ATTEMPTS:
+            notification.status = Notification.Statuses.FAILED
+        else:
+            delay = min(BACKOFF_BASE * 2 ** (notification.attempts - 1), BACKOFF_MAX)
+            notification.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+
+    if notification.status == Notification.Statuses.FAILED:
+        logger.warning("Notification %s to %s failed: %s", notification.pk, notification.chat_id,
+                       notification.last_error)
+
+    await notification.asave(update_fields=["status", "attempts", "next_attempt_at", "last_error", "sent_at"])
+
+
+async def deliver_chat(notifications, bots):
+    # Notifications of one chat are sent one by one so they arrive in the order they were created.
+    # Those without a bot, or whose bot is not in TOKENS any more, go through the first one
+    default = next(iter(bots.values()))
+    for notification in notifications:
+        await deliver(notification, bots.get(notification.bot_id, default))
+
+
+async def dispatch(bots, limit=100):
+    """Delivers up to ``limit`` due notifications through the bots of get_bots(), different chats in
+    parallel. Returns how many it claimed."""
+    notifications = await claim_due(limit)
+    by_chat = {}
+    for notification in notifications:
+        by_chat.setdefault(notification.chat_id, []).append(notification)
+
+    await asyncio.gather(*[deliver_chat(chat_notifications, bots) for chat_notifications in by_chat.values()])
+    return len(notifications)
@@ -1,13 +1,17 @@
 from django.http import HttpResponse
 from django.template.loader import render_to_string
 from weasyprint import HTML, CSS
-from .models import Order
+from .models import Order, ArchiveOrder
 from PyPDF2 import PdfMerger
 import io
 
 
+def get_order(pk):
+    return Order.objects.filter(pk=pk).first() or ArchiveOrder.objects.get(pk=pk)
+
+
 def generate_pdf_view(request, pk):
-    obj = Order.objects.get(pk=pk)
+    obj = get_order(pk)
 
     data = {
         "id": str(obj.id).zfill(10),
@@ -35,7 +39,7 @@ def generate_pdf_view(request, pk):
 
 def generate_pdf2_view(request):
     orders = request.GET.get("orders").split(",")
-    orders = Order.objects.filter(pk__in=orders)
+    orders = [*Order.objects.filter(pk__in=orders), *ArchiveOrder.objects.filter(pk__in=orders)]
     users = ""
     total_sum = 0
     total_qty = 0
@@ -102,7 +106,7 @@ def generate_multiple_pdfs_view(request):
     merger = PdfMerger()
 
     for pk in ids:
-        obj = Order.objects.get(pk=pk)
+        obj = get_order(pk)
         data = {
             "id": str(obj.id).zfill(10),
             "order_time": obj.created_at,
@@ -1,8 +1,12 @@
 import openpyxl
 from openpyxl.utils import get_column_letter
 from django.http import HttpResponse
+from bot import catalog
+from bot.conditional import catalog_conditional
 from .models import Product
 
+
+@catalog_conditional("price_list", tier=lambda request: catalog.tier_of(cate=request.GET.get("cat")))
 def export_products_to_excel(request):
     # Create an Excel workbook and worksheet
     cat = request.GET.get('cat')
@@ -21,13 +25,9 @@ def export_products_to_excel(request):
         worksheet[f"{col_letter}1"] = header
 
     # Query the products and write their data to the worksheet
-    products = Product.objects.all()
-    products = products.extra(
-                    select={
-                        'price_uzs': f'price_uzs_{cat}',
-                        'price_usd': f'price_usd_{cat}'
-                    }
-                )
+    if cat not in catalog.TIERS:
+        cat = catalog.DEFAULT_TIER
+    products = Product.objects.priced(cat)
     for row_num, product in enumerate(products, 2):
         worksheet[f"A{row_num}"] = product.id
         worksheet[f"B{row_num}"] = product.title
@@ -1,5 +1,5 @@
-from import_export import resources
-from bot.models import TelegramUser, Order
+from import_export import fields, resources
+from bot.models import TelegramUser, Order, OrderEvent
 
 
 class UsersTableResourse(resources.ModelResource):
@@ -34,6 +34,14 @@ class UsersTableResourse(resources.ModelResource):
 
 
 class OrderResource(resources.ModelResource):
+    accountant_approve_time = fields.Field(attribute="accountant_approve_time")
+    director_approve_time = fields.Field(attribute="director_approve_time")
+    storekeeper_approve_time = fields.Field(attribute="storekeeper_approve_time")
+
+    def iter_queryset(self, queryset):
+        # The approval times come from the orders' events, loaded for all of them at once
+        return OrderEvent.attach(queryset.select_related("user", "agent"))
+
     def dehydrate_user(self, obj):
         if obj.user:
             return f"{obj.user.first_name} {obj.user.last_name}"
@@ -83,5 +91,7 @@ class OrderResource(resources.ModelResource):
 
     class Meta:
         model = Order
-        exclude = ("id", )
+        fields = ("user", "agent", "payment_status", "payment_type", "status", "created_at", "location_path",
+                  "accountant_approve_time", "director_approve_time", "storekeeper_approve_time")
+        export_order = fields
         
\ No newline at end of file
@@ -0,0 +1,112 @@
+import re
+import threading
+from collections import defaultdict
+
+from bot import catalog
+from bot.models import Category, Product
+
+# Russian and Uzbek Cyrillic written the way Uzbek Latin spells it, so "молоко", "moloko" and
+# "ўрик"/"o'rik" end up the same
+CYRILLIC = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "yo", "ж": "j", "з": "z", "и": "i",
+    "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t",
+    "у": "u", "ф": "f", "х": "x", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sh", "ъ": "", "ы": "i", "ь": "",
+    "э": "e", "ю": "yu", "я": "ya", "ў": "o", "қ": "q", "ғ": "g", "ҳ": "x",
+}
+# o' and g' of Uzbek Latin come with any of these apostrophes, or none
+APOSTROPHES = re.compile(r"['`ʻʼ‘’]")
+# Х is written x, h or kh ("xleb", "hleb", "khleb"), sh and ch stay as they are
+KH = re.compile(r"kh|(?<![sc])h")
+WORD = re.compile(r"\w+")
+
+# Least trigram similarity of a query word and a title word to count as a (misspelled) match
+MIN_SIMILARITY = 0.3
+
+
+def normalize(text):
+    text = APOSTROPHES.sub("", text.lower())
+    return KH.sub("x", "".join(CYRILLIC.get(char, char) for char in text))
+
+
+def words(text):
+    return WORD.findall(normalize(text))
+
+
+def trigrams(word):
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(query_word, word):
+    """1 when ``word`` starts with ``query_word``, otherwise how many trigrams they share, also
+    against the start of ``word`` so that misspelled prefixes match too."""
+    if word.startswith(query_word):
+        return 1.0
+    query_trigrams = trigrams(query_word)
+
+    def jaccard(other):
+        other_trigrams = trigrams(other)
+        return len(query_trigrams & other_trigrams) / len(query_trigrams | other_trigrams)
+
+    return max(jaccard(word), jaccard(word[:len(query_word)]))
+
+
+class TrigramIndex:
+    """In-memory index of {pk: text}, searched by prefix and trigram similarity of the words."""
+
+    def __init__(self, items):
+        self.words = defaultdict(set)  # word -> pks
+        self.trigrams = defaultdict(set)  # trigram -> words
+        for pk, text in items.items():
+            for word in words(text or ""):
+                self.words[word].add(pk)
+        for word in self.words:
+            for trigram in trigrams(word):
+                self.trigrams[trigram].add(word)
+
+    def matches(self, query_word):
+        """{pk: similarity} of the items having a word similar to ``query_word``."""
+        candidates = set()
+        for trigram in trigrams(query_word):
+            candidates |= self.trigrams.get(trigram, set())
+        scores = {}
+        for word in candidates:
+            score = similarity(query_word, word)
+            if score >= MIN_SIMILARITY:
+                for pk in self.words[word]:
+                    scores[pk] = max(scores.get(pk, 0), score)
+        return scores
+
+    def search(self, query):
+        """pks of the items matching every word of the query, best matches first."""
+        scores = None
+        for query_word in words(query):
+            matches = self.matches(query_word)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {pk: score + matches[pk] for pk, score in scores.items() if pk in matches}
+        return sorted(scores or {}, key=lambda pk: (-scores[pk], pk))
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def index(model):
+    """The process's index of the model's titles, rebuilt whenever the catalog version changes."""
+    version = catalog.versions()[0]
+    with _indexes_lock:
+        built_version, built = _indexes.get(model, (None, None))
+        if built_version != version:
+            built = TrigramIndex(dict(model.objects.values_list("pk", "title")))
+            _indexes[model] = version, built
+        return built
+
+
+def products(query):
+    return index(Product).search(query)
+
+
+def categories(query):
+    return index(Category).search(query)
@@ -0,0 +1,188 @@
+import time
+import asyncio
+import logging
+import threading
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from bot import metrics
+from bot.http_client import get_session
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second per bot and 1 per second per chat
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+# A few messages in a row to one chat are fine as long as the average stays at CHAT_RATE
+CHAT_BURST = 3
+MAX_RETRIES = 3
+# Chat buckets are dropped once they are idle and there are more than this many
+MAX_CHATS = 10000
+
+REPLY = "reply"
+NOTIFICATION = "notification"
+# Notifications may only take part of the global rate so replies to users always get through
+PRIORITY_RATES = {
+    REPLY: GLOBAL_RATE,
+    NOTIFICATION: 20,
+}
+
+
+class TokenBucket:
+    """Token bucket kept as the time the next send is due, ``rate`` sends per second with
+    bursts of up to ``burst``."""
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.due = 0.0
+
+    def earliest(self):
+        return self.due - self.tolerance
+
+    def take(self, at):
+        self.due = max(self.due, at) + self.interval
+
+    def block(self, until):
+        self.due = max(self.due, until + self.tolerance)
+
+
+class TelegramSender:
+    """Rate limits for one bot, shared by every thread and event loop of the process."""
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, priority_rates=None):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._lock = threading.Lock()
+        self._global = TokenBucket(global_rate)
+        self._priorities = {
+            priority: TokenBucket(rate) for priority, rate in (priority_rates or PRIORITY_RATES).items()
+        }
+        self._chats = {}
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHATS:
+                self._chats = {key: value for key, value in self._chats.items() if value.due > now}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def try_acquire(self, chat_id=None, priority=REPLY):
+        """Books a slot for a message to ``chat_id``, returns ``(delay, booked)``.
+
+        Replies always book the next free slot and wait ``delay`` for it. Other priorities only take
+        a slot that is free right away so they never push replies back, otherwise nothing is booked
+        and they should try again after ``delay``.
+        """
+        now = time.monotonic()
+        with self._lock:
+            shared = [self._global, self._priorities[priority]]
+            chat = self._chat_bucket(chat_id, now) if chat_id is not None else None
+            at = max([now] + [bucket.earliest() for bucket in shared + [chat] if bucket])
+            if priority != REPLY and at > now:
+                return at - now, False
+            # The shared buckets book their own next slot, a chat that is held back must not hold back the others
+            for bucket in shared:
+                bucket.take(max(now, bucket.earliest()))
+            if chat is not None:
+                chat.take(at)
+        return at - now, True
+
+    def wait(self, chat_id=None, priority=REPLY):
+        started_at = time.monotonic()
+        booked = False
+        while not booked:
+            delay, booked = self.try_acquire(chat_id, priority)
+            time.sleep(delay)
+        metrics.observe(f"telegram.throttle.{priority}", time.monotonic() - started_at)
+
+    async def wait_async(self, chat_id=None, priority=REPLY):
+        started_at = time.monotonic()
+        booked = False
+        while not booked:
+            delay, booked = self.try_acquire(chat_id, priority)
+            await asyncio.sleep(delay)
+        metrics.observe(f"telegram.throttle.{priority}", time.monotonic() - started_at)
+
+    def retry_after(self, chat_id, seconds):
+        """Holds back a chat (or the whole bot) after Telegram answered with 429."""
+        metrics.incr("telegram.retry_after")
+        until = time.monotonic() + seconds
+        with self._lock:
+            if chat_id is None:
+                self._global.block(until)
+            else:
+                self._chat_bucket(chat_id, until).block(until)
+
+    def sent(self, priority, started_at):
+        metrics.incr(f"telegram.sent.{priority}")
+        metrics.observe("telegram.request", time.monotonic() - started_at)
+
+    def send_message(self, token, chat_id, text, parse_mode="HTML", priority=NOTIFICATION, timeout=10):
+        """Blocking sendMessage for the Django side. Returns the sent message, raises
+        ``requests.RequestException`` when Telegram keeps refusing it."""
+        url = f"https://api.telegram.org/bot{token}/sendMessage"
+        data = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode}
+        for attempt in range(MAX_RETRIES + 1):
+            self.wait(chat_id, priority)
+            started_at = time.monotonic()
+            response = get_session().post(url, data=data, timeout=timeout)
+            if response.status_code == 429 and attempt < MAX_RETRIES:
+                seconds = response.json().get("parameters", {}).get("retry_after", 1)
+                logger.warning("Flood control for chat %s, retrying in %s s", chat_id, seconds)
+                self.retry_after(chat_id, seconds)
+                continue
+            response.raise_for_status()
+            self.sent(priority, started_at)
+            return response.json()["result"]
+
+
+_senders = {}
+_senders_lock = threading.Lock()
+
+
+def get_sender(bot_id):
+    """The limits are per bot, so every bot gets one sender per process."""
+    bot_id = str(bot_id)
+    with _senders_lock:
+        if bot_id not in _senders:
+            _senders[bot_id] = TelegramSender()
+        return _senders[bot_id]
+
+
+class RateLimiter(BaseRateLimiter):
+    """Puts every Bot API call of an ExtBot through the bot's sender. The priority is passed as
+    ``rate_limit_args``, calls without one are replies."""
+
+    def __init__(self, bot_id):
+        self.sender = get_sender(bot_id)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args or REPLY
+        chat_id = data.get("chat_id")
+        for attempt in range(MAX_RETRIES + 1):
+            # Calls without a chat (answerCallbackQuery, setWebhook, ...) don't count against the limits
+            if chat_id is not None:
+                await self.sender.wait_async(chat_id, priority)
+            started_at = time.monotonic()
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                logger.warning("Flood control for chat %s on %s, retrying in %s s", chat_id, endpoint, e.retry_after)
+                self.sender.retry_after(chat_id, e.retry_after)
+                # Calls without a chat skip wait_async, they must not retry before Telegram allows it
+                await asyncio.sleep(e.retry_after)
+                continue
+            if chat_id is not None:
+                self.sender.sent(priority, started_at)
+            return result
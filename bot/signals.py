@@ -1,36 +1,112 @@
-import os
-from django.dispatch import receiver
-from django.db.models.signals import pre_save
-from bot.models import Order, Product
-from datetime import datetime
-from dotenv import load_dotenv
-import requests
-from django.contrib import messages
-
-load_dotenv()
-
-
-@receiver(pre_save, sender=Order)
-def update_approve_time(sender, instance:Order, **kwargs):
-    if instance.pk:
-        old_instance = Order.objects.get(id=instance.pk)
-        if old_instance.status == Order.OrderStatus.APPROVED_BY_DIRECTOR and old_instance.status != instance.status:
-            for item in instance.items.all():
-                try:
-                    product = Product.objects.get(id=item)
-                    product.amount = int(product.amount) - int(item.qty)
-                    product.save(update_fields=['amount'])
-                except:
-                    pass
-            return
-
-        if ((old_instance.status == Order.OrderStatus.PENDING and instance.status == Order.OrderStatus.CANCELLED) or
-            (old_instance.status == Order.OrderStatus.APPROVED_BY_ACCOUNTANT and instance.status == Order.OrderStatus.CANCELLED) or
-            (old_instance.status == Order.OrderStatus.APPROVED_BY_DIRECTOR and instance.status == Order.OrderStatus.CANCELLED) or
-            (old_instance.status == Order.OrderStatus.APPROVED_BY_STOREKEEPER and instance.status == Order.OrderStatus.CANCELLED)):
-            message = "Заказ был отменен\n"
-            message = f"Заказ Nº {str(instance.id).zfill(5)}"
-            return
+import threading
+from contextlib import contextmanager
+
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import Signal, receiver
+from bot import catalog, images, sla, stock
+from bot.archive import FINAL_STATUSES
+from bot.models import Category, Notification, Order, Product, TelegramUser
+from bot.notifications import bot_ids
+
+# Sent by Order.transition() inside its transaction with order, name (the key of Order.TRANSITIONS)
+# and source (the status the order came from)
+order_transitioned = Signal()
+
+# Telegram's limit for the text of one message
+MESSAGE_LIMIT = 4096
+
+_batch = threading.local()
+
+
+@contextmanager
+def batched_notifications():
+    """Collects the agent notifications of the transitions made inside the block and writes them
+    with one INSERT when it ends, the messages of an agent joined into as few as fit MESSAGE_LIMIT."""
+    _batch.messages = {}
+    try:
+        yield
+        by_chat, _batch.messages = _batch.messages, None
+        bots = bot_ids(by_chat)
+        Notification.objects.bulk_create([
+            Notification(bot_id=bots.get(chat_id, ""), chat_id=chat_id, text=text)
+            for chat_id, chat_messages in by_chat.items() for text in join_messages(chat_messages)
+        ])
+    finally:
+        _batch.messages = None
+
+
+def join_messages(messages):
+    texts = []
+    for message in messages:
+        if texts and len(texts[-1]) + 1 + len(message) <= MESSAGE_LIMIT:
+            texts[-1] += "\n" + message
+        else:
+            texts.append(message)
+    return texts
+
+
+@receiver(order_transitioned)
+def notify_agent(sender, order: Order, name, **kwargs):
+    role, _, action = name.rpartition("_")
+    if not role or not (order.agent and order.agent.telegram_id):
+        return
+    # The notification is written with the order and delivered by dispatch_notifications
+    message = make_order_message(order, role) if action == "approve" else cancel_order_message(order, role)
+    batch = getattr(_batch, "messages", None)
+    if batch is not None:
+        batch.setdefault(order.agent.telegram_id, []).append(message)
+    else:
+        chat_id = order.agent.telegram_id
+        Notification.objects.create(bot_id=bot_ids([chat_id]).get(chat_id, ""), chat_id=chat_id, text=message)
+
+
+@receiver(order_transitioned)
+def move_stock(sender, order: Order, name, source, **kwargs):
+    # Runs inside the transition's transaction, so the order and its stock move together
+    if name == "storekeeper_approve":
+        return stock.commit(order)
+    if name.endswith("cancel"):
+        if source == Order.OrderStatus.APPROVED_BY_STOREKEEPER:
+            # Taken off stock already, nothing is reserved any more
+            return stock.restock(order)
+        return stock.release(order)
+
+
+@receiver(pre_delete, sender=Order)
+def release_stock(sender, instance: Order, **kwargs):
+    # Abandoned orders (no clients, over the limit, deleted in the admin) give their reservation back.
+    # Finished ones have none left, archiving them needs no ledger lookup
+    if instance.status not in FINAL_STATUSES:
+        stock.release(instance)
+
+
+@receiver(order_transitioned)
+def record_sla(sender, order: Order, name, **kwargs):
+    # The transition's event is the order's latest one
+    sla.record(order, order.events[-1])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def bump_catalog(sender, **kwargs):
+    catalog.bump()
+
+
+@receiver(post_save, sender=TelegramUser)
+@receiver(post_delete, sender=TelegramUser)
+@receiver(m2m_changed, sender=TelegramUser.territory.through)
+def bump_users(sender, **kwargs):
+    # The bot keeps resolved users in memory (utils.resolve_user), the admin's changes reach it this way
+    catalog.bump("users_version")
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Category)
+def make_cover_derivatives(sender, instance, raw=False, **kwargs):
+    if not raw:
+        images.refresh(instance)
 
 
 def cancel_order_message(order: Order, confirmer):
@@ -47,11 +123,8 @@ def cancel_order_message(order: Order, confirmer):
     message += f"<b>Клиент:</b> {order_user_first_name} {order_user_last_name}\n"
     message += f"<b>Статус:</b> ❌ {CANCELERS[confirmer]}\n"
     message += "===================== \n\n"
-    total_sum_uzs = 0
     for item in order.items.all():
-        total_sum_uzs += float(item.qty) * float(item.price_uzs)
-
-        message += f"{item.product_name} - {item.qty} шт. {item.set_amount} набор\n\n"
+        message += f"{item.product_name} - {item.qty.normalize():f} шт. {item.set_amount.normalize():f} набор\n\n"
 
     order_comment = order.comment if order.comment else "Не указано"
     if order.agent and order.agent.territory.exists():
@@ -62,7 +135,7 @@ def cancel_order_message(order: Order, confirmer):
     message += f"<b>Комментарий:</b> {order_comment}\n"
     message += f"<b>Территории:</b> {order_area}\n"
     message += "\n=====================\n"
-    message += f"<b>Общая сумма (UZS):</b> {total_sum_uzs:,}\n"
+    message += f"<b>Общая сумма (UZS):</b> {order.total_uzs:,}\n"
     return message
 
 
@@ -80,11 +153,8 @@ def make_order_message(order: Order, confirmer):
     message += f"<b>Клиент:</b> {order_user_first_name} {order_user_last_name}\n"
     message += f"<b>Статус:</b> ✅ {CONFIRMERS[confirmer]}\n"
     message += "===================== \n\n"
-    total_sum_uzs = 0
     for item in order.items.all():
-        total_sum_uzs += float(item.qty) * float(item.price_uzs)
-
-        message += f"{item.product_name} - {item.qty} шт. {item.set_amount} набор\n\n"
+        message += f"{item.product_name} - {item.qty.normalize():f} шт. {item.set_amount.normalize():f} набор\n\n"
 
     order_comment = order.comment if order.comment else "Не указано"
     if order.agent and order.agent.territory.exists():
@@ -95,19 +165,5 @@ def make_order_message(order: Order, confirmer):
     message += f"<b>Комментарий:</b> {order_comment}\n"
     message += f"<b>Территории:</b> {agent_territory}\n"
     message += "\n=====================\n"
-    message += f"<b>Общая сумма (UZS):</b> {total_sum_uzs:,}\n"
+    message += f"<b>Общая сумма (UZS):</b> {order.total_uzs:,}\n"
     return message
-
-
-def send_notification(chat_id, message):
-    token = os.environ.get("TOKENS")
-    if token:
-        data = {
-            "chat_id": chat_id,
-            "text": message,
-            "parse_mode": "HTML"
-        }
-        endpoint = f"https://api.telegram.org/bot{token}/sendMessage"
-        requests.post(endpoint, data=data)
-    else:
-        raise Exception(f"Token not found {token}")
@@ -0,0 +1,128 @@
+import logging
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from bot.models import ArchiveOrder, Order, OrderEvent, SlaRollup
+
+logger = logging.getLogger(__name__)
+
+Periods = SlaRollup.Periods
+
+# Upper bounds (seconds) of the latency histogram, waits longer than the last one go to one more bucket
+LATENCY_BUCKETS = (
+    60, 5 * 60, 15 * 60, 30 * 60, 60 * 60, 2 * 3600, 4 * 3600, 8 * 3600, 24 * 3600, 2 * 86400, 7 * 86400,
+)
+PERCENTILES = (50, 90, 95)
+
+
+def bucket_of(seconds):
+    return bisect_left(LATENCY_BUCKETS, seconds)
+
+
+def period_starts(at):
+    hour = timezone.localtime(at).replace(minute=0, second=0, microsecond=0)
+    return {Periods.HOUR: hour, Periods.DAY: hour.replace(hour=0)}
+
+
+def latencies(order):
+    """(event, seconds) for the order's approver events, how long the order waited for that role since
+    the previous event, the first one since the order was placed."""
+    previous = order.created_at
+    for event in order.events:
+        if event.role:
+            yield event, max((event.at - previous).total_seconds(), 0)
+        previous = event.at
+
+
+def rollup_keys(order, event):
+    territories = [None] + ([area.pk for area in order.agent.territory.all()] if order.agent else [])
+    for period, start in period_starts(event.at).items():
+        for territory_id in territories:
+            yield period, start, event.role, territory_id
+
+
+def record(order, event):
+    """Adds the wait that ended with ``event`` to the rollups, called for every transition."""
+    seconds = next((seconds for latest, seconds in latencies(order) if latest is event), None)
+    if seconds is None:
+        return
+    bucket = bucket_of(seconds)
+    for period, start, role, territory_id in rollup_keys(order, event):
+        key = {"period": period, "start": start, "role": role, "territory_id": territory_id, "bucket": bucket}
+        added = {"count": F("count") + 1, "total_seconds": F("total_seconds") + seconds}
+        if SlaRollup.objects.filter(**key).update(**added):
+            continue
+        try:
+            with transaction.atomic():
+                SlaRollup.objects.create(**key, count=1, total_seconds=seconds)
+        except IntegrityError:
+            # Another transaction created the row meanwhile, the unique constraint waited for it
+            SlaRollup.objects.filter(**key).update(**added)
+
+
+def rebuild(batch_size=500):
+    """Recomputes all rollups from the event log, live and archived orders."""
+    totals = defaultdict(lambda: [0, 0.0])
+    for model in (Order, ArchiveOrder):
+        orders = list(model.objects.select_related("agent").prefetch_related("agent__territory").order_by("pk"))
+        for i in range(0, len(orders), batch_size):
+            for order in OrderEvent.attach(orders[i:i + batch_size]):
+                for event, seconds in latencies(order):
+                    for key in rollup_keys(order, event):
+                        total = totals[key + (bucket_of(seconds),)]
+                        total[0] += 1
+                        total[1] += seconds
+
+    with transaction.atomic():
+        SlaRollup.objects.all().delete()
+        SlaRollup.objects.bulk_create([
+            SlaRollup(period=period, start=start, role=role, territory_id=territory_id, bucket=bucket, count=count,
+                      total_seconds=seconds)
+            for (period, start, role, territory_id, bucket), (count, seconds) in totals.items()
+        ], batch_size=batch_size)
+    logger.info("Rebuilt %s SLA rollups", len(totals))
+    return len(totals)
+
+
+def prune(before):
+    """Drops the hourly rollups older than ``before``, the daily ones are kept."""
+    deleted, _ = SlaRollup.objects.filter(period=Periods.HOUR, start__lt=before).delete()
+    return deleted
+
+
+def percentile(histogram, percent):
+    """Upper bound of the bucket the ``percent``-th wait falls in, None when it's past the last one."""
+    total = sum(histogram.values())
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen * 100 >= total * percent:
+            return LATENCY_BUCKETS[bucket] if bucket < len(LATENCY_BUCKETS) else None
+    return None
+
+
+def summary(period, since):
+    """Stats per (role, territory name) from the rollups since ``since``, territory None for all
+    territories: count, average and PERCENTILES of the wait in seconds."""
+    rows = SlaRollup.objects.filter(period=period, start__gte=since).values(
+        "role", "territory__name", "bucket").annotate(count=Sum("count"), seconds=Sum("total_seconds"))
+    histograms = defaultdict(dict)
+    seconds = defaultdict(float)
+    for row in rows:
+        key = (row["role"], row["territory__name"])
+        histograms[key][row["bucket"]] = row["count"]
+        seconds[key] += row["seconds"]
+
+    stats = {}
+    for key, histogram in histograms.items():
+        count = sum(histogram.values())
+        stats[key] = {
+            "count": count,
+            "average": seconds[key] / count,
+            **{f"p{percent}": percentile(histogram, percent) for percent in PERCENTILES},
+        }
+    return stats
@@ -0,0 +1,153 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+from pathlib import Path
+
+import brotli
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, StaticFilesStorage, staticfiles_storage
+from django.core.files.base import ContentFile
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+logger = logging.getLogger(__name__)
+
+# Content-Encoding -> suffix of the precompressed copy, best first
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+# Formats that are compressed already, and the source maps only the developer tools fetch
+SKIPPED = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".woff", ".woff2", ".gz", ".br", ".zip", ".map"}
+# A copy is kept only when it is at least this much smaller than the file
+MIN_RATIO = 0.95
+# For the fingerprinted names, a changed file gets a new name
+IMMUTABLE = "public, max-age=31536000, immutable"
+# "gzip;q=0" in Accept-Encoding turns gzip down
+REFUSED = re.compile(r"q=0(\.0*)?")
+
+
+def compress(content):
+    """{encoding: compressed content}"""
+    return {
+        "br": brotli.compress(content, quality=11),
+        "gzip": gzip.compress(content, compresslevel=9, mtime=0),
+    }
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Manifest of fingerprinted names plus .br and .gz copies of the files, all written by collectstatic."""
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        # Most fingerprinted files are byte for byte their originals, each content is compressed once
+        compressed = {}
+        hashed_names = set(self.hashed_files.values())
+        for name in sorted({*paths, *hashed_names}):
+            self.write_copies(name, name in hashed_names, compressed)
+
+    def write_copies(self, name, fingerprinted, compressed):
+        if os.path.splitext(name)[1].lower() in SKIPPED:
+            return
+        # A fingerprinted name always has the same content, a plain one is newer than its copies when changed
+        modified = None if fingerprinted else self.get_modified_time(name)
+        for copy in (name + suffix for suffix in ENCODINGS.values()):
+            if self.exists(copy) and (fingerprinted or self.get_modified_time(copy) >= modified):
+                return
+        with self.open(name) as file:
+            content = file.read()
+        digest = hashlib.md5(content).digest()
+        if digest not in compressed:
+            compressed[digest] = compress(content)
+        for encoding, data in compressed[digest].items():
+            copy = name + ENCODINGS[encoding]
+            if self.exists(copy):
+                self.delete(copy)
+            if len(data) < len(content) * MIN_RATIO:
+                self._save(copy, ContentFile(data))
+        logger.debug("Compressed %s", name)
+
+    def url(self, name, force=False):
+        # DEBUG is on in production, so the fingerprinted names are used whenever there is a manifest.
+        # Files collected without one (or not collected yet) keep their plain names
+        try:
+            return super().url(name, force=force or bool(self.hashed_files))
+        except ValueError:
+            return StaticFilesStorage.url(self, name)
+
+    def savings(self):
+        """(name, size, {encoding: size of the copy}) of every fingerprinted file"""
+        for name in sorted(set(self.hashed_files.values())):
+            if not self.exists(name):
+                continue
+            sizes = {encoding: self.size(name + suffix) for encoding, suffix in ENCODINGS.items()
+                     if self.exists(name + suffix)}
+            yield name, self.size(name), sizes
+
+
+# (mtime of the manifest, fingerprinted names in it)
+_fingerprinted = (None, frozenset())
+
+
+def fingerprinted():
+    """The fingerprinted names of the manifest, read again whenever collectstatic has rewritten it."""
+    global _fingerprinted
+    if not hasattr(staticfiles_storage, "load_manifest"):
+        return frozenset()
+    try:
+        modified = os.path.getmtime(staticfiles_storage.path(staticfiles_storage.manifest_name))
+    except OSError:
+        return frozenset()
+    if _fingerprinted[0] != modified:
+        hashed_files, _ = staticfiles_storage.load_manifest()
+        _fingerprinted = (modified, frozenset(hashed_files.values()))
+    return _fingerprinted[1]
+
+
+def accepted_encodings(request):
+    accepted = set()
+    for part in request.headers.get("Accept-Encoding", "").split(","):
+        encoding, _, params = part.partition(";")
+        if not REFUSED.fullmatch(params.strip()):
+            accepted.add(encoding.strip().lower())
+    return accepted
+
+
+def serve(request, path):
+    """Serves a collected static file in the best encoding the browser accepts. Fingerprinted names
+    are cached for good, plain ones are revalidated."""
+    path = posixpath.normpath(path).lstrip("/")
+    fullpath = Path(safe_join(settings.STATIC_ROOT, path))
+    if not fullpath.is_file():
+        raise Http404(f"No static file {path}")
+    statobj = fullpath.stat()
+    if not was_modified_since(request.META.get("HTTP_IF_MODIFIED_SINCE"), statobj.st_mtime):
+        # Same caching headers as the 200, the caches keep one copy per encoding
+        return cache_headers(HttpResponseNotModified(), path)
+
+    content_type = mimetypes.guess_type(fullpath.name)[0] or "application/octet-stream"
+    served, content_encoding = fullpath, None
+    accepted = accepted_encodings(request)
+    for encoding, suffix in ENCODINGS.items():
+        copy = fullpath.with_name(fullpath.name + suffix)
+        if encoding in accepted and copy.is_file():
+            served, content_encoding = copy, encoding
+            break
+
+    response = FileResponse(served.open("rb"), content_type=content_type, filename=fullpath.name)
+    response.headers["Last-Modified"] = http_date(statobj.st_mtime)
+    if content_encoding:
+        response.headers["Content-Encoding"] = content_encoding
+    return cache_headers(response, path)
+
+
+def cache_headers(response, path):
+    patch_vary_headers(response, ["Accept-Encoding"])
+    response.headers["Cache-Control"] = IMMUTABLE if path in fingerprinted() else "no-cache"
+    return response
@@ -0,0 +1,125 @@
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, F, FloatField, Q, Sum, Value, When
+
+from bot import catalog
+from bot.models import OrderItem, Product, StockMovement
+
+logger = logging.getLogger(__name__)
+
+Kinds = StockMovement.Kinds
+
+
+def order_quantities(order):
+    """{product_id: quantity} of the order's items, lines of the same product added up."""
+    quantities = defaultdict(float)
+    items = OrderItem.objects.filter(order=order, product_id__in=Product.objects.values("pk")).values_list(
+        "product_id", "qty")
+    for product_id, qty in items:
+        try:
+            quantities[product_id] += float(qty)
+        except (TypeError, ValueError):
+            logger.warning("Order %s has a non numeric qty %r for product %s", order.pk, qty, product_id)
+    return dict(quantities)
+
+
+def reserved_for(order):
+    """{product_id: quantity} the ledger still holds reserved for the order."""
+    rows = StockMovement.objects.filter(order=order).values("product_id").annotate(reserved=Sum("reserved_change"))
+    return {row["product_id"]: row["reserved"] for row in rows if row["reserved"]}
+
+
+def committed_for(order):
+    """{product_id: quantity} the ledger has taken off stock for the order and not put back."""
+    rows = StockMovement.objects.filter(order=order).values("product_id").annotate(taken=Sum("amount_change"))
+    return {row["product_id"]: -row["taken"] for row in rows if row["taken"]}
+
+
+def _per_product(quantities):
+    return Case(
+        *[When(pk=product_id, then=Value(quantity)) for product_id, quantity in quantities.items()],
+        default=Value(0.0),
+        output_field=FloatField(),
+    )
+
+
+def move(kind, amount_changes=None, reserved_changes=None, order=None, only_if_available=False):
+    """Applies the changes ({product_id: quantity}) to Product.amount/reserved with one UPDATE and
+    writes them to the ledger. With ``only_if_available`` nothing changes unless every product has
+    enough free stock for its reserved change. Returns whether the changes were applied.
+    """
+    amount_changes = {key: value for key, value in (amount_changes or {}).items() if value}
+    reserved_changes = {key: value for key, value in (reserved_changes or {}).items() if value}
+    product_ids = amount_changes.keys() | reserved_changes.keys()
+    if not product_ids:
+        return True
+
+    updates = {}
+    if amount_changes:
+        updates["amount"] = F("amount") + _per_product(amount_changes)
+    if reserved_changes:
+        updates["reserved"] = F("reserved") + _per_product(reserved_changes)
+
+    with transaction.atomic():
+        products = Product.objects.filter(pk__in=product_ids)
+        if only_if_available:
+            products = products.filter(Q(amount__gte=F("reserved") + _per_product(reserved_changes)))
+        if products.update(**updates) < len(product_ids):
+            transaction.set_rollback(True)
+            return False
+        StockMovement.objects.bulk_create([
+            StockMovement(
+                product_id=product_id,
+                order=order,
+                kind=kind,
+                amount_change=amount_changes.get(product_id, 0),
+                reserved_change=reserved_changes.get(product_id, 0),
+            )
+            for product_id in product_ids
+        ])
+        catalog.bump("stock_version")
+    return True
+
+
+def reserve(order):
+    """Reserves the order's items. Returns {product_id: available} of the products that don't have
+    enough free stock, in which case nothing is reserved."""
+    quantities = order_quantities(order)
+    if move(Kinds.RESERVE, reserved_changes=quantities, order=order, only_if_available=True):
+        return {}
+    available = Product.objects.filter(pk__in=quantities).values_list("pk", F("amount") - F("reserved"))
+    return {product_id: free for product_id, free in available if free < quantities[product_id]}
+
+
+def release(order):
+    """Gives back whatever is still reserved for the order."""
+    reserved = reserved_for(order)
+    move(Kinds.RELEASE, reserved_changes={key: -value for key, value in reserved.items()}, order=order)
+    return reserved
+
+
+def commit(order):
+    """Takes the order's items off stock and drops their reservation. Orders placed before
+    reservations existed have none, they are taken off stock all the same."""
+    quantities = order_quantities(order)
+    move(
+        Kinds.COMMIT,
+        amount_changes={key: -value for key, value in quantities.items()},
+        reserved_changes={key: -value for key, value in reserved_for(order).items()},
+        order=order,
+    )
+    return quantities
+
+
+def restock(order):
+    """Puts back what commit() took off stock, for an order cancelled after the storekeeper's approval."""
+    taken = committed_for(order)
+    move(Kinds.RESTOCK, amount_changes=taken, order=order)
+    return taken
+
+
+def adjust(product_id, quantity):
+    """Manual correction of a product's amount, e.g. after a stock count."""
+    move(Kinds.ADJUST, amount_changes={product_id: quantity})
@@ -1,3 +1,794 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import json
+import re
+import random
+import tempfile
+import unittest
+from unittest import mock
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from decimal import Decimal
+from io import BytesIO
+from pathlib import Path
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib import admin
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import InMemoryStorage
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.http import Http404, HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+from fastapi import HTTPException
+from PIL import Image
+from telegram import Chat, Message, Update, User
+from telegram.error import RetryAfter
+from telegram.ext import CommandHandler, ConversationHandler
+from telegram.ext._utils.trackingdict import TrackingDict
+
+from bot import catalog, images, sla, staticfiles, stock
+from bot.admin import OrderItemTabularInline
+from bot.archive import FINAL_STATUSES, archivable
+from bot.conditional import catalog_conditional
+from bot.models import Area, ArchiveOrder, BotState, Category, CustomUser, Notification, Order, OrderEvent, OrderItem, \
+    ProcessedUpdate, Product, ProductPrice, SlaRollup, TelegramUser
+from bot.notifications import CLAIM_TIMEOUT, bot_ids, claim_due, dispatch
+from bot.search import TrigramIndex
+from bot.staticfiles import compress
+from bot.sender import NOTIFICATION, REPLY, RateLimiter, TelegramSender
+import serve
+from handlers.web import reserve_or_cancel
+from persistence import DjangoPersistence
+from utils import _user_cache, resolve_user
+
+# A table read from start to end, SQLite reports an index walk as "SCAN <table> USING [COVERING] INDEX ..."
+FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+
+
+@unittest.skipUnless(connection.vendor == "sqlite", "EXPLAIN QUERY PLAN is SQLite's")
+class HotQueryPlanTests(TestCase):
+    """Runs EXPLAIN QUERY PLAN on the queries the bot and the admin run most and fails when one of
+    them reads a whole table again."""
+
+    AREAS = 20
+    CLIENTS = 2000
+    AGENTS = 20
+    ORDERS = 3000
+    CATEGORIES = 10
+    PRODUCTS = 300
+    ARCHIVED_ORDERS = 10000
+    # The live table holds about the last month, finished orders older than that are archived
+    LIVE_DAYS = 45
+    ARCHIVE_AFTER_DAYS = 30
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(0)
+        cls.now = timezone.now()
+        areas = Area.objects.bulk_create([Area(name=f"Area {i}") for i in range(cls.AREAS)])
+        users = TelegramUser.objects.bulk_create(
+            [TelegramUser(telegram_id=f"client-{i}", first_name=f"Client {i}", tin=str(300000000 + i))
+             for i in range(cls.CLIENTS)]
+            + [TelegramUser(telegram_id=f"agent-{i}", first_name=f"Agent {i}", is_agent=True) for i in range(cls.AGENTS)]
+        )
+        clients, agents = users[:cls.CLIENTS], users[cls.CLIENTS:]
+        TelegramUser.territory.through.objects.bulk_create([
+            TelegramUser.territory.through(telegramuser_id=user.pk, area_id=rng.choice(areas).pk) for user in users
+        ])
+
+        open_statuses = [status for status in Order.OrderStatus.values if status not in FINAL_STATUSES]
+        orders = Order.objects.bulk_create([
+            Order(user=rng.choice(clients), agent=rng.choice(agents), status=rng.choice(Order.OrderStatus.values))
+            for _ in range(cls.ORDERS)
+        ])
+        # created_at is auto_now_add, spread the orders over the last weeks behind its back
+        for order in orders:
+            order.created_at = cls.now - timedelta(minutes=rng.randrange(cls.LIVE_DAYS * 24 * 60))
+            if order.created_at < cls.now - timedelta(days=cls.ARCHIVE_AFTER_DAYS):
+                order.status = rng.choice(open_statuses)
+        Order.objects.bulk_update(orders, ["created_at", "status"], batch_size=500)
+        ArchiveOrder.objects.bulk_create([
+            ArchiveOrder(user=rng.choice(clients), agent=rng.choice(agents), status=rng.choice(FINAL_STATUSES),
+                         created_at=cls.now - timedelta(minutes=rng.randrange(365 * 24 * 60)))
+            for _ in range(cls.ARCHIVED_ORDERS)
+        ])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product_id=rng.randrange(1, 300), product_name="Product", qty=Decimal(2),
+                      price_uzs=Decimal(1000))
+            for order in orders for _ in range(rng.randrange(1, 6))
+        ])
+        OrderEvent.objects.bulk_create([
+            OrderEvent(order_id=order.pk, role=role, action=OrderEvent.Actions.APPROVE)
+            for order in orders for role in Order.APPROVERS[:rng.randrange(len(Order.APPROVERS) + 1)]
+        ])
+        Notification.objects.bulk_create([
+            Notification(chat_id=str(rng.randrange(1000)), text="Text",
+                         status=rng.choice(Notification.Statuses.values))
+            for _ in range(2000)
+        ])
+
+        categories = Category.objects.bulk_create([Category(title=f"Category {i}") for i in range(cls.CATEGORIES)])
+        products = Product.objects.bulk_create([
+            Product(title=f"Product {i}", description="", category=rng.choice(categories)) for i in range(cls.PRODUCTS)
+        ])
+        ProductPrice.objects.bulk_create([
+            ProductPrice(product=product, tier=tier, amount=rng.randrange(1000, 100000))
+            for product in products for tier in TelegramUser.UserCategory.values
+        ])
+
+        cls.category = categories[0]
+        cls.area_ids = [area.pk for area in areas[:3]]
+        cls.agent = agents[0]
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertNoFullScan(self, queryset):
+        plan = self.plan(queryset)
+        scans = [line for line in plan if FULL_SCAN.match(line)]
+        self.assertFalse(scans, "Full table scan in:\n" + "\n".join(plan))
+
+    def test_orders_by_status(self):
+        self.assertNoFullScan(Order.objects.filter(status=Order.OrderStatus.PENDING).order_by("-created_at")[:20])
+
+    def test_orders_by_statuses(self):
+        self.assertNoFullScan(Order.objects.filter(status__in=FINAL_STATUSES))
+
+    def test_orders_by_date_range(self):
+        self.assertNoFullScan(Order.objects.filter(created_at__range=(self.now - timedelta(days=30), self.now)))
+
+    def test_order_dates(self):
+        self.assertNoFullScan(Order.objects.dates("created_at", "month"))
+
+    def test_orders_of_agent(self):
+        self.assertNoFullScan(Order.objects.filter(agent=self.agent).order_by("-created_at"))
+
+    def test_clients_of_territories(self):
+        # handlers.web.fetch_clients
+        self.assertNoFullScan(TelegramUser.objects.filter(
+            Q(first_name__icontains="12") | Q(tin__icontains="12"),
+            territory__in=self.area_ids,
+            is_agent=False,
+            is_active=True,
+        ))
+
+    def test_agents(self):
+        self.assertNoFullScan(TelegramUser.objects.filter(is_agent=True).order_by("first_name"))
+
+    def test_client_by_tin(self):
+        self.assertNoFullScan(TelegramUser.objects.filter(tin="300000012"))
+
+    def test_items_of_product(self):
+        self.assertNoFullScan(OrderItem.objects.filter(product_id=12))
+
+    def test_events_of_orders(self):
+        # OrderEvent.attach for a changelist page
+        order_ids = Order.objects.order_by("-pk").values_list("pk", flat=True)[:20]
+        self.assertNoFullScan(OrderEvent.objects.filter(order_id__in=list(order_ids)).order_by("at", "pk"))
+
+    def test_due_notifications(self):
+        self.assertNoFullScan(Notification.objects.filter(
+            status=Notification.Statuses.PENDING,
+            next_attempt_at__lte=self.now,
+        ).order_by("id")[:100])
+
+    def test_archive_batch(self):
+        self.assertNoFullScan(archivable(self.now - timedelta(days=self.ARCHIVE_AFTER_DAYS))[:500])
+
+    def test_archive_by_date_range(self):
+        self.assertNoFullScan(ArchiveOrder.objects.filter(created_at__range=(self.now - timedelta(days=30), self.now)))
+
+    def test_category_prices(self):
+        # bot.catalog.products for the category page
+        queryset = Product.objects.priced(TelegramUser.UserCategory.C).filter(category=self.category)
+        self.assertNoFullScan(queryset)
+        self.assertIn("USING COVERING INDEX productprice_covering", "\n".join(self.plan(queryset)))
+
+    def test_detects_full_scan(self):
+        self.assertRaises(AssertionError, self.assertNoFullScan, Order.objects.filter(comment="x"))
+
+
+class TrigramIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = TrigramIndex({
+            1: "Молоко 3.2%",
+            2: "Сметана 20%",
+            3: "O'rik quritilgan",
+            4: "Ўрик",
+            5: "Масло сливочное",
+            6: "Хлеб белый",
+            7: "Молочный коктейль",
+        })
+
+    def test_prefix(self):
+        self.assertEqual(self.index.search("мол"), [1, 7])
+
+    def test_latin_finds_cyrillic(self):
+        self.assertEqual(self.index.search("smetana"), [2])
+        self.assertEqual(self.index.search("hleb"), [6])
+
+    def test_uzbek_spellings(self):
+        self.assertEqual(self.index.search("o‘rik"), [3, 4])
+        self.assertEqual(self.index.search("ўрик"), [3, 4])
+
+    def test_typos(self):
+        self.assertEqual(self.index.search("molko")[0], 1)
+        self.assertEqual(self.index.search("smetna"), [2])
+
+    def test_every_word_must_match(self):
+        self.assertEqual(self.index.search("масл слив"), [5])
+        self.assertEqual(self.index.search("молоко хлеб"), [])
+
+    def test_ranking(self):
+        self.assertEqual(self.index.search("molochn")[0], 7)
+
+    def test_regex_is_not_special(self):
+        self.assertEqual(self.index.search(".*"), [])
+
+
+class NotificationClaimTests(TestCase):
+    def setUp(self):
+        Notification.objects.bulk_create([Notification(chat_id=str(i), text="Text") for i in range(5)])
+
+    def test_claimed_once(self):
+        first = async_to_sync(claim_due)(3)
+        second = async_to_sync(claim_due)(10)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertFalse({n.pk for n in first} & {n.pk for n in second})
+        self.assertEqual(async_to_sync(claim_due)(10), [])
+
+    def test_abandoned_claim_is_taken_over(self):
+        claimed = async_to_sync(claim_due)(10)
+        Notification.objects.update(next_attempt_at=timezone.now() - CLAIM_TIMEOUT)
+        self.assertEqual(len(async_to_sync(claim_due)(10)), len(claimed))
+
+    def test_sent_through_the_agents_bot(self):
+        Notification.objects.all().delete()
+        BotState.objects.create(bot_id="111", kind=BotState.Kinds.USER, key="1", data={})
+        BotState.objects.create(bot_id="111", kind=BotState.Kinds.USER, key="2", data={})
+        # The agent wrote to the second bot since
+        BotState.objects.create(bot_id="222", kind=BotState.Kinds.USER, key="2", data={})
+        bots = bot_ids(["1", "2", "3"])
+        Notification.objects.bulk_create([
+            Notification(bot_id=bots.get(chat_id, ""), chat_id=chat_id, text="Text") for chat_id in ["1", "2", "3"]
+        ])
+        sent = {}
+
+        def fake_bot(bot_id):
+            async def send_message(chat_id, **kwargs):
+                sent[chat_id] = bot_id
+            return SimpleNamespace(send_message=send_message)
+
+        async_to_sync(dispatch)({"111": fake_bot("111"), "222": fake_bot("222")})
+        self.assertEqual(sent, {"1": "111", "2": "222", "3": "111"})
+        self.assertFalse(Notification.objects.exclude(status=Notification.Statuses.SENT).exists())
+
+
+class ReservationTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(title="Product", description="", amount=10)
+        self.order = Order.objects.create()
+        OrderItem.objects.create(order=self.order, product_id=self.product.pk, product_name="Product", qty=3,
+                                 price_uzs=1000)
+
+    def reserved(self):
+        self.product.refresh_from_db()
+        return self.product.reserved
+
+    def test_abandoned_order_releases_its_reservation(self):
+        self.assertEqual(stock.reserve(self.order), {})
+        self.assertEqual(self.reserved(), 3)
+        self.order.delete()
+        self.assertEqual(self.reserved(), 0)
+
+    def test_deleted_in_bulk(self):
+        stock.reserve(self.order)
+        Order.objects.filter(pk=self.order.pk).delete()
+        self.assertEqual(self.reserved(), 0)
+
+    def test_reserved_when_the_order_is_finished(self):
+        self.assertIsNone(async_to_sync(reserve_or_cancel)(self.order))
+        self.assertEqual(self.reserved(), 3)
+        other = Order.objects.create()
+        OrderItem.objects.create(order=other, product_id=self.product.pk, product_name="Product", qty=8, price_uzs=1000)
+        self.assertIn("Product - в наличии 7", async_to_sync(reserve_or_cancel)(other))
+        self.assertFalse(Order.objects.filter(pk=other.pk).exists())
+        self.assertEqual(self.reserved(), 3)
+
+    def test_item_inline_reads_free_stock_with_the_items(self):
+        stock.reserve(self.order)
+        request = RequestFactory().get("/admin/")
+        request.user = SimpleNamespace(has_perm=lambda perm, obj=None: True)
+        items = list(OrderItemTabularInline(Order, admin.site).get_queryset(request).filter(order=self.order))
+        with self.assertNumQueries(0):
+            self.assertEqual([item.get_real_qty() for item in items], ["7.0 dona"])
+
+    def test_cancelled_after_storekeeper_approval_is_restocked(self):
+        for name in ("cancel", "storekeeper_cancel"):
+            with self.subTest(name):
+                stock.reserve(self.order)
+                self.order.status = Order.OrderStatus.APPROVED_BY_DIRECTOR
+                Order.objects.filter(pk=self.order.pk).update(status=self.order.status)
+                self.assertTrue(self.order.transition("storekeeper_approve"))
+                self.product.refresh_from_db()
+                self.assertEqual((self.product.amount, self.product.reserved), (7, 0))
+                self.assertTrue(self.order.transition(name))
+                self.product.refresh_from_db()
+                self.assertEqual((self.product.amount, self.product.reserved), (10, 0))
+
+
+class OrderTotalsTests(TestCase):
+    def setUp(self):
+        self.order = Order.objects.create()
+        self.other = Order.objects.create()
+        OrderItem.objects.bulk_create([
+            OrderItem(order=self.order, product_name="A", qty=Decimal(2), price_uzs=Decimal(1000)),
+            OrderItem(order=self.order, product_name="B", qty=Decimal(1), price_uzs=Decimal(500)),
+        ])
+
+    def assertTotals(self, order, total, count):
+        order.refresh_from_db()
+        self.assertEqual((order.total_uzs, order.item_count), (Decimal(total), count))
+
+    def test_queryset_delete(self):
+        OrderItem.objects.filter(product_name="A").delete()
+        self.assertTotals(self.order, 500, 1)
+
+    def test_queryset_update(self):
+        OrderItem.objects.filter(product_name="B").update(qty=Decimal(3), price_uzs=Decimal(100))
+        self.assertTotals(self.order, 2300, 2)
+
+    def test_moved_to_another_order(self):
+        OrderItem.objects.filter(product_name="A").update(order=self.other)
+        self.assertTotals(self.order, 500, 1)
+        self.assertTotals(self.other, 2000, 1)
+
+
+class ArchiveAdminTests(TestCase):
+    def test_read_only_for_superusers(self):
+        user = CustomUser(username="admin", password="password", is_superuser=True)
+        user.save()
+        self.client.force_login(user)
+        order = ArchiveOrder.objects.create(comment="Archived", created_at=timezone.now())
+        url = reverse("admin:bot_archiveorder_change", args=[order.pk])
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.post(url, {"comment": "Changed"}).status_code, 403)
+        self.assertEqual(self.client.get(reverse("admin:bot_archiveorder_add")).status_code, 403)
+        order.refresh_from_db()
+        self.assertEqual(order.comment, "Archived")
+
+
+class TransitionTests(TestCase):
+    def test_stale_copy_is_rejected(self):
+        order = Order.objects.create()
+        first, second = Order.objects.get(pk=order.pk), Order.objects.get(pk=order.pk)
+        self.assertTrue(first.transition("rop_approve"))
+        # Still PENDING in memory, the UPDATE no longer matches
+        self.assertFalse(second.transition("rop_cancel"))
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.OrderStatus.APPROVED_BY_ROP)
+        self.assertEqual([(event.role, event.action) for event in order.events], [("rop", "approve")])
+
+
+class NumericItemsMigrationTests(SimpleTestCase):
+    def test_to_decimal(self):
+        to_decimal = importlib.import_module("bot.migrations.0053_numeric_order_items").to_decimal
+        self.assertEqual(to_decimal("12 000,5"), Decimal("12000.50"))
+        self.assertEqual(to_decimal(""), Decimal("0.00"))
+        self.assertEqual(to_decimal(None), Decimal("0.00"))
+        # Left for the migration to report instead of becoming 0
+        self.assertIsNone(to_decimal("2 шт"))
+        self.assertIsNone(to_decimal("NaN"))
+
+
+class PlacedAtTests(TestCase):
+    def test_admin_save_keeps_the_placement_time(self):
+        placed_at = timezone.now() - timedelta(hours=1)
+        order = Order.objects.create()
+        Order.objects.filter(pk=order.pk).update(created_at=placed_at)
+        order = Order.objects.get(pk=order.pk)
+        # OrderAdmin.save_order saves the form before the transition
+        order.save()
+        order.transition("rop_approve")
+        order.refresh_from_db()
+        self.assertEqual(order.created_at, placed_at)
+        [(event, seconds)] = sla.latencies(order)
+        self.assertGreaterEqual(seconds, 3600)
+
+
+class SlaRecordTests(TestCase):
+    def test_one_row_per_bucket(self):
+        for _ in range(2):
+            Order.objects.create().transition("rop_approve")
+        self.assertEqual(list(SlaRollup.objects.filter(period=SlaRollup.Periods.HOUR).values_list("count", flat=True)),
+                         [2])
+
+    def test_duplicate_row_is_rejected(self):
+        key = {"period": SlaRollup.Periods.DAY, "start": timezone.now(), "role": "rop", "bucket": 0}
+        SlaRollup.objects.create(**key, count=1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            SlaRollup.objects.create(**key, count=1)
+
+
+class CatalogConditionalTests(TestCase):
+    """The ETags of the webapp pages, decorated the way bot.views decorates the list and the detail page."""
+
+    def setUp(self):
+        catalog._current = None
+        self.factory = RequestFactory()
+        self.product = Product.objects.create(title="Product", description="", amount=10)
+        self.list_view = catalog_conditional("list", "webapp.html")(lambda request: HttpResponse("list"))
+        self.detail_view = catalog_conditional("detail", "single.html", stock=True)(lambda request: HttpResponse("detail"))
+
+    def get(self, view, headers=None, **params):
+        return view(self.factory.get("/webapp/", params, **(headers or {})))
+
+    def etag(self, view, **params):
+        return self.get(view, **params)["ETag"]
+
+    def test_not_modified(self):
+        etag = self.etag(self.list_view)
+        response = self.get(self.list_view, {"HTTP_IF_NONE_MATCH": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertIn("no-cache", response["Cache-Control"])
+
+    def test_product_save_changes_etag(self):
+        etag = self.etag(self.list_view)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        self.assertNotEqual(self.etag(self.list_view), etag)
+        self.assertEqual(self.get(self.list_view, {"HTTP_IF_NONE_MATCH": etag}).status_code, 200)
+
+    def test_etag_per_tier(self):
+        self.assertNotEqual(self.etag(self.list_view, cate="a"), self.etag(self.list_view, cate="c"))
+        self.assertEqual(self.etag(self.list_view, cate="c"), self.etag(self.list_view, cate="c"))
+
+    def test_stock_changes_only_detail(self):
+        list_etag, detail_etag = self.etag(self.list_view), self.etag(self.detail_view)
+        with self.captureOnCommitCallbacks(execute=True):
+            stock.adjust(self.product.pk, 5)
+        self.assertEqual(self.etag(self.list_view), list_etag)
+        self.assertNotEqual(self.etag(self.detail_view), detail_etag)
+
+
+class CatalogPageTests(TestCase):
+    def setUp(self):
+        # Every test starts at the same catalog version, the lists cached by the others would be read
+        catalog._current = None
+        cache.clear()
+
+    def pages(self, items, size, by_pk=True):
+        pages, cursor = [], None
+        while True:
+            chunk, cursor = catalog.page(items, cursor, size, by_pk)
+            pages.append([item.pk for item in chunk])
+            if cursor is None:
+                return pages
+
+    def test_pages(self):
+        items = [SimpleNamespace(pk=pk) for pk in range(1, 6)]
+        self.assertEqual(self.pages(items, 2), [[1, 2], [3, 4], [5]])
+
+    def test_deleted_cursor_product(self):
+        items = [SimpleNamespace(pk=pk) for pk in (1, 2, 3, 4, 5)]
+        chunk, cursor = catalog.page(items, None, 2)
+        del items[1]
+        self.assertEqual([item.pk for item in catalog.page(items, cursor, 2)[0]], [3, 4])
+
+    def test_search_results_keep_their_order(self):
+        ranked = [SimpleNamespace(pk=pk) for pk in (5, 3, 9, 1, 7)]
+        self.assertEqual(self.pages(ranked, 2, by_pk=False), [[5, 3], [9, 1], [7]])
+        chunk, cursor = catalog.page(ranked, None, 2, by_pk=False)
+        # The last product of the page is gone, the next page starts where it was rather than at pk > 3
+        del ranked[1]
+        self.assertEqual([item.pk for item in catalog.page(ranked, cursor, 2, by_pk=False)[0]], [9, 1])
+
+    def test_products_endpoint(self):
+        for i in range(3):
+            product = Product.objects.create(title=f"Product {i}", description="")
+            catalog.set_prices(product, {"a": 12000})
+        response = self.client.get("/webapp/products/", {"cate": "a", "size": 2})
+        first = response.json()
+        self.assertEqual([product["price"] for product in first["products"]], ["12\xa0000", "12\xa0000"])
+        second = self.client.get(first["next"]).json()
+        self.assertEqual(len(second["products"]), 1)
+        self.assertIsNone(second["next"])
+
+    def test_category_page_without_category_lists_all(self):
+        Product.objects.create(title="Product", description="")
+        response = self.client.get("/webapp/category/")
+        self.assertEqual(len(response.context["products"]), 1)
+
+
+class PersistenceTests(TestCase):
+    """Two DjangoPersistence instances stand for two worker processes of the same bot."""
+    KEY = (10, 20)
+
+    def setUp(self):
+        self.update = Update(1, message=Message(1, datetime.now(), Chat(10, "private"), from_user=User(20, "A", False),
+                                                text="/start"))
+
+    def handler(self):
+        handler = ConversationHandler([CommandHandler("start", lambda update, context: 1)], {1: []}, [],
+                                      name="order_handler", persistent=True)
+        # What Application.initialize() sets up
+        handler._conversations = TrackingDict()
+        return handler
+
+    async def write(self, persistence, state):
+        await persistence.update_conversation("order_handler", self.KEY, state)
+        await persistence.flush()
+
+    async def test_state_moves_between_processes(self):
+        first, second = DjangoPersistence("1"), DjangoPersistence("1")
+        handler = self.handler()
+        application = SimpleNamespace(handlers={0: [handler]})
+        await self.write(first, 3)
+        await second.sync_conversations(application, self.update)
+        self.assertEqual(handler._conversations[self.KEY], 3)
+        # Read through, no cache in between
+        await self.write(first, 4)
+        await second.sync_conversations(application, self.update)
+        self.assertEqual(handler._conversations[self.KEY], 4)
+
+    async def test_unwritten_local_state_is_kept(self):
+        first, second = DjangoPersistence("1"), DjangoPersistence("1")
+        handler = self.handler()
+        application = SimpleNamespace(handlers={0: [handler]})
+        await self.write(first, 3)
+        await second.sync_conversations(application, self.update)
+        handler._conversations[self.KEY] = 5
+        await second.sync_conversations(application, self.update)
+        self.assertEqual(handler._conversations[self.KEY], 5)
+
+    async def test_write_through(self):
+        persistence = DjangoPersistence("1", flush_delay=60)
+
+        async def update_persistence():
+            await persistence.update_conversation("order_handler", self.KEY, 2)
+
+        await persistence.write_through(SimpleNamespace(update_persistence=update_persistence))
+        self.assertEqual(await BotState.objects.filter(kind=BotState.Kinds.CONVERSATION).acount(), 1)
+
+    def test_cache_is_bounded(self):
+        persistence = DjangoPersistence("1", cache_size=2)
+        for key in range(3):
+            persistence._remember((BotState.Kinds.USER, "", str(key)), {})
+        self.assertEqual(list(persistence._cache), [(BotState.Kinds.USER, "", "1"), (BotState.Kinds.USER, "", "2")])
+
+
+class UserCacheTests(TestCase):
+    def setUp(self):
+        catalog._current = None
+        _user_cache.clear()
+        self.telegram_user = SimpleNamespace(id=42, username="agent", first_name="First", last_name="Last")
+
+    def resolve(self):
+        return async_to_sync(resolve_user)(self.telegram_user)
+
+    def test_cached_user_costs_no_query(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.resolve()
+        # Read again once, the creation bumped the users version
+        self.resolve()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.resolve().first_name, "First")
+
+    def test_admin_change_is_seen(self):
+        self.resolve()
+        user = TelegramUser.objects.get(telegram_id="42")
+        user.category = "c"
+        with self.captureOnCommitCallbacks(execute=True):
+            user.save()
+        # As seen by another process once its versions are read again
+        catalog._current = None
+        self.assertEqual(self.resolve().category, "c")
+
+    def test_saves_only_changes(self):
+        self.resolve()
+        self.telegram_user.username = "renamed"
+        self.resolve()
+        self.assertEqual(TelegramUser.objects.get(telegram_id="42").username, "renamed")
+
+    def test_save_does_not_wait_for_telegram(self):
+        # The message about the saved user is queued for dispatch_notifications
+        self.resolve()
+        self.assertTrue(Notification.objects.filter(text__contains="name First").exists())
+
+
+class TelegramSenderTests(SimpleTestCase):
+    def setUp(self):
+        self.sender = TelegramSender(global_rate=1000, chat_rate=1, chat_burst=3,
+                                     priority_rates={REPLY: 1000, NOTIFICATION: 500})
+
+    def test_chat_burst(self):
+        delays = [self.sender.try_acquire("1")[0] for _ in range(4)]
+        self.assertLess(max(delays[:3]), 0.05)
+        self.assertAlmostEqual(delays[3], 1, delta=0.05)
+        # Other chats are only held back by the global rate
+        self.assertLess(self.sender.try_acquire("2")[0], 0.05)
+
+    def test_notification_waits_for_replies(self):
+        sender = TelegramSender(global_rate=10, priority_rates={REPLY: 10, NOTIFICATION: 10})
+        self.assertEqual(sender.try_acquire("1")[1], True)
+        delay, booked = sender.try_acquire("2", NOTIFICATION)
+        self.assertFalse(booked)
+        self.assertAlmostEqual(delay, 0.1, delta=0.05)
+        # Nothing was booked, the next reply is not pushed back
+        self.assertAlmostEqual(sender.try_acquire("3")[0], 0.1, delta=0.05)
+
+    def test_retry_after_holds_the_chat_back(self):
+        self.sender.retry_after("1", 5)
+        self.assertAlmostEqual(self.sender.try_acquire("1")[0], 5, delta=0.05)
+        self.assertLess(self.sender.try_acquire("2")[0], 0.05)
+
+    def test_retry_after_without_chat_sleeps(self):
+        calls = []
+
+        async def callback():
+            calls.append(None)
+            if len(calls) == 1:
+                raise RetryAfter(3)
+            return True
+
+        limiter = RateLimiter("test-retry-after")
+        with mock.patch("bot.sender.asyncio.sleep", new=mock.AsyncMock()) as sleep:
+            result = async_to_sync(limiter.process_request)(callback, (), {}, "answerCallbackQuery", {}, None)
+        self.assertTrue(result)
+        self.assertEqual(len(calls), 2)
+        sleep.assert_awaited_once_with(3)
+
+
+class WebhookDedupTests(TestCase):
+    """serve.handle_update with a fake application, the lanes are not worked on."""
+    token = "123:test"
+
+    def setUp(self):
+        self.application = SimpleNamespace(bot=None)
+        serve.applications[self.token] = self.application
+        serve.deduplicators[self.token] = serve.UpdateDeduplicator(100, 60)
+        serve.lanes[:] = [asyncio.Queue(maxsize=2)]
+
+    def tearDown(self):
+        serve.applications.pop(self.token)
+        serve.deduplicators.pop(self.token)
+        serve.lanes.clear()
+
+    def post(self, update_id):
+        async def json():
+            return {"update_id": update_id}
+        return async_to_sync(serve.handle_update)(SimpleNamespace(json=json), self.token)
+
+    def test_redelivery_is_dropped(self):
+        self.post(1)
+        self.post(1)
+        self.assertEqual(serve.lanes[0].qsize(), 1)
+
+    def test_redelivery_to_another_worker_is_dropped(self):
+        self.post(1)
+        # The other worker has never seen it
+        serve.deduplicators[self.token] = serve.UpdateDeduplicator(100, 60)
+        self.post(1)
+        self.assertEqual(serve.lanes[0].qsize(), 1)
+        self.assertEqual(ProcessedUpdate.objects.filter(bot_id="123", update_id=1).count(), 1)
+
+    def test_rejected_update_is_accepted_when_redelivered(self):
+        self.post(1)
+        self.post(2)
+        with self.assertRaises(HTTPException):
+            self.post(3)
+        self.assertFalse(ProcessedUpdate.objects.filter(update_id=3).exists())
+        serve.lanes[0].get_nowait()
+        self.post(3)
+        self.assertEqual(serve.lanes[0].qsize(), 2)
+
+    def test_old_claims_are_pruned(self):
+        self.post(1)
+        self.post(2)
+        ProcessedUpdate.objects.filter(update_id=1).update(received_at=timezone.now() - timedelta(days=2))
+        self.assertEqual(async_to_sync(serve.prune_updates)(24 * 60 * 60), 1)
+        self.assertEqual(list(ProcessedUpdate.objects.values_list("update_id", flat=True)), [2])
+
+
+class StaticServeTests(SimpleTestCase):
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.root = Path(root.name)
+        override = override_settings(STATIC_ROOT=root.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        content = b"console.log('app');" * 100
+        for name in ("app.js", "app.0123456789ab.js"):
+            (self.root / name).write_bytes(content)
+            (self.root / f"{name}.br").write_bytes(compress(content)["br"])
+            (self.root / f"{name}.gz").write_bytes(compress(content)["gzip"])
+        (self.root / "staticfiles.json").write_text(json.dumps(
+            {"paths": {"app.js": "app.0123456789ab.js"}, "version": "1.1", "hash": "0123456789ab"}))
+
+    def get(self, path, **headers):
+        return staticfiles.serve(RequestFactory().get(f"/static/{path}", **headers), path)
+
+    def test_best_accepted_encoding(self):
+        for accepted, encoding in (("gzip, br", "br"), ("gzip, br;q=0", "gzip"), ("", None)):
+            with self.subTest(accepted):
+                response = self.get("app.js", HTTP_ACCEPT_ENCODING=accepted)
+                self.assertEqual(response.get("Content-Encoding"), encoding)
+                self.assertEqual(response["Vary"], "Accept-Encoding")
+                self.assertEqual(response["Cache-Control"], "no-cache")
+                response.close()
+
+    def test_fingerprinted_name_is_cached_for_good(self):
+        response = self.get("app.0123456789ab.js", HTTP_ACCEPT_ENCODING="br")
+        self.assertEqual(response["Cache-Control"], staticfiles.IMMUTABLE)
+        response.close()
+
+    def test_not_modified_keeps_vary(self):
+        modified = http_date((self.root / "app.js").stat().st_mtime)
+        response = self.get("app.js", HTTP_ACCEPT_ENCODING="br", HTTP_IF_MODIFIED_SINCE=modified)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["Vary"], "Accept-Encoding")
+        self.assertEqual(response["Cache-Control"], "no-cache")
+
+    def test_missing_file(self):
+        with self.assertRaises(Http404):
+            self.get("missing.js")
+
+
+class CoverDerivativeTests(TestCase):
+    def setUp(self):
+        catalog._current = None
+        cache.clear()
+        override = override_settings(STORAGES={
+            **settings.STORAGES, "default": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+        })
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def image(self, size=(800, 600), mode="RGB", name="milk.png"):
+        buffer = BytesIO()
+        Image.new(mode, size, (200, 30, 30, 128) if mode == "RGBA" else (200, 30, 30)).save(buffer, "PNG")
+        return ContentFile(buffer.getvalue(), name)
+
+    def test_generate(self):
+        storage = InMemoryStorage()
+        storage.save("products/milk.png", self.image(mode="RGBA"))
+        self.assertEqual(images.generate("products/milk.png", storage), [120, 240, 360, 540])
+        with storage.open("products/derivatives/milk.png-240.webp") as file:
+            webp = Image.open(file)
+            self.assertEqual((webp.format, webp.size, webp.mode), ("WEBP", (240, 180), "RGBA"))
+        with storage.open("products/derivatives/milk.png-240.jpg") as file:
+            jpeg = Image.open(file)
+            self.assertEqual((jpeg.format, jpeg.mode), ("JPEG", "RGB"))
+
+    def test_small_image_is_not_enlarged(self):
+        storage = InMemoryStorage()
+        storage.save("products/milk.png", self.image(size=(100, 50)))
+        self.assertEqual(images.generate("products/milk.png", storage), [100])
+
+    def test_saved_cover_reaches_the_cached_catalog(self):
+        product = Product.objects.create(title="Milk", description="")
+        self.assertIsNone(catalog.products("a")[0].cover_sources)
+        product.cover = self.image()
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        [cached] = catalog.products("a")
+        self.assertEqual(cached.cover_derivatives["widths"], [120, 240, 360, 540])
+        self.assertIn("derivatives/", cached.cover_sources["src"])
+        # Made again on their own (cover_derivatives command), they invalidate the catalog too
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertTrue(images.refresh(product, force=True))
+        self.assertEqual(len(callbacks), 1)
 
-# Create your tests here.
@@ -1,18 +1,9 @@
-import requests
-
 BOT_TOKEN = "7579963454:AAHeUGjThsYobNytNQR334LrR3lh2R96DDk"
+ADMIN_CHAT_ID = "631751797"
 
-def send_telegram_message(text):
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    data = {
-        "chat_id": 631751797,
-        "text": text,
-        "parse_mode": 'HTML'
-    }
-    try:
-        response = requests.post(url, data=data, timeout=10)
-        response.raise_for_status()
-        print(f"Message send successfully: {response.json()}")
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to send Telegram message: {e}")
 
+def send_telegram_message(text):
+    """Queues the text for the admin chat. dispatch_notifications sends it within Telegram's limits,
+    so model saves never wait for the rate limiter or the network."""
+    from bot.models import Notification
+    Notification.objects.create(bot_id=BOT_TOKEN.split(":")[0], chat_id=ADMIN_CHAT_ID, text=text)
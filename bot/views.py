@@ -1,77 +1,122 @@
 from typing import Any
-from django.db.models.query import QuerySet
-from django.views.generic import TemplateView, ListView, DetailView
-from bot.models import Product, Category, TelegramUser
-from django.db.models import Q
+from urllib.parse import urlencode
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, JsonResponse
+from django.template.defaultfilters import floatformat
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.views.generic import TemplateView, ListView, DetailView, View
+from bot import catalog, metrics, search
+from bot.conditional import catalog_conditional, catalog_hit_rates, request_tier
+from bot.models import Product, Category
+
+
+def int_param(value, default=None):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def cursor_param(value):
+    """(pk, position) of a "pk.position" cursor, position None in the cursors of older pages."""
+    pk, _, position = (value or "").partition(".")
+    pk = int_param(pk)
+    return None if pk is None else (pk, int_param(position))
+
+
+def catalog_products(tier, category=None, query=None):
+    """Products of the webapp pages priced for the tier: of a category, matching a search or all."""
+    products = catalog.products(tier, category)
+    if not query:
+        return products
+    by_pk = {product.pk: product for product in products}
+    return [by_pk[pk] for pk in search.products(query) if pk in by_pk]
+
+
+class CatalogMixin:
+    """Prices come from the per tier catalog cache, see bot.catalog. Pages show the first
+    catalog.PAGE_SIZE products, the rest is loaded while scrolling from WebAppProductsView."""
+    # GET parameters the next pages keep
+    page_params = ("user_id", "cate", "preview", "cat", "q")
+
+    @property
+    def tier(self):
+        return request_tier(self.request)
+
+    @property
+    def category(self):
+        """Category id of ``?cat=``, None (all products) without one."""
+        category = self.request.GET.get("cat")
+        return None if category is None else int_param(category, 0)
+
+    def paginate(self, products):
+        after = cursor_param(self.request.GET.get("after"))
+        size = min(max(int_param(self.request.GET.get("size"), catalog.PAGE_SIZE), 1), catalog.MAX_PAGE_SIZE)
+        # Search results are in rank order, the other lists in pk order
+        products, cursor = catalog.page(products, after, size, by_pk=not self.request.GET.get("q"))
+        self.next_url = None
+        if cursor is not None:
+            params = {name: self.request.GET[name] for name in self.page_params if name in self.request.GET}
+            after = "%s.%s" % cursor
+            self.next_url = f"{reverse('products')}?{urlencode({**params, 'after': after, 'size': size})}"
+        return products
+
+    def get_context_data(self, **kwargs: Any):
+        context = super().get_context_data(**kwargs)
+        context['user_id'] = self.request.GET.get("user_id", None)
+        context['cate'] = self.request.GET.get("cate", "a")
+        context['preview'] = self.request.GET.get("preview") == "1"
+        context['prev_val'] = self.request.GET.get("preview")
+        context['next_url'] = getattr(self, "next_url", None)
+        return context
 
 
-class WebAppTemplateView(ListView):
+@method_decorator(catalog_conditional("list", "webapp.html"), name="dispatch")
+class WebAppTemplateView(CatalogMixin, ListView):
     model = Product
     context_object_name = "products"
     template_name = 'webapp.html'
 
     def get_queryset(self):
-        queryset = super().get_queryset()
-        query = self.request.GET.get('q')
-        user_id = self.request.GET.get("user_id", None)
-
-        if query:
-            search_term = str(query).lower()  # Ensure the search term is lowercase
-            queries = [
-                Q(**{f"title__icontains": search_term}) |
-                Q(**{f"title__iregex": f"(?i){search_term}"})
-            ]
-            queryset = queryset.filter(*queries)
-
-        if user_id and user_id != "None":
-            category = TelegramUser.objects.get(pk=user_id).category
-
-            if category:
-                queryset = queryset.extra(
-                    select={
-                        'price_uzs': f'price_uzs_{category}',
-                        'price_usd': f'price_usd_{category}'
-                    }
-                )
-
-            else:
-                queryset = queryset.extra(
-                    select={
-                        'price_uzs': f'price_uzs_a',
-                        'price_usd': f'price_usd_a'
-                    }
-                )
-
-        else:
-            queryset = queryset.extra(
-                select={
-                    'price_uzs': f'price_uzs_a',
-                    'price_usd': f'price_usd_a'
-                }
-            )
-
-        cat = self.request.GET.get("cate", None)
-        if cat and (not user_id or user_id == "None"):
-            queryset = queryset.extra(
-                select={
-                    'price_uzs': f'price_uzs_{cat}',
-                    'price_usd': f'price_usd_{cat}'
-                }
-            )
-
-        return queryset
+        return self.paginate(catalog_products(self.tier, query=self.request.GET.get('q')))
 
     def get_context_data(self, **kwargs: Any):
         context = super().get_context_data(**kwargs)
-        context['user_id'] = self.request.GET.get("user_id", None)
-        context['cate'] = self.request.GET.get("cate", "a")
-        context['preview'] = self.request.GET.get("preview") == "1"
-        context['categories'] = Category.objects.all()
-        context['top'] = Product.objects.filter(is_top=True)
-        context['prev_val'] = self.request.GET.get("preview")
+        context['categories'] = catalog.categories()
         return context
 
 
+@method_decorator(catalog_conditional("products"), name="dispatch")
+class WebAppProductsView(CatalogMixin, View):
+    """Next pages of the webapp's product lists as JSON, with only what the product cards show."""
+
+    def get(self, request, *args, **kwargs):
+        products = self.paginate(catalog_products(self.tier, self.category, request.GET.get("q")))
+        link = urlencode({
+            "user_id": request.GET.get("user_id"),
+            "cate": request.GET.get("cate", "a"),
+            "preview": request.GET.get("preview"),
+        })
+        return JsonResponse({
+            "products": [
+                {
+                    "id": product.pk,
+                    "title": product.title,
+                    # Formatted like the cards of the pages, whole sums with the locale's grouping
+                    "price": floatformat(product.price_uzs, "0g"),
+                    "cover": product.cover.url if product.cover else static("assets/png/picture.png"),
+                    # {"webp": srcset, "jpg": srcset, "src": url} of the smaller copies, null without them
+                    "cover_sources": product.cover_sources,
+                    "url": f"{reverse('detail', args=[product.pk])}?{link}",
+                }
+                for product in products
+            ],
+            "next": self.next_url,
+        })
+
+
 class WebAppHomePage(ListView):
     model = Product
     context_object_name = "products"
@@ -81,13 +126,7 @@ class WebAppHomePage(ListView):
         queryset = super().get_queryset().filter(is_top=False)
         query = self.request.GET.get('q')
         if query:
-            search_term = str(query).lower()  # Ensure the search term is lowercase
-            queries = [
-                Q(**{f"title__icontains": search_term}) |
-                Q(**{f"title__iregex": f"(?i){search_term}"})
-            ]
-            print(queries)
-            queryset = queryset.filter(*queries)
+            queryset = queryset.filter(pk__in=search.products(query))
         return queryset
 
     def get_context_data(self, **kwargs: Any):
@@ -98,120 +137,35 @@ class WebAppHomePage(ListView):
         return context
 
 
-class WebAppCategoryPage(ListView):
+@method_decorator(catalog_conditional("category", "category.html"), name="dispatch")
+class WebAppCategoryPage(CatalogMixin, ListView):
     model = Product
     context_object_name = "products"
     template_name = "category.html"
 
-    def get_queryset(self) -> QuerySet[Any]:
-        category = self.request.GET.get("cat")
-        queryset = super().get_queryset().filter(category_id=category)
-        user_id = self.request.GET.get("user_id", None)
-
-        if user_id and user_id != "None":
-            category = TelegramUser.objects.get(pk=user_id).category
-
-            if category:
-                queryset = queryset.extra(
-                    select={
-                        'price_uzs': f'price_uzs_{category}',
-                        'price_usd': f'price_usd_{category}'
-                    }
-                )
-            else:
-                queryset = queryset.extra(
-                    select={
-                        'price_uzs': f'price_uzs_a',
-                        'price_usd': f'price_usd_a'
-                    }
-                )
-
-        else:
-            queryset = queryset.extra(
-                select={
-                    'price_uzs': f'price_uzs_a',
-                    'price_usd': f'price_usd_a'
-                }
-            )
-
-        cat = self.request.GET.get("cate", None)
-        if cat and (not user_id or user_id == "None"):
-            queryset = queryset.extra(
-                select={
-                    'price_uzs': f'price_uzs_{cat}',
-                    'price_usd': f'price_usd_{cat}'
-                }
-            )
-
-        return queryset
-
-    def get_context_data(self, **kwargs: Any) -> dict[str, Any]:
-        context = super().get_context_data(**kwargs)
-        context['user_id'] = self.request.GET.get("user_id", None)
-        context['cate'] = self.request.GET.get("cate", "a")
-        context['preview'] = self.request.GET.get("preview") == "1"
-        context['prev_val'] = self.request.GET.get("preview")
-        return context
+    def get_queryset(self):
+        return self.paginate(catalog_products(self.tier, self.category))
 
 
-class WebAppDetailPage(DetailView):
+@method_decorator(catalog_conditional("detail", "single.html", stock=True), name="dispatch")
+class WebAppDetailPage(CatalogMixin, DetailView):
     template_name = "single.html"
     model = Product
 
     def get_object(self, queryset=None):
-        obj = super().get_object(queryset)
+        obj = catalog.product(self.tier, self.kwargs[self.pk_url_kwarg])
+        if obj is None:
+            raise Http404("No product found matching the query")
         if int(obj.set_amount) == 0:
             obj.set_amount = 1
         return obj
 
-    def get_queryset(self) -> QuerySet[Any]:
-        user_id = self.request.GET.get("user_id", None)
-        queryset = super().get_queryset()
-
-        if user_id and user_id != "None":
-            category = TelegramUser.objects.get(pk=user_id).category
-
-            if category:
-                queryset = queryset.extra(
-                    select={
-                        'price_uzs': f'price_uzs_{category}',
-                        'price_usd': f'price_usd_{category}'
-                    }
-                )
-            else:
-                queryset = queryset.extra(
-                    select={
-                        'price_uzs': f'price_uzs_a',
-                        'price_usd': f'price_usd_a'
-                    }
-                )
-
-        else:
-            queryset = queryset.extra(
-                select={
-                    'price_uzs': f'price_uzs_a',
-                    'price_usd': f'price_usd_a'
-                }
-            )
-
-        cat = self.request.GET.get("cate", None)
-        if cat and (not user_id or user_id == "None"):
-            queryset = queryset.extra(
-                select={
-                    'price_uzs': f'price_uzs_{cat}',
-                    'price_usd': f'price_usd_{cat}'
-                }
-            )
-        return queryset
-
-    def get_context_data(self, **kwargs: Any) -> dict[str, Any]:
-        context = super().get_context_data(**kwargs)
-        context['user_id'] = self.request.GET.get("user_id", None)
-        context['cate'] = self.request.GET.get("cate", "a")
-        context['preview'] = self.request.GET.get("preview") == "1"
-        context['prev_val'] = self.request.GET.get("preview")
-        return context
-
 
 class WebAppCartPage(TemplateView):
     template_name = "app/product-backet.html"
+
+
+@staff_member_required
+def webapp_metrics(request):
+    """Metrics of this process with the conditional GET hit rates of the catalog pages."""
+    return JsonResponse({**metrics.snapshot(), "conditional_get": catalog_hit_rates()})
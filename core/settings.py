@@ -179,6 +179,15 @@ STATICFILES_DIRS = (
     os.path.join(BASE_DIR, 'static'),
 )
 
+# collectstatic fingerprints the names and writes .br/.gz copies, bot.staticfiles.serve serves them
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'bot.staticfiles.CompressedManifestStaticFilesStorage'},
+}
+# Django serves STATIC_URL itself (with the .br/.gz copies) unless a web server in front of it does,
+# then set SERVE_STATIC=0 and point the server at STATIC_ROOT
+SERVE_STATIC = os.environ.get("SERVE_STATIC", "1" if DEBUG else "0") == "1"
+
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / "media"
 
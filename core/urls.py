@@ -1,8 +1,8 @@
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
-from bot import views, pdf_views, price_list
+from bot import views, pdf_views, price_list, staticfiles
 from django.conf import settings
 from django.conf.urls.static import static
 
@@ -21,6 +21,8 @@ urlpatterns = [
     # path('webapp/', views.WebAppHomePage.as_view(), name="list"),
     path("webapp/<int:pk>/", views.WebAppDetailPage.as_view(), name="detail"),
     path("webapp/category/", views.WebAppCategoryPage.as_view(), name="by_category"),
+    path("webapp/products/", views.WebAppProductsView.as_view(), name="products"),
+    path("webapp/metrics/", views.webapp_metrics, name="webapp_metrics"),
     path('pdf/', pdf_views.generate_pdf2_view, name='generate_pdf2'),
     path('pdf/<int:pk>/', pdf_views.generate_pdf_view, name='generate_pdf'),
     path('generate-multiple-pdfs/', pdf_views.generate_multiple_pdfs_view, name='generate_multiple_pdfs'),
@@ -37,7 +39,9 @@ urlpatterns = [
 
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-    urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
+
+if settings.SERVE_STATIC:
+    urlpatterns += [re_path(r'^%s(?P<path>.*)$' % settings.STATIC_URL.lstrip('/'), staticfiles.serve)]
 
 
 urlpatterns += [path('', admin.site.urls),]
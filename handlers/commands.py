@@ -1,3 +1,5 @@
+from asgiref.sync import sync_to_async
+
 from bot.utils import send_telegram_message
 from utils import get_user
 from telegram import ReplyKeyboardMarkup
@@ -24,7 +26,7 @@ async def start(update, context, user, *args):
 @get_user
 async def category(update, context, user, *args):
     text = f"/category user, {user}, is_agent ?: {user.is_agent}, id, {user.id}"
-    send_telegram_message(text)
+    await sync_to_async(send_telegram_message)(text)
     if not user.is_agent:
         return await start(update, context, user, *args)
     
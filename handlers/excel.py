@@ -1,6 +1,5 @@
 from telegram import Update, InputFile
 from telegram.ext import Application, CommandHandler, ContextTypes
-from openpyxl import Workbook
 from django.conf import settings
 from bot.models import Product  # Import your Product model
 import os
@@ -9,16 +8,11 @@ import asyncio
 
 @sync_to_async
 def fetch_products(cat):
-    # Use extra() to select dynamic fields for prices
-    return list(Product.objects.extra(
-        select={
-            'price_uzs': f'price_uzs_{cat}',
-            'price_usd': f'price_usd_{cat}'
-        }
-    ).values('id', 'title', 'price_uzs', 'price_usd'))
+    return list(Product.objects.priced(cat).values('id', 'title', 'price_uzs'))
 
 # Function to generate Excel file from Product data
 async def generate_excel_file(cat):
+    from openpyxl import Workbook
     from bot.models import TelegramUser
     file_name = TelegramUser.UserCategory(cat).label
 
@@ -3,6 +3,7 @@ from keyboards import replies, inlines
 import json
 from telegram import Update, ReplyKeyboardRemove
 from telegram.ext import CallbackContext
+from bot import stock
 from bot.models import TelegramUser, Order, OrderItem, Product
 import states
 from asgiref.sync import sync_to_async
@@ -13,6 +14,19 @@ from django.db.models import Q
 #     close_old_connections()
 #     return await sync_to_async(lambda: TelegramUser.objects.filter(territory__in=user.territory.all(), is_agent=False))()
 
+async def reserve_or_cancel(order):
+    """Reserves the stock of an order once the agent has finished it, so abandoned ones hold none.
+    Without enough stock the order is deleted and the message telling the agent is returned."""
+    short = await sync_to_async(stock.reserve)(order)
+    if not short:
+        return None
+    names = {item.product_id: item.product_name async for item in order.items.all()}
+    await order.adelete()
+    message = "Заказ отменен, недостаточно товара на складе:\n"
+    message += "\n".join(f"{names[product_id]} - в наличии {available:g}" for product_id, available in short.items())
+    return message
+
+
 async def fetch_clients(territories, search):
     # Wrap the ORM operation with sync_to_async
     return await sync_to_async(
@@ -70,7 +84,7 @@ async def web_app_data(update: Update, context: CallbackContext, user: TelegramU
 
     if order_items:
         await OrderItem.objects.abulk_create(order_items)
-    
+
     context.user_data["uncompleted_order_id"] = order.pk
     territories = await sync_to_async(user.territory.all)()
     clients = await fetch_clients(territories, search="")
@@ -182,17 +196,16 @@ async def get_payment(update: Update, context: CallbackContext, user:TelegramUse
     message += f"<b>Клиент:</b> {user.first_name} {user.last_name}\n"
     message += f"<b>Статус:</b> {order.get_status_display()}\n"
     message += "===================== \n\n"
-    total_sum_uzs = 0
     async for item in order.items.all().aiterator():
-        total_sum_uzs += float(item.qty) * float(item.price_uzs)
-
-        message += f"{item.product_name} - {item.qty} шт. {item.set_amount} блок\n"
+        message += f"{item.product_name} - {item.qty.normalize():f} шт. {item.set_amount.normalize():f} блок\n"
     message += "\n=====================\n"
-    message += f"<b>Общая сумма (UZS):</b> {total_sum_uzs:,}\n"
+    message += f"<b>Общая сумма (UZS):</b> {order.total_uzs:,}\n"
     
-    if total_sum_uzs > user.limit:
-        order.adelete()
+    if order.total_uzs > user.limit:
+        await order.adelete()
         message = "Заказ отменен, так как баланс клиента превысил лимит"
+    else:
+        message = await reserve_or_cancel(order) or message
     
     await update.callback_query.message.reply_text(message, reply_markup=replies.get_agent_main(), parse_mode="html")
     return -1
@@ -212,18 +225,17 @@ async def get_location(update: Update, context: CallbackContext, user:TelegramUs
         message += f"<b>Клиент:</b> {user.first_name} {user.last_name}\n"
         message += f"<b>Статус:</b> {order.get_status_display()}\n"
         message += "===================== \n\n"
-        total_sum_uzs = 0
         order = await Order.objects.aget(id=context.user_data['uncompleted_order_id'])
         async for item in order.items.all().aiterator():
-            total_sum_uzs += float(item.qty) * float(item.price_uzs)
-
-            message += f"{item.product_name} - {item.qty} шт. {item.set_amount} блок\n"
+            message += f"{item.product_name} - {item.qty.normalize():f} шт. {item.set_amount.normalize():f} блок\n"
         message += "\n=====================\n"
-        message += f"<b>Общая сумма (UZS):</b> {total_sum_uzs:,}\n"
+        message += f"<b>Общая сумма (UZS):</b> {order.total_uzs:,}\n"
 
-        if total_sum_uzs > user.limit:
-            order.adelete()
+        if order.total_uzs > user.limit:
+            await order.adelete()
             message = "Заказ отменен, так как баланс клиента превысил лимит"
+        else:
+            message = await reserve_or_cancel(order) or message
         
         await update.message.reply_text(message, reply_markup=replies.get_agent_main(), parse_mode="html")
         return -1
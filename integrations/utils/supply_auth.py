@@ -2,6 +2,8 @@ import requests
 import json
 from datetime import datetime, timedelta
 
+from bot.http_client import get_session
+
 # Base URL for all API calls
 BASE_URL = "https://apisupply.smartpos.uz"
 AUTH_ENDPOINT = "/api/cabinet/v1/account/login"
@@ -75,7 +77,7 @@ class SupplyAuthService:
         }
 
         try:
-            response = requests.post(url, data=json.dumps(payload), headers=headers)
+            response = get_session().post(url, data=json.dumps(payload), headers=headers)
             response.raise_for_status()  # Raise exception for non-200 status codes
 
             data = response.json()
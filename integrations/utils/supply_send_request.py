@@ -5,6 +5,8 @@ from datetime import datetime
 from typing import Dict, List, Optional, Tuple, Union, Any
 
 from django.db import transaction
+
+from bot.http_client import get_session
 from .supply_auth import SupplyAuthService, create_supply_auth_service
 
 # Base URL for all API calls
@@ -24,6 +26,9 @@ FACTURA_OUTGOING_ENDPOINT = "/api/integration/v1/1C/factura/outgoing"
 WAYBILL_INCOMING_ENDPOINT = "/api/integration/v1/1C/waybill/incoming"
 WAYBILL_OUTGOING_ENDPOINT = "/api/integration/v1/1C/waybill/outgoing"
 
+# Shared keep-alive session, also applies the default timeouts
+session = get_session()
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
@@ -90,7 +95,7 @@ def get_branches(
 
     try:
         # Make the request
-        response = requests.get(url, headers=headers)
+        response = session.get(url, headers=headers)
         response.raise_for_status()
 
         # Process response
@@ -134,7 +139,7 @@ def get_warehouses(
 
     try:
         # Make the request
-        response = requests.get(url, headers=headers)
+        response = session.get(url, headers=headers)
         response.raise_for_status()
 
         # Process response
@@ -224,7 +229,7 @@ def create_order(
     while retry_count < max_retries:
         try:
             # Make the request
-            response = requests.post(
+            response = session.post(
                 url,
                 headers=headers,
                 data=json.dumps(order_data)
@@ -371,7 +376,7 @@ def send_stock_in_to_1c(
     while retry_count < max_retries:
         try:
             # Make the request to Supply first
-            supply_response = requests.post(
+            supply_response = session.post(
                 supply_url,
                 headers=supply_headers,
                 data=json.dumps(stock_in_data)
@@ -380,7 +385,7 @@ def send_stock_in_to_1c(
             supply_response.raise_for_status()
 
             # If successful, now send to 1C
-            one_c_response = requests.post(
+            one_c_response = session.post(
                 one_c_url,
                 auth=one_c_auth,
                 headers=one_c_headers,
@@ -508,7 +513,7 @@ def get_facturas(
 
     try:
         # Make the request
-        response = requests.get(url, headers=headers)
+        response = session.get(url, headers=headers)
         response.raise_for_status()
 
         # Process response
@@ -590,7 +595,7 @@ def get_waybills(
 
     try:
         # Make the request
-        response = requests.get(url, headers=headers)
+        response = session.get(url, headers=headers)
         response.raise_for_status()
 
         # Process response
@@ -727,7 +732,7 @@ def get_receipts(
 
     try:
         # Make the request
-        response = requests.get(url, headers=headers)
+        response = session.get(url, headers=headers)
         response.raise_for_status()
 
         # Process response
@@ -782,7 +787,7 @@ def get_product_qty(
 
     try:
         # Make the request
-        response = requests.get(url, headers=headers)
+        response = session.get(url, headers=headers)
         response.raise_for_status()
 
         # Process response
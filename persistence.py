@@ -0,0 +1,250 @@
+import json
+import time
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+
+import telegram
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Q
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput
+
+from bot.models import BotState
+
+logger = logging.getLogger(__name__)
+
+Kinds = BotState.Kinds
+
+# PTB has no public way to get the conversation key of an update or to read and change one conversation
+# of a running handler. The functions below are the only places using its internals, they are
+# written against this version (pinned in requirements.txt) and switched off for any other
+PTB_VERSION = "20.3"
+
+
+def conversations_syncable(handler):
+    return (
+        telegram.__version__ == PTB_VERSION
+        and callable(getattr(handler, "_get_key", None))
+        and callable(getattr(getattr(handler, "_conversations", None), "update_no_track", None))
+    )
+
+
+def conversation_key(handler, update):
+    """The handler's key of the update's conversation, None when the update has none (e.g. no chat)."""
+    try:
+        return handler._get_key(update)
+    except RuntimeError:
+        return None
+
+
+def get_conversation(handler, key):
+    return handler._conversations.get(key)
+
+
+def set_conversation(handler, key, state):
+    # Not tracked, it is what the database holds already and must not be written back
+    handler._conversations.update_no_track({key: state})
+
+
+class DjangoPersistence(BasePersistence):
+    """Keeps user/chat/bot data and conversation states in the BotState table.
+
+    Writes are collected and flushed in one transaction shortly after the application hands them
+    over, or right away by :meth:`write_through`. User and chat data may be served from a per-key
+    cache for ``cache_ttl`` seconds (0, the default, reads them every time), conversation states are
+    always read from the database by :meth:`sync_conversations`. Together this lets several processes
+    serve the same bot.
+    """
+
+    def __init__(self, bot_id, update_interval=1, cache_ttl=0, flush_delay=0.2, cache_size=10000):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.bot_id = bot_id
+        self.cache_ttl = cache_ttl
+        self.flush_delay = flush_delay
+        self.cache_size = cache_size
+        # (kind, name, key) -> (data, loaded_at), data is what the database holds as far as we know.
+        # Least recently used first, at most cache_size entries
+        self._cache = OrderedDict()
+        # (kind, name, key) -> data, None deletes the row
+        self._pending = {}
+        self._flush_task = None
+        self._sync_unsupported_logged = False
+
+    @staticmethod
+    def _dump_key(key):
+        return json.dumps(key)
+
+    @staticmethod
+    def _load_key(key):
+        value = json.loads(key)
+        return tuple(value) if isinstance(value, list) else value
+
+    @sync_to_async
+    def _load_all(self, kind, name=""):
+        return list(BotState.objects.filter(bot_id=self.bot_id, kind=kind, name=name).values_list("key", "data"))
+
+    @sync_to_async
+    def _load_one(self, kind, name, key):
+        return BotState.objects.filter(bot_id=self.bot_id, kind=kind, name=name, key=key).values_list(
+            "data", flat=True).first()
+
+    @sync_to_async
+    def _load_conversations(self, cache_keys):
+        """{(kind, name, key): state} of the conversations, None for those without a row."""
+        states = dict.fromkeys(cache_keys)
+        query = Q()
+        for kind, name, key in cache_keys:
+            query |= Q(kind=kind, name=name, key=key)
+        for kind, name, key, data in BotState.objects.filter(query, bot_id=self.bot_id).values_list(
+                "kind", "name", "key", "data"):
+            states[(kind, name, key)] = data
+        return states
+
+    def _remember(self, cache_key, data):
+        self._cache[cache_key] = (data, time.monotonic())
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    @sync_to_async
+    def _write(self, pending):
+        upserts = [
+            BotState(bot_id=self.bot_id, kind=kind, name=name, key=key, data=data)
+            for (kind, name, key), data in pending.items() if data is not None
+        ]
+        deletes = [cache_key for cache_key, data in pending.items() if data is None]
+        with transaction.atomic():
+            if upserts:
+                BotState.objects.bulk_create(
+                    upserts,
+                    update_conflicts=True,
+                    unique_fields=["bot_id", "kind", "name", "key"],
+                    update_fields=["data", "updated_at"],
+                )
+            for kind, name, key in deletes:
+                BotState.objects.filter(bot_id=self.bot_id, kind=kind, name=name, key=key).delete()
+
+    def _stage(self, kind, name, key, data):
+        cache_key = (kind, name, self._dump_key(key))
+        self._pending[cache_key] = data
+        self._remember(cache_key, data)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        await self.flush()
+
+    async def _refresh(self, kind, key, data):
+        cache_key = (kind, "", self._dump_key(key))
+        if cache_key in self._pending:
+            return
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            known, loaded_at = cached
+            # Local changes that were not handed over yet must not be overwritten
+            if data != (known or {}):
+                return
+            if time.monotonic() - loaded_at < self.cache_ttl:
+                return
+        stored = await self._load_one(kind, "", cache_key[2])
+        self._remember(cache_key, stored)
+        if stored is not None and stored != data:
+            data.clear()
+            data.update(stored)
+
+    async def get_user_data(self):
+        return {self._load_key(key): data for key, data in await self._load_all(Kinds.USER)}
+
+    async def get_chat_data(self):
+        return {self._load_key(key): data for key, data in await self._load_all(Kinds.CHAT)}
+
+    async def get_bot_data(self):
+        rows = await self._load_all(Kinds.BOT)
+        return rows[0][1] if rows else {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {self._load_key(key): state for key, state in await self._load_all(Kinds.CONVERSATION, name)}
+
+    async def update_conversation(self, name, key, new_state):
+        self._stage(Kinds.CONVERSATION, name, key, new_state)
+
+    async def update_user_data(self, user_id, data):
+        self._stage(Kinds.USER, "", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._stage(Kinds.CHAT, "", chat_id, data)
+
+    async def update_bot_data(self, data):
+        self._stage(Kinds.BOT, "", "", data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        self._stage(Kinds.CHAT, "", chat_id, None)
+
+    async def drop_user_data(self, user_id):
+        self._stage(Kinds.USER, "", user_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh(Kinds.USER, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh(Kinds.CHAT, chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def sync_conversations(self, application, update):
+        """Loads the current state of ``update``'s conversations from the database, they may have moved
+        on in another process. Must run before the update is processed since the handlers check their
+        state first. Only a state this process changed and didn't write yet is kept."""
+        handlers = {}
+        for handler in itertools.chain.from_iterable(application.handlers.values()):
+            if not (isinstance(handler, ConversationHandler) and handler.persistent):
+                continue
+            if not conversations_syncable(handler):
+                if not self._sync_unsupported_logged:
+                    logger.error("python-telegram-bot is not %s, conversations are not synced between processes. "
+                                 "Check persistence.set_conversation", PTB_VERSION)
+                    self._sync_unsupported_logged = True
+                continue
+            key = conversation_key(handler, update)
+            if key is None:
+                continue
+            cache_key = (Kinds.CONVERSATION, handler.name, self._dump_key(key))
+            if cache_key in self._pending:
+                continue
+            cached = self._cache.get(cache_key)
+            if cached is not None and get_conversation(handler, key) != cached[0]:
+                continue
+            handlers[cache_key] = handler, key
+        if not handlers:
+            return
+        for cache_key, state in (await self._load_conversations(list(handlers))).items():
+            handler, key = handlers[cache_key]
+            self._remember(cache_key, state)
+            set_conversation(handler, key, state)
+
+    async def write_through(self, application):
+        """Hands the changes of the update just processed to the database right away instead of after
+        update_interval and flush_delay, the next update of the chat may be processed by another process."""
+        await application.update_persistence()
+        await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await self._write(pending)
+        except Exception:
+            logger.exception("Failed to write %s bot states", len(pending))
+            # Keep the newer values that were staged while writing
+            self._pending = {**pending, **self._pending}
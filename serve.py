@@ -1,4 +1,13 @@
+import time
+
+IMPORTS_STARTED_AT = time.monotonic()
+
 import os
+import zlib
+import asyncio
+import logging
+from collections import deque
+from datetime import timedelta
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,10 +21,21 @@ from telegram import Update, ReplyKeyboardMarkup
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 django.setup()
 
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
 from utils import get_user
+from bot import metrics
+from bot.models import ProcessedUpdate
+from bot.sender import RateLimiter
+from bot.http_client import TimedHTTPXRequest
+from persistence import DjangoPersistence
 from handlers import commands, common, parameters, web, excel
 import states
 
+IMPORTS_TIME = time.monotonic() - IMPORTS_STARTED_AT
+
 app = FastAPI()
 
 import sentry_sdk
@@ -33,9 +53,101 @@ sentry_sdk.init(
     },
 )
 
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
+# httpx logs every Bot API request on INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
 # Store bot applications in a dictionary
 applications = {}
 
+# Updates are acknowledged as soon as they are queued and processed by the lane workers below,
+# so a slow handler never holds Telegram's webhook connection open. Every chat is pinned to one
+# lane, which keeps its updates in order (the conversation states rely on it) while different
+# chats are handled in parallel.
+UPDATE_LANES = int(os.environ.get("UPDATE_LANES", 8))
+UPDATE_LANE_SIZE = int(os.environ.get("UPDATE_LANE_SIZE", 200))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", 30))
+
+lanes = []
+lane_workers = []
+
+# Only the update types the handlers below consume are delivered
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Conversation states and user_data are kept in the database, so a restart does not lose
+# in-flight orders and several workers can serve the same bot. They are read before and written
+# after every update, a cache TTL only makes sense with a single worker.
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", 1))
+PERSISTENCE_CACHE_TTL = float(os.environ.get("PERSISTENCE_CACHE_TTL", 0))
+
+# Telegram redelivers an update when the previous delivery was not acknowledged in time, possibly
+# to another worker. Every queued update id is claimed in ProcessedUpdate, whose unique key makes
+# the repeats fail whichever worker gets them. The ids this worker has queued are remembered in
+# memory too (bounded by count and age) so its own repeats cost no query. Claims older than
+# DEDUP_TTL are deleted every DEDUP_PRUNE_INTERVAL seconds.
+DEDUP_SIZE = int(os.environ.get("DEDUP_SIZE", 10000))
+DEDUP_TTL = float(os.environ.get("DEDUP_TTL", 24 * 60 * 60))
+DEDUP_PRUNE_INTERVAL = float(os.environ.get("DEDUP_PRUNE_INTERVAL", 60 * 60))
+
+deduplicators = {}
+pruners = []
+
+
+class UpdateDeduplicator:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.ids = set()
+        self.ring = deque()
+
+    def _expire(self, now):
+        while self.ring and (len(self.ring) >= self.size or now - self.ring[0][1] > self.ttl):
+            update_id, _ = self.ring.popleft()
+            self.ids.discard(update_id)
+
+    def seen(self, update_id):
+        self._expire(time.monotonic())
+        return update_id in self.ids
+
+    def add(self, update_id):
+        now = time.monotonic()
+        self._expire(now)
+        self.ids.add(update_id)
+        self.ring.append((update_id, now))
+
+
+@sync_to_async
+def claim_update(bot_id, update_id):
+    """Records the update as queued, False when a worker has queued it already."""
+    try:
+        with transaction.atomic():
+            ProcessedUpdate.objects.create(bot_id=bot_id, update_id=update_id)
+    except IntegrityError:
+        return False
+    return True
+
+
+@sync_to_async
+def release_update(bot_id, update_id):
+    ProcessedUpdate.objects.filter(bot_id=bot_id, update_id=update_id).delete()
+
+
+@sync_to_async
+def prune_updates(ttl=DEDUP_TTL):
+    """Deletes the claims Telegram won't redeliver any more, returns how many."""
+    deleted, _ = ProcessedUpdate.objects.filter(received_at__lt=timezone.now() - timedelta(seconds=ttl)).delete()
+    return deleted
+
+
+async def pruner():
+    while True:
+        try:
+            await prune_updates()
+        except Exception:
+            logger.exception("Failed to prune the processed updates")
+        await asyncio.sleep(DEDUP_PRUNE_INTERVAL)
+
 CHOOSING, TYPING_REPLY = range(2)
 
 
@@ -52,71 +164,170 @@ async def handle_reply(update, context):
     return ConversationHandler.END
 
 
-conversation_handler = ConversationHandler(
-    entry_points=[
-        MessageHandler(filters.Text("⚙️ Настройки"), parameters.get_parameters)
-    ],
-    states={
-        states.GET_SETTING: [MessageHandler(filters.TEXT, parameters.get_setting)],
-        states.GET_FULL_NAME: [MessageHandler(filters.TEXT, parameters.get_full_name)],
-        states.GET_PHONE: [MessageHandler(filters.TEXT, parameters.get_phone)],
-    },
-    fallbacks=[
-        CommandHandler("start", commands.start)
-    ]
-)
-
-order_handler = ConversationHandler(
-    entry_points=[
-        MessageHandler(filters.StatusUpdate.WEB_APP_DATA, web.web_app_data),
-        MessageHandler(filters.Text("🛍 Продукты"), web.get_agent_client),
-        MessageHandler(filters.Text("Выберите клиента"), web.get_agent_client),
-    ],
-    states={
-        states.SEARCH_CLIENT: [
-            CallbackQueryHandler(web.get_searched_user),
-            MessageHandler(filters.TEXT, web.get_searched_user)
+# Every application gets its own conversation handlers, their states are loaded from and saved
+# to that application's persistence.
+def build_conversation_handler():
+    return ConversationHandler(
+        entry_points=[
+            MessageHandler(filters.Text("⚙️ Настройки"), parameters.get_parameters)
         ],
-        states.CHOOSE_CLIENT: [
-            CallbackQueryHandler(web.get_client),
-            MessageHandler(filters.TEXT, web.get_client)
+        states={
+            states.GET_SETTING: [MessageHandler(filters.TEXT, parameters.get_setting)],
+            states.GET_FULL_NAME: [MessageHandler(filters.TEXT, parameters.get_full_name)],
+            states.GET_PHONE: [MessageHandler(filters.TEXT, parameters.get_phone)],
+        },
+        fallbacks=[
+            CommandHandler("start", commands.start)
         ],
-        states.CHOOSE_PAYMENT: [
-            CallbackQueryHandler(web.get_payment)
+        name="conversation_handler",
+        persistent=True,
+    )
+
+
+def build_order_handler():
+    return ConversationHandler(
+        entry_points=[
+            MessageHandler(filters.StatusUpdate.WEB_APP_DATA, web.web_app_data),
+            MessageHandler(filters.Text("🛍 Продукты"), web.get_agent_client),
+            MessageHandler(filters.Text("Выберите клиента"), web.get_agent_client),
         ],
-        states.CHOOSE_LOCATION: [
-            MessageHandler(filters.ALL, web.get_location)
-        ]
-    },
-    fallbacks=[
-        CommandHandler("start", commands.start)
-    ]
-)
+        states={
+            states.SEARCH_CLIENT: [
+                CallbackQueryHandler(web.get_searched_user),
+                MessageHandler(filters.TEXT, web.get_searched_user)
+            ],
+            states.CHOOSE_CLIENT: [
+                CallbackQueryHandler(web.get_client),
+                MessageHandler(filters.TEXT, web.get_client)
+            ],
+            states.CHOOSE_PAYMENT: [
+                CallbackQueryHandler(web.get_payment)
+            ],
+            states.CHOOSE_LOCATION: [
+                MessageHandler(filters.ALL, web.get_location)
+            ]
+        },
+        fallbacks=[
+            CommandHandler("start", commands.start)
+        ],
+        name="order_handler",
+        persistent=True,
+    )
 
 
 async def setup_bot(token: str):
-    application = Application.builder().token(token).build()
-    application.add_handler(order_handler)
+    persistence = DjangoPersistence(
+        bot_id=token.split(":")[0],
+        update_interval=PERSISTENCE_INTERVAL,
+        cache_ttl=PERSISTENCE_CACHE_TTL,
+    )
+    application = (
+        Application.builder()
+        .token(token)
+        .persistence(persistence)
+        .request(TimedHTTPXRequest())
+        .rate_limiter(RateLimiter(token.split(":")[0]))
+        .build()
+    )
+    application.add_handler(build_order_handler())
     application.add_handler(CommandHandler("start", commands.start))
     application.add_handler(CommandHandler("category", commands.category))
     application.add_handler(MessageHandler(filters.Text("📞 Связаться с нами"), common.contact))
-    application.add_handler(conversation_handler)
+    application.add_handler(build_conversation_handler())
     application.add_handler(MessageHandler(filters.ALL, commands.start))
     application.add_handler(CallbackQueryHandler(excel.send_excel))
 
+    timings = {}
+    started_at = time.monotonic()
+    await application.initialize()
+    # Starts the loop that hands changed data and conversation states to the persistence
+    await application.start()
+    timings["initialize"] = time.monotonic() - started_at
     applications[token] = application
+    deduplicators[token] = UpdateDeduplicator(DEDUP_SIZE, DEDUP_TTL)
 
     webhook_url = f"{os.environ.get('WEBHOOK')}webhook?token={token}"
-    print(webhook_url)
-    await application.bot.set_webhook(url=webhook_url)
+    started_at = time.monotonic()
+    webhook_info = await application.bot.get_webhook_info()
+    timings["get_webhook_info"] = time.monotonic() - started_at
+
+    if webhook_info.url == webhook_url and set(webhook_info.allowed_updates or ()) == set(ALLOWED_UPDATES):
+        timings["set_webhook"] = None
+    else:
+        started_at = time.monotonic()
+        await application.bot.set_webhook(url=webhook_url, allowed_updates=ALLOWED_UPDATES)
+        timings["set_webhook"] = time.monotonic() - started_at
+
+    return application.bot.id, timings
+
+
+def get_lane_index(token, update):
+    chat = update.effective_chat
+    key = chat.id if chat else update.update_id
+    return zlib.crc32(f"{token}:{key}".encode()) % len(lanes)
+
+
+async def lane_worker(index):
+    lane = lanes[index]
+    while True:
+        application, update, queued_at = await lane.get()
+        started_at = time.monotonic()
+        metrics.observe("updates.wait", started_at - queued_at)
+        metrics.observe(f"updates.lane.{index}.wait", started_at - queued_at)
+        try:
+            await application.persistence.sync_conversations(application, update)
+            try:
+                await application.process_update(update)
+            finally:
+                await application.persistence.write_through(application)
+        except Exception:
+            logger.exception("Failed to process update %s", update.update_id)
+        finally:
+            metrics.observe("updates.handle", time.monotonic() - started_at)
+            lane.task_done()
 
 
 @app.on_event("startup")
 async def on_startup():
+    started_at = time.monotonic()
     bot_tokens = os.environ.get("TOKENS").split(",")
 
-    for token in bot_tokens:
-        await setup_bot(token)
+    for index in range(UPDATE_LANES):
+        lanes.append(asyncio.Queue(maxsize=UPDATE_LANE_SIZE))
+        lane_workers.append(asyncio.create_task(lane_worker(index)))
+
+    results = await asyncio.gather(*[setup_bot(token) for token in bot_tokens])
+    pruners.append(asyncio.create_task(pruner()))
+
+    for bot_id, timings in results:
+        logger.info(
+            "Bot %s ready: %s", bot_id,
+            ", ".join(f"{step} {'skipped' if spent is None else f'{spent:.3f}s'}" for step, spent in timings.items())
+        )
+    logger.info("Startup took %.3fs (imports %.3fs)", time.monotonic() - started_at, IMPORTS_TIME)
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    try:
+        await asyncio.wait_for(asyncio.gather(*[lane.join() for lane in lanes]), timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Shutting down with %s unprocessed updates", sum(lane.qsize() for lane in lanes))
+
+    for worker in lane_workers + pruners:
+        worker.cancel()
+    await asyncio.gather(*lane_workers, *pruners, return_exceptions=True)
+    lane_workers.clear()
+    pruners.clear()
+
+    for application in applications.values():
+        await application.stop()
+        await application.shutdown()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return {"lane_depth": [lane.qsize() for lane in lanes], **metrics.snapshot()}
 
 
 @app.get("/sentry-debug")
@@ -130,11 +341,28 @@ async def handle_update(request: Request, token: str = Query(...)):
         raise HTTPException(status_code=404, detail="Invalid bot token")
 
     application = applications[token]
+    deduplicator = deduplicators[token]
     data = await request.json()
 
+    bot_id = token.split(":")[0]
+    update_id = data.get("update_id")
+    if deduplicator.seen(update_id) or not await claim_update(bot_id, update_id):
+        metrics.incr("updates.dedup.hit")
+        return {"status": "ok"}
+    metrics.incr("updates.dedup.miss")
+
     update = Update.de_json(data, application.bot)
-    await application.initialize()
-    await application.process_update(update)
+    index = get_lane_index(token, update)
+    try:
+        lanes[index].put_nowait((application, update, time.monotonic()))
+    except asyncio.QueueFull:
+        # Let Telegram redeliver later instead of blocking the connection, to whichever worker
+        await release_update(bot_id, update_id)
+        metrics.incr("updates.rejected")
+        raise HTTPException(status_code=503, detail="Update queue is full")
+    # Only remember updates that were actually queued, a rejected one must be accepted when redelivered
+    deduplicator.add(update_id)
+    metrics.incr("updates.received")
 
     return {"status": "ok"}
 
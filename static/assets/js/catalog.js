@@ -0,0 +1,109 @@
+// Loads the rest of the product list page by page while the user scrolls, see WebAppProductsView
+const CARD_SIZES = '(max-width: 600px) 45vw, 270px';
+
+document.addEventListener('DOMContentLoaded', function () {
+    const list = document.getElementById('products');
+    const end = document.getElementById('productsEnd');
+    if (!list || !end || !list.dataset.next) {
+        return;
+    }
+    let next = list.dataset.next;
+    let loading = false;
+
+    function productCard(product) {
+        const column = document.createElement('div');
+        column.className = 'col-sm-6 p-2 col-6 m-0 p-0';
+
+        const link = document.createElement('a');
+        link.className = 'link';
+        link.href = product.url;
+
+        const cover = document.createElement('div');
+        cover.className = 'cat-cover mb-1';
+        const image = document.createElement('img');
+        image.alt = '';
+        image.loading = 'lazy';
+        const sources = product.cover_sources;
+        if (sources) {
+            // Same as templates/cover.html
+            const picture = document.createElement('picture');
+            const webp = document.createElement('source');
+            webp.type = 'image/webp';
+            webp.srcset = sources.webp;
+            webp.sizes = CARD_SIZES;
+            image.src = sources.src;
+            image.srcset = sources.jpg;
+            image.sizes = CARD_SIZES;
+            picture.appendChild(webp);
+            picture.appendChild(image);
+            cover.appendChild(picture);
+        } else {
+            image.src = product.cover;
+            cover.appendChild(image);
+        }
+
+        const title = document.createElement('div');
+        title.className = 'sub-title';
+        title.style.wordBreak = 'break-all';
+        title.textContent = product.title;
+
+        const details = document.createElement('div');
+        details.className = 'product-details';
+        const prices = document.createElement('ul');
+        prices.className = 'product-prices';
+        const price = document.createElement('li');
+        price.textContent = product.price + ' сум';
+        prices.appendChild(price);
+        const basket = document.createElement('img');
+        basket.src = list.dataset.basket;
+        basket.alt = '';
+        details.appendChild(prices);
+        details.appendChild(basket);
+
+        link.appendChild(cover);
+        link.appendChild(title);
+        link.appendChild(details);
+        column.appendChild(link);
+        return column;
+    }
+
+    const observer = new IntersectionObserver(function (entries) {
+        if (entries[0].isIntersecting) {
+            loadNext();
+        }
+    }, {rootMargin: '600px'});
+
+    function loadNext() {
+        if (loading || !next) {
+            return;
+        }
+        loading = true;
+        fetch(next)
+            .then(function (response) {
+                if (!response.ok) {
+                    throw new Error(response.status);
+                }
+                return response.json();
+            })
+            .then(function (data) {
+                data.products.forEach(function (product) {
+                    list.appendChild(productCard(product));
+                });
+                next = data.next;
+                loading = false;
+                // Observing again reports the end right away if the new page didn't fill the screen
+                observer.unobserve(end);
+                if (next) {
+                    observer.observe(end);
+                }
+            })
+            .catch(function () {
+                // Retried the next time the end of the list scrolls into view
+                loading = false;
+                observer.unobserve(end);
+                observer.observe(end);
+            });
+    }
+
+    observer.observe(end);
+});
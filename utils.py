@@ -1,34 +1,67 @@
+import time
+from collections import OrderedDict
 from functools import wraps
 from pprint import pprint
 
 from asgiref.sync import sync_to_async
 from telegram import Update
 
+from bot import catalog
 from bot.models import TelegramUser
 
-def get_user(handler):
-    @wraps(handler)
-    async def wrapper(update: Update, context, *args, **kwargs):
-        user = update.effective_user
-        user_data = {
-            'telegram_id': user.id,
-            'username': user.username,
-            'first_name': user.first_name,
-            'last_name': user.last_name,
-        }
+# Resolved users are kept in memory so a button press does not cost a read and a write. Every
+# TelegramUser change, from this process or the admin, bumps catalog.users_version() and the entries
+# read before it are read again within catalog.VERSION_TTL. USER_CACHE_TTL only bounds how long a
+# bulk update(), which sends no signal, goes unnoticed.
+USER_CACHE_SIZE = 2000
+USER_CACHE_TTL = 10 * 60
+
+_user_cache = OrderedDict()
+
 
+async def resolve_user(telegram_user):
+    key = str(telegram_user.id)
+    version = await sync_to_async(catalog.users_version)()
+    cached = _user_cache.get(key)
+    if cached and cached[2] == version and time.monotonic() - cached[1] < USER_CACHE_TTL:
+        user, cached_at, _ = cached
+    else:
+        cached_at = time.monotonic()
         try:
-            user = await TelegramUser.objects.prefetch_related("territory").aget(telegram_id=user.id)
-            user.username = user_data.get("username", "")
-            if not user.is_updated:
-                user.first_name = user_data.get("first_name", "")
-                user.last_name = user_data.get("last_name", "")
+            user = await TelegramUser.objects.prefetch_related("territory").aget(telegram_id=key)
+        except TelegramUser.DoesNotExist:
+            user = await TelegramUser.objects.acreate(
+                telegram_id=telegram_user.id,
+                username=telegram_user.username,
+                first_name=telegram_user.first_name,
+                last_name=telegram_user.last_name,
+            )
+
+    changed_fields = []
+    if user.username != telegram_user.username:
+        user.username = telegram_user.username
+        changed_fields.append("username")
+    if not user.is_updated:
+        if user.first_name != telegram_user.first_name:
+            user.first_name = telegram_user.first_name
+            changed_fields.append("first_name")
+        if user.last_name != telegram_user.last_name:
+            user.last_name = telegram_user.last_name
+            changed_fields.append("last_name")
+    if changed_fields:
+        await user.asave(update_fields=changed_fields)
+
+    _user_cache[key] = (user, cached_at, version)
+    _user_cache.move_to_end(key)
+    if len(_user_cache) > USER_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+    return user
 
-            await user.asave()
-        except Exception as e:
-            print(e)
-            user = await TelegramUser.objects.acreate(**user_data)
 
+def get_user(handler):
+    @wraps(handler)
+    async def wrapper(update: Update, context, *args, **kwargs):
+        user = await resolve_user(update.effective_user)
         return await handler(update, context, user, *args, **kwargs)
 
     return wrapper
@@ -44,10 +77,9 @@ def update_or_create(model, params, defaults):
     return obj, created
 
 
-from openpyxl import load_workbook
-
-
 def import_data():
+    from openpyxl import load_workbook
+    from bot import catalog
     from bot.models import Product
     workbook = load_workbook(filename="dumb.xlsx")
     sheet = workbook.active
@@ -58,11 +90,13 @@ def import_data():
         price_uzs_c = str(price_uzs_c).replace(',00', '').replace(' ', '')
         price_uzs_d = str(price_uzs_d).replace(',00', '').replace(' ', '')
         price_uzs_e = str(price_uzs_e).replace(',00', '').replace(' ', '')
-        Product.objects.create(title=name, price_uzs_a=price_uzs_a, price_uzs_b=price_uzs_b, price_uzs_c=price_uzs_c,
-                               price_uzs_d=price_uzs_d, price_uzs_e=price_uzs_e)
+        product = Product.objects.create(title=name)
+        catalog.set_prices(product, {"a": price_uzs_a, "b": price_uzs_b, "c": price_uzs_c, "d": price_uzs_d,
+                                     "e": price_uzs_e})
 
 
 def import_client_data():
+    from openpyxl import load_workbook
     from bot.models import Area
     area, created = Area.objects.get_or_create(name="Мирзо Улугбек")
     workbook = load_workbook(filename="clients.xlsx")